@@ -0,0 +1,463 @@
+""" Benchmarks the stages of the SubcellularDistribution pipeline on reproducible synthetic images
+
+Synthetic segmentation and intensity volumes are generated for three structures: 'rna' (small spots placed w/ a Poisson process),
+'centrosomes' (medium sized blobs) and 'nuclei' (large blobs). Every stage is timed separately and the timings are written as JSON,
+so the results of two runs (e.g. before and after a change) can be compared w/ --compare
+
+If --database is given, the database stages run against that postgres database, which is created for the benchmark and dropped
+afterwards (use a throwaway name; the benchmark refuses to use a database that already exists). The connection settings are read
+from the same environment variables as pipeline.py (POSTGRES_HOST, POSTGRES_PORT, POSTGRES_USER, POSTGRES_PASSWORD).
+W/o --database, in-process stand-ins are timed instead and their stages are named after what they run: prepare_insert_rows
+(the rows are prepared for insert_object_data but not sent), measure_image_objects (distances measured in memory per image) and
+compute_cumulative_distributions. --storage-format, --measurement-mode and --distribution-mode only apply to the database stages,
+so they are rejected w/o --database
+
+Usage:
+python benchmark.py --output benchmark.json
+python benchmark.py --database pipeline_benchmark --output benchmark.json --compare previous_benchmark.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import pipeline
+
+
+STRUCTURES = ['rna', 'centrosomes', 'nuclei']
+
+TARGET_STRUCTURES = ['centrosomes', 'nuclei']
+
+
+def parse_arguments(argv=None):
+    """ Returns the parsed command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the SubcellularDistribution pipeline on synthetic images')
+
+    parser.add_argument('--output', default='benchmark.json', help='path of the JSON file to write the timings to')
+    parser.add_argument('--compare', help='path of an earlier JSON output to compare the timings with')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic images')
+    parser.add_argument('--images', type=int, default=2, help='number of synthetic images')
+    parser.add_argument('--shape', type=int, nargs=3, default=[32, 256, 256], metavar=('Z', 'Y', 'X'), help='image shape in voxels')
+    parser.add_argument('--xy-scale', type=float, default=0.065, help='microns per pixel in the xy dimension')
+    parser.add_argument('--z-scale', type=float, default=0.25, help='microns between each z step')
+    parser.add_argument('--spot-density', type=float, default=0.2, help='mean number of rna spots per cubic micron')
+    parser.add_argument('--spot-radius', type=float, default=0.1, help='rna spot radius in microns')
+    parser.add_argument('--centrosomes', type=int, default=4, help='number of centrosomes per image')
+    parser.add_argument('--centrosome-radius', type=float, default=0.6, help='centrosome radius in microns')
+    parser.add_argument('--nuclei', type=int, default=2, help='number of nuclei per image')
+    parser.add_argument('--nucleus-radius', type=float, default=2.5, help='nucleus radius in microns')
+    parser.add_argument('--number-centroid-measure', type=int, default=3, help='number_centroid_measure for the distance measurements')
+    parser.add_argument('--max-pairs', type=int, default=2000, help='maximum number of object pairs timed w/ minimum_distance')
+    parser.add_argument('--step-size', type=float, default=0.05, help='step_size for the distributions')
+    parser.add_argument('--distance-threshold', type=float, default=5, help='distance_threshold for the distributions')
+    parser.add_argument('--database', help='name of a throwaway postgres database to create for the database stages')
+    parser.add_argument('--keep-database', action='store_true', help='do not drop the database after the benchmark')
+    parser.add_argument('--storage-format', choices=['array', 'compact'], help='storage_format of the structure tables (default array, requires --database)')
+    parser.add_argument('--measurement-mode', choices=['object', 'image', 'edt', 'queue'], help='measurement_mode of measure_distances (default image, requires --database)')
+    parser.add_argument('--distribution-mode', choices=['query', 'sql', 'numpy'], help='distribution_mode of calculate_distributions_by_image (default sql, requires --database)')
+
+    args = parser.parse_args(argv)
+
+    database_defaults = {'storage_format': 'array', 'measurement_mode': 'image', 'distribution_mode': 'sql'}
+
+    for option, default in database_defaults.items():
+        if not args.database:
+            if getattr(args, option) is not None:
+                parser.error('--' + option.replace('_', '-') + ' only applies to the database stages and requires --database')
+        elif getattr(args, option) is None:
+            setattr(args, option, default)
+
+    return args
+
+def add_ellipsoid(mask, center, radii):
+    """ Sets the voxels of mask inside the ellipsoid w/ the given center and radii (in voxels, z, y, x) to True
+
+    Returns nothing
+    """
+
+    lower = [max(0, int(np.floor(center[axis] - radii[axis]))) for axis in range(3)]
+    upper = [min(mask.shape[axis], int(np.ceil(center[axis] + radii[axis])) + 1) for axis in range(3)]
+
+    if any(upper[axis] <= lower[axis] for axis in range(3)):
+        return
+
+    zz, yy, xx = np.ogrid[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+
+    inside = (((zz - center[0]) / radii[0]) ** 2 + ((yy - center[1]) / radii[1]) ** 2 + ((xx - center[2]) / radii[2]) ** 2) <= 1
+
+    mask[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]] |= inside
+
+    return
+
+def synthetic_mask(random_state, shape, object_count, radius, xy_scale, z_scale):
+    """ Returns a boolean volume w/ object_count ellipsoids placed uniformly at random
+    radius is in microns; the radii in voxels follow from the xy and z scale, w/ at least half a voxel along each axis
+    """
+
+    mask = np.zeros(shape, dtype=bool)
+
+    radii = (max(0.5, radius / z_scale), max(0.5, radius / xy_scale), max(0.5, radius / xy_scale))
+
+    for center in random_state.uniform(0, 1, size=(object_count, 3)) * np.array(shape):
+        add_ellipsoid(mask, center, radii)
+
+    return mask
+
+def synthetic_intensity(random_state, mask, background=100, signal=1000):
+    """ Returns a uint16 intensity volume w/ Poisson noise around background outside of the mask and background + signal inside it
+    """
+
+    return random_state.poisson(background + signal * mask).astype(np.uint16)
+
+def generate_synthetic_images(image_dir, args):
+    """ Writes the synthetic segmentation and intensity images to image_dir in the folder layout used by pipeline.ipynb
+    (<structure>/segmentations and <structure>/raw-data)
+
+    Returns a list of tuples in format [(structure, image_name, segmented_image_path, intensity_image_path)]
+    """
+
+    from skimage.io import imsave
+
+    random_state = np.random.RandomState(args.seed)
+
+    shape = tuple(args.shape)
+    volume = shape[0] * args.z_scale * shape[1] * args.xy_scale * shape[2] * args.xy_scale
+
+    object_settings = {'rna': (args.spot_radius, 1000),
+                       'centrosomes': (args.centrosome_radius, 600),
+                       'nuclei': (args.nucleus_radius, 300)}
+
+    image_files = []
+
+    for image_idx in range(args.images):
+        image_name = 'image_{idx:03d}.tif'.format(idx=image_idx)
+
+        object_counts = {'rna': random_state.poisson(args.spot_density * volume),
+                         'centrosomes': args.centrosomes,
+                         'nuclei': args.nuclei}
+
+        for structure in STRUCTURES:
+            radius, signal = object_settings[structure]
+
+            mask = synthetic_mask(random_state, shape, object_counts[structure], radius, args.xy_scale, args.z_scale)
+            intensity = synthetic_intensity(random_state, mask, signal=signal)
+
+            seg_img_path = os.path.join(image_dir, structure, 'segmentations', image_name)
+            ins_img_path = os.path.join(image_dir, structure, 'raw-data', image_name)
+
+            for image_path, image_data in ((seg_img_path, mask.astype(np.uint8) * 255), (ins_img_path, intensity)):
+                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                imsave(image_path, image_data, check_contrast=False)
+
+            image_files.append((structure, image_name, seg_img_path, ins_img_path))
+
+    return image_files
+
+def create_benchmark_database(database_name):
+    """ Creates database_name; raises a ValueError if it already exists, so a real experiment's database is never used
+
+    Returns nothing
+    """
+
+    import psycopg2
+    from psycopg2 import sql
+
+    connection_settings = pipeline.database_connection_settings(os.environ.get('POSTGRES_DB', 'postgres'))
+
+    conn = psycopg2.connect(**connection_settings)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    cur.execute("SELECT COUNT(*) FROM pg_database WHERE datname = %s;", (database_name,))
+    if cur.fetchone()[0]:
+        cur.close()
+        conn.close()
+        raise ValueError("database {database_name!r} already exists; the benchmark needs a throwaway database name".format(database_name=database_name))
+
+    cur.execute(sql.SQL("CREATE DATABASE {database}").format(database=sql.Identifier(database_name)))
+
+    cur.close()
+    conn.close()
+
+    return
+
+def drop_benchmark_database(database_name):
+    """ Closes the pipeline's connections to database_name and drops it
+
+    Returns nothing
+    """
+
+    import psycopg2
+    from psycopg2 import sql
+
+    pipeline.close_connection_pools()
+
+    conn = psycopg2.connect(**pipeline.database_connection_settings(os.environ.get('POSTGRES_DB', 'postgres')))
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(sql.SQL("DROP DATABASE IF EXISTS {database}").format(database=sql.Identifier(database_name)))
+    cur.close()
+    conn.close()
+
+    return
+
+def prepare_insert_rows(structure_data):
+    """ In-process stand-in for insert_object_data: prepares the rows in the same way, but keeps them in a list
+
+    Returns the list of rows
+    """
+
+    prepared_rows = []
+
+    for object_data in pipeline.iter_object_data(structure_data):
+        prepared_rows.append(dict(object_data,
+                                  coordinates=np.asarray(object_data['coordinates']).tolist(),
+                                  intensity_image=np.asarray(object_data['intensity_image']).tolist()))
+
+    return prepared_rows
+
+def check_distance_engines(object_data, image_names, xy_scale, z_scale):
+    """ Checks that measure_image_objects_edt finds the same distances as measure_image_objects (w/ candidate_mode='bound', which is exact)
+    for a spot inside a sphere, a spot outside of it and the synthetic rna objects to every target structure
+
+    Raises a RuntimeError if any distance differs; returns the number of distances compared
+    """
+
+    scale = np.array([z_scale, xy_scale, xy_scale])
+
+    # a 3x3x3 spot in the center of a sphere w/ a radius of 8 voxels and a second spot outside of the sphere
+    grid = np.indices((40, 40, 40)).reshape(3, -1).T
+    sphere = grid[((grid - 20) ** 2).sum(axis=1) <= 64] * scale
+    inner_spot = grid[(np.abs(grid - 20) <= 1).all(axis=1)] * scale
+    outer_spot = grid[(np.abs(grid - [20, 20, 36]) <= 1).all(axis=1)] * scale
+
+    structure_pairs = [([(1, inner_spot.mean(axis=0), inner_spot), (2, outer_spot.mean(axis=0), outer_spot)], [(1, sphere.mean(axis=0), sphere)])]
+
+    for structure_2 in TARGET_STRUCTURES:
+        for image_name in image_names:
+            structure_pairs.append(tuple([(single_object['object_id'], single_object['centroid'], single_object['coordinates'])
+                                          for single_object in object_data.get((structure, image_name), [])] for structure in ('rna', structure_2)))
+
+    compared = 0
+
+    for structure_1_data, structure_2_data in structure_pairs:
+        if not structure_1_data or not structure_2_data:
+            continue
+
+        surface_distances = pipeline.measure_image_objects(structure_1_data, structure_2_data, None, candidate_mode='bound')
+        edt_distances = pipeline.measure_image_objects_edt(structure_1_data, structure_2_data, xy_scale, z_scale)
+
+        for (object_id, surface_distance, surface_id), (edt_id, edt_distance, edt_structure_2_id) in zip(surface_distances, edt_distances):
+            if object_id != edt_id or abs(surface_distance - edt_distance) > 1e-6:
+                raise RuntimeError('The edt engine measured {edt_distance} instead of {surface_distance} for object {object_id}'.format(
+                    edt_distance=edt_distance, surface_distance=surface_distance, object_id=object_id))
+
+            compared += 1
+
+    return compared
+
+def time_stage(stage_timings, stage, backend, stage_function, count_function=None):
+    """ Runs stage_function() once and saves its wall and cpu time in stage_timings[stage]
+    count_function takes the result and returns the number of items processed (e.g. objects), which is saved as 'count'
+
+    Returns the result of stage_function
+    """
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    result = stage_function()
+
+    wall_seconds = time.perf_counter() - wall_start
+    cpu_seconds = time.process_time() - cpu_start
+
+    stage_timings[stage] = {'backend': backend, 'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds}
+
+    if count_function is not None:
+        stage_timings[stage]['count'] = int(count_function(result))
+
+    print('{stage}: {seconds:.3f} s ({backend})'.format(stage=stage, seconds=wall_seconds, backend=backend))
+
+    return result
+
+def run_benchmark(args):
+    """ Generates the synthetic images and times each pipeline stage
+
+    Returns the benchmark results as a dictionary
+    """
+
+    import pandas as pd
+
+    backend = 'postgres' if args.database else 'memory'
+
+    stage_timings = {}
+
+    with tempfile.TemporaryDirectory() as image_dir:
+        image_files = time_stage(stage_timings, 'generate_synthetic_images', 'memory', lambda: generate_synthetic_images(image_dir, args), len)
+
+        def extract_all():
+            object_data = {}
+
+            for structure, image_name, seg_img_path, ins_img_path in image_files:
+                object_data[(structure, image_name)] = pipeline.extract_object_properties(seg_img_path, ins_img_path, image_name, args.xy_scale, args.z_scale, arrays_bool=True)
+
+            return object_data
+
+        object_data = time_stage(stage_timings, 'extract_object_properties', 'memory', extract_all,
+                                 lambda result: sum(len(image_data) for image_data in result.values()))
+
+    image_names = sorted({image_name for structure, image_name in object_data})
+
+    print('Checked {count} distances of the edt engine against measure_image_objects'.format(
+        count=check_distance_engines(object_data, image_names, args.xy_scale, args.z_scale)))
+
+    if args.database:
+        def insert_all():
+            for structure in STRUCTURES:
+                pipeline.create_postgres_table(structure, args.database, storage_format=args.storage_format)
+
+            for (structure, image_name), image_data in object_data.items():
+                pipeline.insert_object_data(structure, image_data, args.database)
+
+            return object_data
+
+        time_stage(stage_timings, 'insert_object_data', backend, insert_all, lambda result: sum(len(image_data) for image_data in result.values()))
+    else:
+        time_stage(stage_timings, 'prepare_insert_rows', backend, lambda: [prepare_insert_rows(image_data) for image_data in object_data.values()],
+                   lambda result: sum(len(rows) for rows in result))
+
+    # surfaces of every object
+    def extract_all_surfaces():
+        return {key: [np.array(pipeline.extract_surface_coordinates(single_object['coordinates'])) for single_object in image_data]
+                for key, image_data in object_data.items()}
+
+    surfaces = time_stage(stage_timings, 'extract_surface_coordinates', 'memory', extract_all_surfaces,
+                          lambda result: sum(len(image_surfaces) for image_surfaces in result.values()))
+
+    # rna to centrosome surface pairs in the same image, up to max_pairs
+    surface_pairs = []
+    for image_name in image_names:
+        for surface_1 in surfaces.get(('rna', image_name), []):
+            for surface_2 in surfaces.get(('centrosomes', image_name), []):
+                if len(surface_pairs) < args.max_pairs:
+                    surface_pairs.append((surface_1, surface_2))
+
+    time_stage(stage_timings, 'minimum_distance', 'memory', lambda: [pipeline.minimum_distance(surface_1, surface_2) for surface_1, surface_2 in surface_pairs], len)
+
+    if args.database:
+        def measure_all():
+            for structure_2 in TARGET_STRUCTURES:
+                pipeline.measure_distances(('rna', structure_2), False, args.database, args.number_centroid_measure, measurement_mode=args.measurement_mode,
+                                           xy_scale=args.xy_scale, z_scale=args.z_scale)
+
+            return object_data
+
+        time_stage(stage_timings, 'measure_distances', backend, measure_all,
+                   lambda result: len(TARGET_STRUCTURES) * sum(len(result.get(('rna', image_name), [])) for image_name in image_names))
+
+        # the distributions read the images table
+        with pipeline.database_connection(args.database) as conn:
+            cur = conn.cursor()
+            cur.execute("CREATE TABLE images (name TEXT, condition TEXT);")
+            cur.executemany("INSERT INTO images (name, condition) VALUES (%s, %s);", [(image_name, 'synthetic') for image_name in image_names])
+            cur.close()
+
+        time_stage(stage_timings, 'calculate_distributions_by_image', backend,
+                   lambda: pipeline.calculate_distributions_by_image(args.distance_threshold, False, None, args.step_size, 'name', 'rna', 'centrosomes',
+                                                                     args.database, distribution_mode=args.distribution_mode), len)
+    else:
+        # in-memory stand-in for measurement_mode='image': the same per-image measurement, w/o the database round trips
+        def measure_all_in_memory():
+            distance_rows = []
+
+            for structure_2 in TARGET_STRUCTURES:
+                for image_name in image_names:
+                    structure_1_data = [(single_object['object_id'], single_object['centroid'], single_object['coordinates'])
+                                        for single_object in object_data.get(('rna', image_name), [])]
+                    structure_2_data = [(single_object['object_id'], single_object['centroid'], single_object['coordinates'])
+                                        for single_object in object_data.get((structure_2, image_name), [])]
+
+                    if not structure_1_data or not structure_2_data:
+                        continue
+
+                    distance_results = pipeline.measure_image_objects(structure_1_data, structure_2_data, args.number_centroid_measure)
+
+                    if structure_2 == 'centrosomes':
+                        total_intensities = {single_object['object_id']: single_object['total_intensity'] for single_object in object_data[('rna', image_name)]}
+                        distance_rows.extend((image_name, distance, total_intensities[object_id], np.nan) for object_id, distance, structure_2_id in distance_results)
+
+            return distance_rows
+
+        distance_rows = time_stage(stage_timings, 'measure_image_objects', backend, measure_all_in_memory, len)
+
+        distance_data = pd.DataFrame(distance_rows, columns=['name', 'distance', 'total_intensity', 'normalized_intensity'])
+        image_data_list = [{'name': image_name, 'condition': 'synthetic'} for image_name in image_names]
+
+        time_stage(stage_timings, 'compute_cumulative_distributions', backend,
+                   lambda: pipeline.compute_cumulative_distributions(distance_data, image_data_list, args.distance_threshold, False, None, args.step_size, 'name'), len)
+
+    object_counts = {structure: sum(len(image_data) for (object_structure, image_name), image_data in object_data.items() if object_structure == structure)
+                     for structure in STRUCTURES}
+
+    return {'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()},
+            'backend': backend,
+            'object_counts': object_counts,
+            'stages': stage_timings}
+
+def compare_results(results, previous_results):
+    """ Prints the wall time of each stage next to its time in previous_results
+
+    Returns nothing
+    """
+
+    print('{stage:<34} {previous:>10} {current:>10} {ratio:>7}'.format(stage='stage', previous='previous', current='current', ratio='ratio'))
+
+    for stage, stage_timing in results['stages'].items():
+        previous_timing = previous_results.get('stages', {}).get(stage)
+
+        if previous_timing is None:
+            print('{stage:<34} {previous:>10} {current:>10.3f}'.format(stage=stage, previous='-', current=stage_timing['wall_seconds']))
+            continue
+
+        ratio = stage_timing['wall_seconds'] / previous_timing['wall_seconds'] if previous_timing['wall_seconds'] else float('nan')
+
+        print('{stage:<34} {previous:>10.3f} {current:>10.3f} {ratio:>7.2f}'.format(stage=stage, previous=previous_timing['wall_seconds'],
+                                                                                   current=stage_timing['wall_seconds'], ratio=ratio))
+
+    return
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    if args.database:
+        create_benchmark_database(args.database)
+
+    try:
+        results = run_benchmark(args)
+    finally:
+        if args.database and not args.keep_database:
+            drop_benchmark_database(args.database)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    print('Timings saved to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare_results(results, json.load(previous_file))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
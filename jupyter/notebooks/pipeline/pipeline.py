@@ -1,639 +1,3630 @@
-def extract_object_properties(segmented_image_path, intensity_image_path, image_name, xy_scale, z_scale):
-    """
-    Takes a segmented image and the corresponding intensity image for that segmentation
+from contextlib import contextmanager
+from threading import local
+from weakref import WeakKeyDictionary
 
-    Measures minimum, mean, max, and total intensity in addition to total # of pixels per object
 
-    Returns a list of dictionaries, where each dictionary has a key-value pair mapping
-    object property terms to their values
-    e.g. 'area': 163
+# connection pools and prepared statement names, keyed by process id and database name / by connection
+# each process (including multiprocessing workers) creates its own pool the first time it needs one
+# the prepared statements are held weakly, so a closed connection's names are dropped w/ it and never reused by a new connection
+_connection_pools = {}
+_prepared_statements = WeakKeyDictionary()
+
+# storage format ('array' or 'compact') of each structure table, keyed by database name and structure
+_storage_formats = {}
+
+# (database name, structure) of the tables that have the precomputed surface and bbox columns
+_surface_columns = set()
+
+# names of the databases that have the data_versions, distance_versions and table_changes tables (see create_version_tables)
+_version_tables = set()
+
+# opt-in instrumentation (see enable_instrumentation): the stage times and counters of the current process that have not been written yet,
+# guarded by the process' lock; the nesting depth of the running stages is kept per thread (see stage_depth)
+_instrumentation = {'pid': None, 'lock': None, 'stages': {}, 'counters': {}}
+_instrumentation_threads = local()
+
+
+def database_connection_settings(database_name):
+    """ Returns a dict of psycopg2.connect keyword arguments for database_name
+
+    The host, port and credentials are read from the POSTGRES_HOST (default 'db'), POSTGRES_PORT (default '5432'),
+    POSTGRES_USER and POSTGRES_PASSWORD environment variables
     """
 
-    print('Extracting object properties for {image_name}'.format(image_name=image_name))
+    import os
 
-    # import packages needed for object extraction
-    from skimage.io import imread
-    from scipy.ndimage import label as ndi_label
-    from skimage import measure
+    connection_settings = {
+        'host': os.environ.get('POSTGRES_HOST', 'db'),
+        'port': os.environ.get('POSTGRES_PORT', '5432'),
+        'user': os.environ['POSTGRES_USER'],
+        'password': os.environ['POSTGRES_PASSWORD'],
+        'dbname': database_name}
 
-    # read in images
-    segmented_image = imread(segmented_image_path)
-    intensity_image = imread(intensity_image_path)
+    return connection_settings
 
-    # label connected components
-    labeled, num_features = ndi_label(segmented_image)
+def get_connection_pool(database_name):
+    """ Returns the psycopg2 connection pool for database_name that belongs to the current process
 
-    # measure properties
-    region_properties = measure.regionprops(labeled, intensity_image = intensity_image)
+    The pool is created the first time a process asks for it, so multiprocessing workers never share
+    connections with their parent process. The maximum number of connections per process is read from
+    the POSTGRES_POOL_MAXCONN environment variable (default 8)
+    The pool keeps up to POSTGRES_POOL_MINCONN idle connections open (default 2, so a nested query or a worker's
+    heartbeat thread reuses its connection); connections beyond that are closed when they are returned
+    """
 
-    object_data_list = []
+    import os
+    from psycopg2.pool import ThreadedConnectionPool
 
-    for prop in region_properties:
+    pool_key = (os.getpid(), database_name)
 
-        # apply the z scale and xy scales to the centroid and coordinates lists
-        centroid = list(prop.centroid)
-        centroid_scaled = [centroid[0] * z_scale, centroid[1]*xy_scale, centroid[2] * xy_scale]
+    # pools inherited from a parent process are left alone; closing them would close the parent's connections
+    if pool_key not in _connection_pools:
+        with instrument_stage('db_connect'):
+            maxconn = int(os.environ.get('POSTGRES_POOL_MAXCONN', 8))
+            minconn = min(maxconn, int(os.environ.get('POSTGRES_POOL_MINCONN', 2)))
 
-        coords = prop.coords.tolist()
-        coords_scaled = [[coord[0]*z_scale, coord[1]* xy_scale, coord[2]*xy_scale] for coord in coords ]
+            _connection_pools[pool_key] = ThreadedConnectionPool(minconn, maxconn, **database_connection_settings(database_name))
 
-        # create a dict containing object properties
-        object_properties_dict = {
-        'area': int(prop.area),
-        'min_intensity' : int(prop.min_intensity),
-        'max_intensity' : int(prop.max_intensity),
-        'mean_intensity' : int(prop.mean_intensity),
-        'total_intensity': int(prop.intensity_image.sum()),
-        'object_id' : int(prop.label),
-        'name': image_name,
-        'centroid': centroid_scaled,
-        'coordinates': coords_scaled,
-        'intensity_image': prop.intensity_image.tolist()}
+    return _connection_pools[pool_key]
 
-        object_data_list.append(object_properties_dict)
+@contextmanager
+def database_connection(database_name):
+    """ Context manager that borrows a connection from this process's pool for database_name
 
-    return object_data_list
+    The transaction is committed when the with block finishes and rolled back if the block raises an error
+    The connection is then returned to the pool (or discarded if it was closed by an error)
+    While instrumentation is enabled, its cursors count round trips, rows and bytes (see instrumented_cursor_factory)
 
+    Usage:
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        ...
+    """
 
-def insert_object_data(structure, object_data_list, database_name):
-    """ Inputs: structure (string that describes the subcellular structure)
-                object_data_list - a list that is the output of the extract_object_properties function,
-                a psycopg2 connection object for connecting to the experiment's database
+    import psycopg2
 
-        Inserts data from the object_data_list into the structure table.
-        Use caution: this funtion appends data if the structure table already contains object data for that image
+    pool = get_connection_pool(database_name)
 
-        Returns nothing
+    # the pool opens a new connection if none is free
+    with instrument_stage('db_connect'):
+        conn = pool.getconn()
+
+    if instrumentation_enabled():
+        conn.cursor_factory = instrumented_cursor_factory()
+    elif 'cursor_factory' in _instrumentation:
+        conn.cursor_factory = psycopg2.extensions.cursor
+
+    try:
+        yield conn
+
+        with instrument_stage('db_commit'):
+            conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def close_connection_pools():
+    """ Closes all of the pooled connections that belong to the current process
+
+    Returns None
     """
 
     import os
-    import psycopg2
+
+    for pool_key in [pool_key for pool_key in _connection_pools if pool_key[0] == os.getpid()]:
+        _connection_pools.pop(pool_key).closeall()
+
+    _prepared_statements.clear()
+
+    return None
+
+def execute_prepared(cur, query, params=()):
+    """ Executes query on the cursor as a server-side prepared statement
+
+    The query is a string or psycopg2.sql object that uses $1, $2, ... as placeholders, and params holds the values
+    for those placeholders. The statement is prepared once per connection, so postgres only parses and plans
+    a query that is run for every object once
+
+    Returns None
+    """
+
+    import hashlib
     from psycopg2 import sql
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    if isinstance(query, str):
+        query = sql.SQL(query)
 
-    query = sql.SQL("""INSERT into {table}
-                    (area, min_intensity, max_intensity, mean_intensity, total_intensity, object_id, name, centroid, coordinates, raw_img)
-                    VALUES
-                    (%(area)s, %(min_intensity)s, %(max_intensity)s, %(mean_intensity)s, %(total_intensity)s, %(object_id)s, %(name)s, %(centroid)s, %(coordinates)s, %(intensity_image)s);""").format(
-                        table=sql.Identifier(structure))
+    query_string = query.as_string(cur)
+    statement_name = 'pipeline_' + hashlib.md5(query_string.encode('utf-8')).hexdigest()[0:16]
 
+    prepared_statements = _prepared_statements.setdefault(cur.connection, set())
 
-    cur.executemany(query, object_data_list)
-    conn.commit()
+    if statement_name not in prepared_statements:
+        cur.execute(sql.SQL("PREPARE {statement_name} AS ").format(statement_name=sql.Identifier(statement_name)) + sql.SQL(query_string))
+        prepared_statements.add(statement_name)
 
-    cur.close()
-    conn.close()
+    if params:
+        cur.execute(sql.SQL("EXECUTE {statement_name} ({params})").format(
+                            statement_name=sql.Identifier(statement_name),
+                            params=sql.SQL(', ').join(sql.Placeholder() * len(params))), params)
+    else:
+        cur.execute(sql.SQL("EXECUTE {statement_name}").format(statement_name=sql.Identifier(statement_name)))
 
-    return
+    return None
 
-def extract_surface_coordinates(coordinates_list):
-    """ Input: a list of coordinates that define one object
+def instrumentation_enabled():
+    """ Returns True if the opt-in instrumentation is enabled, i.e. if the PIPELINE_METRICS_DIR environment variable is set
+    (see enable_instrumentation)
+    """
 
-    Logic is to include all coordinates in the minimum and maximum z slices
-    Then hold z, x constant and include the coordinates w/ the min and max y values for each z,x pair
-    Then hold z, y constant and include the coordinates w/ the min and max x values for each z,y pair
+    import os
 
-    Return list of exterior coordinates, excluding any invaginations
+    return bool(os.environ.get('PIPELINE_METRICS_DIR'))
+
+def enable_instrumentation(metrics_dir):
+    """ Turns on the opt-in instrumentation, which records the wall and cpu time of the pipeline stages (per image where the stage
+    works on one image) and counts database round trips, rows and bytes, voxel pairs compared by minimum_distance
+    and the utilisation of the measure_distances process pool
+
+    The metrics_dir is saved in the PIPELINE_METRICS_DIR environment variable, so multiprocessing workers record their stages as well
+    (setting PIPELINE_METRICS_DIR before starting the notebook has the same effect)
+    Every process appends its records to metrics_dir/metrics-<host>-<pid>.jsonl; use aggregate_instrumentation to combine them
+
+    Returns None
     """
-    z_coords = set([coord[0] for coord in coordinates_list])
 
-    surface_coords = []
+    import os
+
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.environ['PIPELINE_METRICS_DIR'] = os.path.abspath(metrics_dir)
 
-    # add all of the coordinates that are in the minimum and maximum z slices
-    z_min = min(z_coords)
-    z_max = max(z_coords)
+    return None
 
-    minimum_z_coords = [coord for coord in coordinates_list if coord[0] == z_min]
-    maximum_z_coords = [coord for coord in coordinates_list if coord[0] == z_max]
+def disable_instrumentation():
+    """ Writes the records that have not been written yet and turns the instrumentation off
 
-    surface_coords.extend(minimum_z_coords)
-    surface_coords.extend(maximum_z_coords)
+    Returns None
+    """
 
-    # now iterate over z coordinates
-    # hold x constant and add [z, x, y_min] and [z, x, y_max] if not already in surface list
-    # then hold y constant and add [z, x_min, y] and [z, x_max, y] if not already in surface list
+    import os
 
-    for z in z_coords:
+    flush_instrumentation()
+    os.environ.pop('PIPELINE_METRICS_DIR', None)
 
-        select_xy_coords = [(coord[1:]) for coord in coordinates_list if coord[0] == z]
+    return None
 
-        x_coords = set([coord[0] for coord in select_xy_coords])
-        y_coords = set([coord[1] for coord in select_xy_coords])
+def process_instrumentation():
+    """ Returns the instrumentation state of the current process
 
-        for x in x_coords:
-            select_y_values = [xy_coord[1] for xy_coord in select_xy_coords if xy_coord[0] == x]
+    The state that a multiprocessing worker inherits from its parent is reset, so every record is written by only one process
+    Hold the state's lock to change its stages and counters, since other threads (e.g. the heartbeat thread of run_distance_worker) record stages as well
+    """
 
-            min_y = min(select_y_values)
+    import os
+    import atexit
+    import threading
 
-            surface_coords.append([z, x, min_y])
+    if _instrumentation['pid'] != os.getpid():
+        # the main process writes its remaining records on exit; pool workers write theirs after every task
+        if _instrumentation['pid'] is None:
+            atexit.register(flush_instrumentation)
 
-            max_y = max(select_y_values)
-            surface_coords.append([z, x, max_y])
+        _instrumentation.update(pid=os.getpid(), lock=threading.Lock(), stages={}, counters={})
 
-        for y in y_coords:
-            select_x_values = [xy_coord[0] for xy_coord in select_xy_coords if xy_coord[1] == y]
+    return _instrumentation
 
-            min_x = min(select_x_values)
-            surface_coords.append([z, min_x, y])
+def stage_depth(change=0):
+    """ Adds change to the number of instrumented stages that are running in the current thread
 
-            max_x = max(select_x_values)
-            surface_coords.append([z, max_x, y])
+    Each thread counts its own stages, so a stage that runs in another thread doesn't change the nesting of this thread's stages
+    The count that a multiprocessing worker inherits from its parent is reset
 
-    # remove duplicates
-    duplicates_removed = list((set(map(tuple, surface_coords))))
+    Returns the new number of running stages
+    """
 
-    return duplicates_removed
+    import os
 
-def centroid_measurements_closest_structure_2(centroid_1, structure_2_centroid_data, number_centroid_measure):
-    """ structure_2 centroid data is a list of tuples in format [(id, centroid)] w/ all the centroids for the subcellular target of interest for that image
+    if getattr(_instrumentation_threads, 'pid', None) != os.getpid():
+        _instrumentation_threads.pid = os.getpid()
+        _instrumentation_threads.depth = 0
+
+    _instrumentation_threads.depth += change
+
+    return _instrumentation_threads.depth
+
+def count_metric(name, value=1):
+    """ Adds value to the counter name if instrumentation is enabled
+
+    Returns None
     """
 
-    # package import
-    import numpy as np
+    if not instrumentation_enabled():
+        return None
 
-    # convert centroid to numpy array
-    centroid_1 = np.array(centroid_1)
+    instrumentation = process_instrumentation()
 
-    # measure distances between all centroids
-    distance_data = []
-    for id_centroid_row in structure_2_centroid_data:
-        table_id = id_centroid_row[0]
-        centroid_2 = np.array(id_centroid_row[1])
+    with instrumentation['lock']:
+        instrumentation['counters'][name] = instrumentation['counters'].get(name, 0) + value
 
-        distance = np.linalg.norm(centroid_1 - centroid_2)
+    return None
 
-        distance_data.append({'structure_2_id': table_id, 'distance': distance})
+def record_stage(stage, image_name, wall_seconds, cpu_seconds):
+    """ Adds one call of stage (for image_name, or None) w/ the given wall and cpu time to the records of this process
 
-    sorted_distances = sorted(distance_data, key=lambda k: k['distance'])[0:number_centroid_measure]
+    The records are written to the metrics file once no other stage is running in this thread
 
-    closest_structure_2_ids = tuple([structure_dict['structure_2_id'] for structure_dict in sorted_distances])
+    Returns None
+    """
 
-    return closest_structure_2_ids
+    instrumentation = process_instrumentation()
 
-def minimum_distance(object_1, object_2):
-    """ Takes two lists as input
-    A list of numpy arrays of coordinates that make up object 1 and object 2
-    Measures the distances between each of the coordinates
-    Returns the minimum distance between the two objects, as calculated using a vector norm
-    Stops the calculation and returns 0 if two coordinates overlap
+    with instrumentation['lock']:
+        stage_totals = instrumentation['stages'].setdefault((stage, image_name), [0, 0.0, 0.0])
+        stage_totals[0] += 1
+        stage_totals[1] += wall_seconds
+        stage_totals[2] += cpu_seconds
+
+    if stage_depth() == 0:
+        flush_instrumentation()
+
+    return None
+
+@contextmanager
+def instrument_stage(stage, image_name=None):
+    """ Context manager that records the wall and cpu time of the with block as one call of stage (see record_stage)
+    Stages can be nested, e.g. minimum_distance runs inside measure_image_objects; each stage's time includes its nested stages
+
+    Does nothing unless instrumentation is enabled
+
+    Usage:
+    with instrument_stage('read_images', image_name):
+        ...
     """
 
-    # package import
-    import numpy as np
+    if not instrumentation_enabled():
+        yield
+        return
 
-    # main algorithm
-    minimum_distance = 100000
+    import time
 
-    for coord_1 in object_1:
-        for coord_2 in object_2:
-            distance_btwn_coords = np.linalg.norm(coord_1 - coord_2)
-            if distance_btwn_coords == 0:
-                minimum_distance = distance_btwn_coords
-                return float(minimum_distance)
-            elif distance_btwn_coords < minimum_distance:
-                minimum_distance = distance_btwn_coords
+    stage_depth(1)
 
-    return float(minimum_distance)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
 
+    try:
+        yield
+    finally:
+        stage_depth(-1)
+        record_stage(stage, image_name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
 
-def create_postgres_table(structure, database_name):
-    """ Function to create foundational table for holding data related to images
-    All images of subcellular structures have this foundational data collected and stored
-    The structure_1 table has specialized additional columns for distance measurements that are added separately
+def instrument_function(image_argument=None):
+    """ Decorator that records every call of the decorated function as a stage named after the function (see instrument_stage)
+    If image_argument is given, the value of that argument is recorded as the image name
 
-    Input: connection object for psycopg2.connect, string describing the subcellular structure this table is for
-    (e.g. 'rna' or 'centrosomes')
+    Usage:
+    @instrument_function('image_name')
+    def measure_distances_by_image(image_name, ...):
+    """
 
-    Output: creates a table in the database that the connection object connects to.
-    Closes the cursor and returns nothing
+    import functools
+    import inspect
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def instrumented_function(*args, **kwargs):
+            if not instrumentation_enabled():
+                return function(*args, **kwargs)
+
+            image_name = None
+            if image_argument is not None:
+                image_name = signature.bind_partial(*args, **kwargs).arguments.get(image_argument)
+
+            with instrument_stage(function.__name__, image_name):
+                return function(*args, **kwargs)
+
+        return instrumented_function
+
+    return decorator
+
+def instrument_iterator(stage, iterable, image_name=None):
+    """ Records the time spent producing the items of iterable (e.g. a generator that measures objects lazily) as one call of stage,
+    w/o the time the caller spends on the items
 
+    Returns iterable unchanged if instrumentation is disabled, otherwise a generator that yields the same items
     """
 
-    import psycopg2
-    from psycopg2 import sql
-    import os
+    if not instrumentation_enabled():
+        return iterable
 
-    #create a connection object using the connect_postgres() function and initialize a cursor
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cursor = conn.cursor()
+    def timed_items():
+        import time
 
-    cursor.execute(sql.SQL("""
+        wall_seconds, cpu_seconds = 0.0, 0.0
+        iterator = iter(iterable)
 
-        CREATE TABLE IF NOT EXISTS {table}
-            (id SERIAL NOT NULL,
-            object_id INT NOT NULL,
-            name TEXT NOT NULL,
-            area REAL,
-            min_intensity REAL,
-            max_intensity REAL,
-            mean_intensity REAL,
-            total_intensity REAL,
-            centroid REAL [][][],
-            coordinates REAL [][][],
-            raw_img INT [][][]);""").format(
-                                table=sql.Identifier(structure)))
+        try:
+            while True:
+                stage_depth(1)
+                wall_start = time.perf_counter()
+                cpu_start = time.process_time()
 
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    wall_seconds += time.perf_counter() - wall_start
+                    cpu_seconds += time.process_time() - cpu_start
+                    stage_depth(-1)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+                yield item
+        finally:
+            record_stage(stage, image_name, wall_seconds, cpu_seconds)
 
-    return None
+    return timed_items()
 
-def add_distance_columns(structure_1, structure_2, database_name):
-    # package import
-    import psycopg2
-    from psycopg2 import sql
-    import os
+def metric_value_size(value):
+    """ Returns an estimate of the number of bytes that postgres sent for value (a field of a fetched row)
+    """
 
-    # create variables that contain the names for the new columns
-    distance_to_structure_2 = 'distance_to_' + structure_2
-    structure_2_id = structure_2 + '_id'
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(metric_value_size(item) for item in value)
 
-    # update the database
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    return 8
 
-    query = sql.SQL("ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col_1} REAL, ADD COLUMN IF NOT EXISTS {col_2} INT;").format(
-                            table=sql.Identifier(structure_1),
-                            col_1=sql.Identifier(distance_to_structure_2),
-                            col_2=sql.Identifier(structure_2_id))
+def instrumented_cursor_factory():
+    """ Returns a psycopg2 cursor class that counts database round trips (db_round_trips), the rows written and received
+    (db_rows_written, db_rows_received) and the bytes of query text, COPY data and fetched fields (db_bytes_sent, db_bytes_received)
 
-    cur.execute(query)
-    conn.commit()
-    cur.close()
-    conn.close()
+    database_connection uses it for its connections while instrumentation is enabled
+    The received bytes are an estimate from the size of the fetched values, since psycopg2 doesn't report the size of a result
+    """
 
-    # create indexes on tables to speed up distance measurements later
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    if 'cursor_factory' in _instrumentation:
+        return _instrumentation['cursor_factory']
 
-    structures = [structure_1, structure_2]
+    from psycopg2.extensions import cursor
 
-    index_columns = ['name', 'id']
+    class InstrumentedCursor(cursor):
+        def count_query(self, round_trips, extra_bytes=0):
+            count_metric('db_round_trips', round_trips)
+            count_metric('db_bytes_sent', len(self.query or b'') * round_trips + extra_bytes)
 
-    for structure in structures:
-        for index_column in index_columns:
-            index_name = 'idx_' + structure + '_' + index_column
+            if self.description is None and self.rowcount > 0:
+                count_metric('db_rows_written', self.rowcount)
 
-            create_index_query = sql.SQL("""CREATE INDEX IF NOT EXISTS {index_name} ON {structure}({index_column})""").format(
-            index_name=sql.Identifier(index_name),
-            structure=sql.Identifier(structure),
-            index_column=sql.Identifier(index_column))
+        def count_rows(self, rows):
+            count_metric('db_rows_received', len(rows))
+            count_metric('db_bytes_received', sum(metric_value_size(row) for row in rows))
 
-            cur.execute(create_index_query)
-            conn.commit()
+            return rows
 
-    cur.close()
-    conn.close()
+        def execute(self, query, vars=None):
+            try:
+                return super().execute(query, vars)
+            finally:
+                self.count_query(1)
 
-    return None
+        def executemany(self, query, vars_list):
+            # executemany runs the query once per parameter tuple; the tuples are counted as they are consumed
+            row_count = [0]
 
+            def counted_vars(vars_list):
+                for vars in vars_list:
+                    row_count[0] += 1
+                    yield vars
 
-def test_data_db(image_name, structure, database_name):
-    """Inputs: string describing the name of an image and a string describing a subcellular structure in that image
-    and a connection object
+            try:
+                return super().executemany(query, counted_vars(vars_list))
+            finally:
+                self.count_query(row_count[0])
 
-    Tests if any object data for a given structure and image has been inserted into the database
+        def copy_expert(self, sql, file, size=8192):
+            try:
+                file_start = file.tell()
+            except (AttributeError, OSError):
+                file_start = None
 
-    Returns 'True' if there is 1 or more objects for that structure are in the db
-    Returns 'False' if there are no objects for that structure are in the db
+            try:
+                return super().copy_expert(sql, file, size)
+            finally:
+                copy_bytes = file.tell() - file_start if file_start is not None else 0
+                count_metric('db_round_trips', 1)
+                count_metric('db_bytes_sent' if 'FROM STDIN' in str(sql).upper() else 'db_bytes_received', copy_bytes)
 
+                if self.rowcount > 0:
+                    count_metric('db_rows_written', self.rowcount)
+
+        def fetchone(self):
+            row = super().fetchone()
+
+            if row is not None:
+                self.count_rows([row])
+
+            return row
+
+        def fetchmany(self, size=None):
+            return self.count_rows(super().fetchmany(self.arraysize if size is None else size))
+
+        def fetchall(self):
+            return self.count_rows(super().fetchall())
+
+        def __iter__(self):
+            row = self.fetchone()
+
+            while row is not None:
+                yield row
+                row = self.fetchone()
+
+    _instrumentation['cursor_factory'] = InstrumentedCursor
+
+    return InstrumentedCursor
+
+def flush_instrumentation():
+    """ Appends the stage and counter records of the current process to its metrics file, as one JSON object per line:
+    {"type": "stage", "stage": ..., "image": ..., "calls": ..., "wall_seconds": ..., "cpu_seconds": ..., "host": ..., "pid": ..., "time": ...}
+    {"type": "counter", "name": ..., "value": ..., "host": ..., "pid": ..., "time": ...}
+    The values are totals since the previous flush, so the records of all lines and processes can be added up
+
+    Returns None
     """
 
-    import psycopg2
-    from psycopg2 import sql
     import os
+    import json
+    import time
+    import socket
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
-    query = sql.SQL("SELECT * FROM {table} where name = %s").format(
-                            table=sql.Identifier(structure))
+    metrics_dir = os.environ.get('PIPELINE_METRICS_DIR')
+    instrumentation = process_instrumentation()
 
-    cur.execute(query, (image_name,))
+    if not metrics_dir:
+        return None
 
-    processed_bool = bool(cur.fetchone())
+    # take the records that have not been written yet, so other threads start new totals
+    with instrumentation['lock']:
+        stages, counters = instrumentation['stages'], instrumentation['counters']
+        instrumentation['stages'] = {}
+        instrumentation['counters'] = {}
 
-    cur.close()
-    conn.close()
+    if not (stages or counters):
+        return None
 
-    return processed_bool
+    record_info = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+
+    records = [dict(record_info, type='stage', stage=stage, image=image_name, calls=calls, wall_seconds=wall_seconds, cpu_seconds=cpu_seconds)
+               for (stage, image_name), (calls, wall_seconds, cpu_seconds) in stages.items()]
+    records += [dict(record_info, type='counter', name=name, value=value) for name, value in counters.items()]
+
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics_path = os.path.join(metrics_dir, 'metrics-{host}-{pid}.jsonl'.format(host=record_info['host'], pid=record_info['pid']))
+
+    # one thread appends at a time, so the lines of two flushes are never interleaved
+    with instrumentation['lock'], open(metrics_path, 'a') as metrics_file:
+        metrics_file.write(''.join(json.dumps(record) + '\n' for record in records))
+
+    return None
+
+def aggregate_instrumentation(metrics_dir=None, output_path=None, by_image_bool=False):
+    """ Adds up the records in the metrics files of all processes in metrics_dir (default: PIPELINE_METRICS_DIR)
+
+    The totals are written in the Prometheus text format to output_path (default: metrics_dir/metrics.prom),
+    per stage, or per stage and image if by_image_bool = True
+    measurement_pool_utilization is the fraction of the measure_distances pool's process time that was spent running tasks
+
+    Returns a dictionary w/ 'stages' ({(stage, image_name): {'calls', 'wall_seconds', 'cpu_seconds'}}, w/ image_name None unless by_image_bool),
+    'counters' ({name: value}) and 'processes' (the number of processes that wrote records)
+    """
 
-def select_null_ids(structure_1, distance_col, database_name):
-    import psycopg2
-    from psycopg2 import sql
     import os
+    import glob
+    import json
 
-    structure_1_data_query = sql.SQL("""SELECT id
-                            FROM {structure_1}
-                            WHERE {distance_col} IS NULL;""").format(
-                    structure_1=sql.Identifier(structure_1),
-                    distance_col=sql.Identifier(distance_col))
+    flush_instrumentation()
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    if metrics_dir is None:
+        metrics_dir = os.environ['PIPELINE_METRICS_DIR']
 
-    cur.execute(structure_1_data_query)
-    structure_1_data_all = cur.fetchall()
+    if output_path is None:
+        output_path = os.path.join(metrics_dir, 'metrics.prom')
 
-    structure_1_id_ls = [id_tuple[0] for id_tuple in structure_1_data_all]
+    stages = {}
+    counters = {}
+    processes = set()
 
-    cur.close()
-    conn.close()
+    for metrics_path in sorted(glob.glob(os.path.join(metrics_dir, 'metrics-*.jsonl'))):
+        with open(metrics_path) as metrics_file:
+            for line in metrics_file:
+                record = json.loads(line)
+                processes.add((record['host'], record['pid']))
 
-    return structure_1_id_ls
+                if record['type'] == 'stage':
+                    stage_totals = stages.setdefault((record['stage'], record['image'] if by_image_bool else None),
+                                                     {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
 
+                    for key in stage_totals:
+                        stage_totals[key] += record[key]
+                else:
+                    counters[record['name']] = counters.get(record['name'], 0) + record['value']
 
-def measure_distances(structure_measurement_tuple, parallel_processing_bool, database_name, number_centroid_measure):
+    def metric_labels(stage, image_name):
+        labels = [('stage', stage)] + ([('image', image_name)] if image_name is not None else [])
 
-    """ This function measures the distances between two structures, defined within a tuple with form
-    (structure_1, structure_2)
+        return ','.join('{key}="{value}"'.format(key=key, value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for key, value in labels)
 
-    If parallel_processing_bool is True, then the distances will be measured using parallel processing
-    Otherwise, one object is measured at a time
+    lines = []
 
-    The number_centroid_measure will determine how many structure 2 objects are measured using surface to surface coordinates
+    for key, help_text in (('calls', 'Number of times each pipeline stage ran'),
+                           ('wall_seconds', 'Wall time spent in each pipeline stage, including nested stages'),
+                           ('cpu_seconds', 'Cpu time spent in each pipeline stage, including nested stages')):
+        metric_name = 'pipeline_stage_{key}_total'.format(key=key)
+        lines += ['# HELP {metric_name} {help_text}'.format(metric_name=metric_name, help_text=help_text),
+                  '# TYPE {metric_name} counter'.format(metric_name=metric_name)]
+        lines += ['{metric_name}{{{labels}}} {value}'.format(metric_name=metric_name, labels=metric_labels(stage, image_name), value=stage_totals[key])
+                  for (stage, image_name), stage_totals in sorted(stages.items(), key=lambda item: (item[0][0], str(item[0][1])))]
 
-    The database will be updated for each object
+    for name, value in sorted(counters.items()):
+        lines += ['# TYPE pipeline_{name}_total counter'.format(name=name),
+                  'pipeline_{name}_total {value}'.format(name=name, value=value)]
 
-    Returns None
+    if counters.get('measurement_pool_capacity_seconds'):
+        lines += ['# HELP pipeline_measurement_pool_utilization Fraction of the measure_distances pool process time spent running tasks',
+                  '# TYPE pipeline_measurement_pool_utilization gauge',
+                  'pipeline_measurement_pool_utilization {value}'.format(value=counters.get('measurement_pool_busy_seconds', 0) / counters['measurement_pool_capacity_seconds'])]
+
+    lines += ['# TYPE pipeline_processes gauge', 'pipeline_processes {value}'.format(value=len(processes))]
+
+    with open(output_path, 'w') as output_file:
+        output_file.write('\n'.join(lines) + '\n')
+
+    return {'stages': stages, 'counters': counters, 'processes': len(processes)}
+
+
+def extract_object_properties(segmented_image_path, intensity_image_path, image_name, xy_scale, z_scale, measurement_engine='ndimage', slab_depth=None,
+                              arrays_bool=False):
     """
+    Takes a segmented image and the corresponding intensity image for that segmentation
 
-    # unpack the structure_measurement_tuple
-    structure_1 = structure_measurement_tuple[0]
-    structure_2 = structure_measurement_tuple[1]
+    Measures minimum, mean, max, and total intensity in addition to total # of pixels per object
 
-    # add distance columns to the database and create database indexes
-    add_distance_columns(structure_1, structure_2, database_name)
+    measurement_engine - 'ndimage' (default) measures all objects at once w/ measure_labeled_objects
+                         'regionprops' measures the objects one at a time w/ skimage.measure.regionprops
+    slab_depth - if set, the images are labeled and measured this many z slices at a time (see label_image_slabs),
+                 so only the objects and one slab of the images need to fit in memory
 
-    # get all structure 1 ids that haven't been measured
-    distance_col = 'distance_to_' + structure_2
+    Returns a list of dictionaries, where each dictionary has a key-value pair mapping
+    object property terms to their values
+    e.g. 'area': 163
+    The centroid, coordinates and intensity_image values are nested lists, whichever engine measured them
+    If arrays_bool = True, the coordinates and intensity_image of the 'ndimage' engine are kept as numpy arrays,
+    which are faster to send between processes and to insert (insert_object_data accepts both)
 
-    structure_1_id_ls = select_null_ids(structure_1, distance_col, database_name)
+    See iter_object_properties to measure objects without holding all of them in memory
+    """
 
-    # code to process using parallel processing
-    if parallel_processing_bool:
-        print('Measuring distances with parallel processing')
-        import multiprocessing as mp
+    object_data_list = list(iter_object_properties(segmented_image_path, intensity_image_path, image_name, xy_scale, z_scale,
+                                                   measurement_engine=measurement_engine, slab_depth=slab_depth))
 
-        cpu_count = mp.cpu_count() - 1
+    if arrays_bool:
+        return object_data_list
 
-        argument_tuples = []
-        for structure_1_id in structure_1_id_ls:
-            argument_tuple = (structure_1_id, structure_1, structure_2, number_centroid_measure, database_name)
+    for object_data in object_data_list:
+        object_data['centroid'] = [float(value) for value in object_data['centroid']]
 
-            argument_tuples.append(argument_tuple)
+        for key in ('coordinates', 'intensity_image'):
+            if not isinstance(object_data[key], list):
+                object_data[key] = object_data[key].tolist()
 
-        pool = mp.Pool(cpu_count)
-        result = pool.starmap(measure_distance_by_obj, argument_tuples)
+    return object_data_list
 
-    # otherwise iterate over list and process one id at a time
-    else:
-        print('Measuring distances without parallel processing')
 
-        for structure_1_id in structure_1_id_ls:
-            measure_distance_by_obj(structure_1_id, structure_1, structure_2, number_centroid_measure, database_name)
+def iter_object_properties(segmented_image_path, intensity_image_path, image_name, xy_scale, z_scale, batch_size=None, measurement_engine='ndimage', slab_depth=None):
+    """ Generator version of extract_object_properties
 
-    return None
+    Yields the object dictionaries one at a time as they are measured, or lists of up to batch_size dictionaries
+    Coordinates and intensity crops are only created for the objects that are being yielded, so memory use depends on
+    the batch size rather than the number of objects in the image
+    Uncompressed tifs are memory-mapped (see read_image_stack); w/ slab_depth the labeling is done in z-slabs as well
+    W/ the 'ndimage' engine the coordinates and intensity_image values are numpy arrays instead of nested lists
 
+    The output can be passed directly to insert_object_data, e.g.
+    insert_object_data(structure, iter_object_properties(seg_img_path, ins_img_path, image_name, xy_scale, z_scale, batch_size=1000), database_name)
+    """
 
-def measure_distance_by_obj(obj_id, structure_1, structure_2, number_centroid_measure, database_name):
+    if measurement_engine not in ('ndimage', 'regionprops'):
+        raise ValueError("measurement_engine must be 'ndimage' or 'regionprops', not {measurement_engine!r}".format(measurement_engine=measurement_engine))
 
-    """ This function takes an object id from the structure_1 table. It will measure the distance from that object
-    to the closest structure_2 object.
+    print('Extracting object properties for {image_name}'.format(image_name=image_name))
 
-    The number_centroid_measure is the number of structure_2 objects to use to perform surface to surface distance measurements for this structure 1 object
+    # import packages needed for object extraction
+    from scipy.ndimage import label as ndi_label
 
-    It then updates the database with the closest structure_2 id
+    # read in images; uncompressed tifs are memory-mapped rather than read into memory
+    with instrument_stage('read_images', image_name):
+        segmented_image = read_image_stack(segmented_image_path)
+        intensity_image = read_image_stack(intensity_image_path)
 
-    Returns None
+    # label connected components
+    with instrument_stage('label_objects', image_name):
+        if slab_depth:
+            labeled, num_features = label_image_slabs(segmented_image, slab_depth)
+        else:
+            labeled, num_features = ndi_label(segmented_image)
+
+    if measurement_engine == 'ndimage':
+        object_records = iter_labeled_objects(labeled, intensity_image, image_name, xy_scale, z_scale, slab_depth=slab_depth)
+    else:
+        object_records = iter_regionprops_objects(labeled, intensity_image, image_name, xy_scale, z_scale)
+
+    # the objects are measured as they are requested
+    object_records = instrument_iterator('measure_objects', object_records, image_name)
+
+    if not batch_size:
+        yield from object_records
+        return
+
+    object_data_batch = []
+
+    for object_data in object_records:
+        object_data_batch.append(object_data)
+
+        if len(object_data_batch) == batch_size:
+            yield object_data_batch
+            object_data_batch = []
+
+    if object_data_batch:
+        yield object_data_batch
+
+
+def read_image_stack(image_path):
+    """ Takes the path to a (3D) tif image
+
+    Uncompressed tifs are memory-mapped w/ tifffile, so only the parts of the image that are used are read from disk
+    Other images (e.g. compressed tifs) are read into memory w/ skimage.io.imread
+
+    Returns the image as a read-only numpy memmap or a numpy array
+    """
+
+    # package import
+    from skimage.io import imread
+
+    try:
+        import tifffile
+        return tifffile.memmap(image_path, mode='r')
+    except (ImportError, ValueError):
+        # tifffile raises a ValueError for images that can't be memory-mapped
+        return imread(image_path)
+
+
+def label_image_slabs(segmented_image, slab_depth):
+    """ Takes a 3D segmented image (e.g. a memmap from read_image_stack) and the number of z slices to label at a time
+
+    Each slab is labeled w/ scipy.ndimage.label; objects that touch across the boundary between two slabs
+    (the last slice of one slab and the first slice of the next) are then merged
+    The merged objects are numbered in the same order as scipy.ndimage.label numbers them for the whole image,
+    so the labels are identical to labeling the whole image at once
+
+    The labels are written to a temporary memory-mapped file, so the labeled image does not need to fit in memory
+
+    Returns a tuple of (labeled image, number of objects)
+    """
+
+    # package import
+    import tempfile
+    import numpy as np
+    from scipy.ndimage import label as ndi_label
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    z_size = segmented_image.shape[0]
+    labeled = np.memmap(tempfile.TemporaryFile(), dtype=np.int32, mode='w+', shape=segmented_image.shape)
+
+    label_offset = 0
+    boundary_label_pairs = []
+
+    for slab_start in range(0, z_size, slab_depth):
+        slab_end = min(slab_start + slab_depth, z_size)
+
+        slab_labels, slab_features = ndi_label(np.asarray(segmented_image[slab_start:slab_end]))
+        slab_labels[slab_labels > 0] += label_offset
+
+        if slab_start > 0:
+            # pairs of labels that are connected across the slab boundary
+            previous_slice = np.asarray(labeled[slab_start - 1])
+            touching = (previous_slice > 0) & (slab_labels[0] > 0)
+            boundary_label_pairs.append(np.column_stack([previous_slice[touching], slab_labels[0][touching]]))
+
+        labeled[slab_start:slab_end] = slab_labels
+        label_offset += slab_features
+
+    if not any(len(label_pairs) for label_pairs in boundary_label_pairs):
+        # no objects cross a slab boundary
+        return labeled, label_offset
+
+    # merge the connected labels; the merged object is numbered by its smallest slab label (i.e. its first voxel)
+    label_pairs = np.unique(np.concatenate(boundary_label_pairs), axis=0)
+    label_graph = coo_matrix((np.ones(len(label_pairs)), (label_pairs[:, 0], label_pairs[:, 1])), shape=(label_offset + 1, label_offset + 1))
+    num_components, components = connected_components(label_graph, directed=False)
+
+    component_ids, component_first_labels = np.unique(components, return_index=True)
+    component_numbers = np.empty(num_components, dtype=np.int32)
+    component_numbers[np.argsort(component_first_labels)] = np.arange(num_components, dtype=np.int32)
+    label_map = component_numbers[components]
+
+    for slab_start in range(0, z_size, slab_depth):
+        labeled[slab_start:slab_start + slab_depth] = label_map[labeled[slab_start:slab_start + slab_depth]]
+
+    return labeled, num_components - 1
+
+
+def iter_regionprops_objects(labeled, intensity_image, image_name, xy_scale, z_scale):
+    """ Takes a labeled image and the corresponding intensity image
+
+    Yields one dictionary per object, measured w/ skimage.measure.regionprops
+    """
+
+    # package import
+    from skimage import measure
+
+    # measure properties
+    region_properties = measure.regionprops(labeled, intensity_image = intensity_image)
+
+    for prop in region_properties:
+
+        # apply the z scale and xy scales to the centroid and coordinates lists
+        centroid = list(prop.centroid)
+        centroid_scaled = [centroid[0] * z_scale, centroid[1]*xy_scale, centroid[2] * xy_scale]
+
+        coords = prop.coords.tolist()
+        coords_scaled = [[coord[0]*z_scale, coord[1]* xy_scale, coord[2]*xy_scale] for coord in coords ]
+
+        # create a dict containing object properties
+        object_properties_dict = {
+        'area': int(prop.area),
+        'min_intensity' : int(prop.min_intensity),
+        'max_intensity' : int(prop.max_intensity),
+        'mean_intensity' : int(prop.mean_intensity),
+        'total_intensity': int(prop.intensity_image.sum()),
+        'object_id' : int(prop.label),
+        'name': image_name,
+        'centroid': centroid_scaled,
+        'coordinates': coords_scaled,
+        'coordinate_scale': [z_scale, xy_scale, xy_scale],
+        'intensity_image': prop.intensity_image.tolist()}
+
+        yield object_properties_dict
+
+
+def measure_labeled_objects(labeled, intensity_image, image_name, xy_scale, z_scale):
+    """ Takes a labeled image (e.g. from scipy.ndimage.label) and the corresponding intensity image
+
+    Measures every object in one pass: the foreground voxels are sorted by label once, so each object's
+    voxels are one contiguous slice and the per-object reductions are done w/ numpy reduceat
+    Gives the same values as the regionprops loop in extract_object_properties
+
+    Returns a list of dictionaries like extract_object_properties, w/ the coordinates and intensity_image as numpy arrays
+    """
+
+    return list(iter_labeled_objects(labeled, intensity_image, image_name, xy_scale, z_scale))
+
+
+def iter_labeled_objects(labeled, intensity_image, image_name, xy_scale, z_scale, slab_depth=None):
+    """ Generator version of measure_labeled_objects
+
+    The per-object measurements are computed for all objects up front; the scaled coordinates and the
+    intensity crop of each object are only created when that object is yielded
+    The foreground voxels are collected slab_depth z slices at a time (default: the whole image at once),
+    which keeps memory use low for memory-mapped images
+    """
+
+    # package import
+    import numpy as np
+    from scipy.ndimage import find_objects
+
+    if not slab_depth:
+        slab_depth = labeled.shape[0]
+
+    # collect the flat index, label and intensity of the foreground voxels one slab at a time
+    slab_size = int(np.prod(labeled.shape[1:]))
+    foreground_indexes, foreground_labels, foreground_intensities = [], [], []
+
+    for slab_start in range(0, labeled.shape[0], slab_depth):
+        slab_labels = np.asarray(labeled[slab_start:slab_start + slab_depth]).ravel()
+        slab_foreground = np.flatnonzero(slab_labels)
+
+        foreground_indexes.append(slab_foreground + slab_start * slab_size)
+        foreground_labels.append(slab_labels[slab_foreground])
+        foreground_intensities.append(np.asarray(intensity_image[slab_start:slab_start + slab_depth]).ravel()[slab_foreground])
+
+    foreground_labels = np.concatenate(foreground_labels)
+
+    if foreground_labels.size == 0:
+        return
+
+    # sort the foreground voxels by label; the stable sort keeps each object's voxels in raster order
+    voxel_order = np.argsort(foreground_labels, kind='stable')
+    voxel_indexes = np.concatenate(foreground_indexes)[voxel_order]
+    voxel_intensities = np.concatenate(foreground_intensities)[voxel_order]
+    del foreground_indexes, foreground_intensities
+
+    object_labels, object_starts, object_areas = np.unique(foreground_labels[voxel_order], return_index=True, return_counts=True)
+    del foreground_labels, voxel_order
+
+    # per-object intensity measurements
+    sum_dtype = np.int64 if voxel_intensities.dtype.kind in 'iub' else np.float64
+
+    min_intensities = np.minimum.reduceat(voxel_intensities, object_starts)
+    max_intensities = np.maximum.reduceat(voxel_intensities, object_starts)
+    total_intensities = np.add.reduceat(voxel_intensities, object_starts, dtype=sum_dtype)
+    mean_intensities = total_intensities / object_areas
+    del voxel_intensities
+
+    # voxel coordinates (one array per axis) and centroids, w/ the z scale and xy scales applied
+    voxel_coordinates = np.unravel_index(voxel_indexes, labeled.shape)
+    del voxel_indexes
+
+    scale = np.array([z_scale, xy_scale, xy_scale])
+    centroids = np.column_stack([np.add.reduceat(axis_coordinates, object_starts) for axis_coordinates in voxel_coordinates])
+    scaled_centroids = centroids / object_areas[:, np.newaxis] * scale
+
+    object_slices = find_objects(labeled)
+    object_ends = np.append(object_starts[1:], voxel_coordinates[0].size)
+
+    for idx, object_label in enumerate(object_labels.tolist()):
+
+        object_start, object_end = object_starts[idx], object_ends[idx]
+        scaled_coordinates = np.column_stack([axis_coordinates[object_start:object_end] for axis_coordinates in voxel_coordinates]) * scale
+
+        # crop of the intensity image w/ the pixels outside the object set to 0
+        object_slice = object_slices[object_label - 1]
+        object_intensity_image = intensity_image[object_slice] * (labeled[object_slice] == object_label)
+
+        # create a dict containing object properties
+        object_properties_dict = {
+        'area': int(object_areas[idx]),
+        'min_intensity' : int(min_intensities[idx]),
+        'max_intensity' : int(max_intensities[idx]),
+        'mean_intensity' : int(mean_intensities[idx]),
+        'total_intensity': int(total_intensities[idx]),
+        'object_id' : object_label,
+        'name': image_name,
+        'centroid': scaled_centroids[idx].tolist(),
+        'coordinates': scaled_coordinates,
+        'coordinate_scale': [z_scale, xy_scale, xy_scale],
+        'intensity_image': object_intensity_image}
+
+        yield object_properties_dict
+
+
+def iter_object_data(object_data):
+    """ Takes a list of object dictionaries, or an iterable of dictionaries or of lists of dictionaries (e.g. from iter_object_properties)
+
+    Yields the object dictionaries one at a time
+    """
+
+    for object_item in object_data:
+        if isinstance(object_item, dict):
+            yield object_item
+        else:
+            yield from object_item
+
+
+@instrument_function()
+def insert_object_data(structure, object_data_list, database_name, copy_bool=False, surface_bool=False):
+    """ Inputs: structure (string that describes the subcellular structure)
+                object_data_list - a list that is the output of the extract_object_properties function,
+                                   or the iterator returned by iter_object_properties (w/ or w/o batch_size)
+                database_name - the name of the experiment's database
+                copy_bool - if True, the rows are streamed w/ COPY (see insert_object_data_copy) instead of executemany
+                surface_bool - if True, each object's surface coordinates and bounding box are also stored (see add_surface_columns)
+
+        Inserts data from the object_data_list into the structure table.
+        Iterators are consumed one object at a time, so they are never held in memory as a whole;
+        all of the objects are inserted in one transaction, together w/ a new data version for each image (see create_version_tables)
+        Use caution: this funtion appends data if the structure table already contains object data for that image
+
+        Returns nothing
+    """
+
+    import numpy as np
+    from psycopg2 import sql
+
+    if copy_bool:
+        insert_object_data_copy(structure, [object_data_list], database_name, surface_bool=surface_bool)
+        return
+
+    storage_format = get_storage_format(structure, database_name)
+
+    create_version_tables(database_name)
+
+    image_names = set()
+
+    def track_image_names(object_data_iterator):
+        for object_data in object_data_iterator:
+            image_names.add(object_data['name'])
+            yield object_data
+
+    object_data_list = track_image_names(iter_object_data(object_data_list))
+
+    surface_columns = sql.SQL("")
+    surface_values = sql.SQL("")
+
+    if surface_bool:
+        add_surface_columns(structure, database_name)
+        object_data_list = (surface_object_data(object_data, storage_format) for object_data in object_data_list)
+
+        surface_columns = sql.SQL(", surface, bbox")
+        surface_values = sql.SQL(", %(surface)s, %(bbox)s")
+
+    if storage_format == 'compact':
+        # encode the coordinates and intensity crops for the compact table layout
+        object_data_list = (compact_object_data(object_data) for object_data in object_data_list)
+
+        query = sql.SQL("""INSERT into {table}
+                        (area, min_intensity, max_intensity, mean_intensity, total_intensity, object_id, name, centroid, coordinates, coordinate_scale, raw_img, raw_img_shape, raw_img_dtype{surface_columns})
+                        VALUES
+                        (%(area)s, %(min_intensity)s, %(max_intensity)s, %(mean_intensity)s, %(total_intensity)s, %(object_id)s, %(name)s, %(centroid)s, %(coordinates)s, %(coordinate_scale)s, %(intensity_image)s, %(raw_img_shape)s, %(raw_img_dtype)s{surface_values});""").format(
+                            table=sql.Identifier(structure),
+                            surface_columns=surface_columns,
+                            surface_values=surface_values)
+    else:
+        # numpy arrays (from the ndimage measurement engine) are converted to nested lists for psycopg2
+        object_data_list = (dict(object_data,
+                                 coordinates=np.asarray(object_data['coordinates']).tolist(),
+                                 intensity_image=np.asarray(object_data['intensity_image']).tolist())
+                            if isinstance(object_data['coordinates'], np.ndarray) or isinstance(object_data['intensity_image'], np.ndarray)
+                            else object_data
+                            for object_data in object_data_list)
+
+        query = sql.SQL("""INSERT into {table}
+                        (area, min_intensity, max_intensity, mean_intensity, total_intensity, object_id, name, centroid, coordinates, raw_img{surface_columns})
+                        VALUES
+                        (%(area)s, %(min_intensity)s, %(max_intensity)s, %(mean_intensity)s, %(total_intensity)s, %(object_id)s, %(name)s, %(centroid)s, %(coordinates)s, %(intensity_image)s{surface_values});""").format(
+                            table=sql.Identifier(structure),
+                            surface_columns=surface_columns,
+                            surface_values=surface_values)
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.executemany(query, object_data_list)
+        bump_data_versions(cur, structure, image_names)
+        cur.close()
+
+    return
+
+def postgres_array_literal(values):
+    """ Takes a (nested) list or numpy array of numbers
+
+    Returns the text representation of the values as a postgres array, e.g. '{{0.25,0.065,0.13},{0.25,0.13,0.13}}'
+    """
+
+    # package import
+    import numpy as np
+
+    array = np.asarray(values)
+
+    if array.size == 0:
+        return '{}'
+
+    # join the innermost dimension, then wrap groups of elements for each outer dimension
+    elements = ['{' + ','.join(row) + '}' for row in array.astype(str).reshape(-1, array.shape[-1]).tolist()]
+
+    for axis_length in reversed(array.shape[:-1]):
+        elements = ['{' + ','.join(elements[idx:idx + axis_length]) + '}' for idx in range(0, len(elements), axis_length)]
+
+    return elements[0]
+
+@instrument_function()
+def insert_object_data_copy(structure, object_data_lists, database_name, batch_size=1000, surface_bool=False):
+    """ Inputs: structure (string that describes the subcellular structure)
+                object_data_lists - an iterable of extract_object_properties or iter_object_properties outputs, e.g. one per image
+                database_name - the name of the experiment's database
+                batch_size - the number of rows written to the in-memory buffer before it is sent to postgres
+                surface_bool - if True, each object's surface coordinates and bounding box are also stored (see add_surface_columns)
+
+        Streams the objects into the structure table w/ COPY ... FROM STDIN in text format
+        Array values are formatted directly from numpy arrays, and all of the images are inserted in one transaction
+        (together w/ their new data versions), so either all or none of them are saved
+        Tables created w/ storage_format='compact' receive encoded coordinates and intensity crops
+
+        Returns the number of objects inserted
+    """
+
+    # package import
+    import io
+    from psycopg2 import sql
+
+    storage_format = get_storage_format(structure, database_name)
+    compact_bool = storage_format == 'compact'
+
+    create_version_tables(database_name)
+
+    surface_columns = sql.SQL("")
+
+    if surface_bool:
+        add_surface_columns(structure, database_name)
+        surface_columns = sql.SQL(", surface, bbox")
+
+    if compact_bool:
+        copy_query = sql.SQL("""COPY {table}
+                        (area, min_intensity, max_intensity, mean_intensity, total_intensity, object_id, name, centroid, coordinates, coordinate_scale, raw_img, raw_img_shape, raw_img_dtype{surface_columns})
+                        FROM STDIN""").format(
+                            table=sql.Identifier(structure),
+                            surface_columns=surface_columns)
+    else:
+        copy_query = sql.SQL("""COPY {table}
+                        (area, min_intensity, max_intensity, mean_intensity, total_intensity, object_id, name, centroid, coordinates, raw_img{surface_columns})
+                        FROM STDIN""").format(
+                            table=sql.Identifier(structure),
+                            surface_columns=surface_columns)
+
+    def copy_text(value):
+        # escape the characters that have a special meaning in COPY text format
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    object_count = 0
+    image_names = set()
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        copy_query = copy_query.as_string(conn)
+
+        buffer = io.StringIO()
+        buffer_rows = 0
+
+        for object_data_list in object_data_lists:
+            for object_data in iter_object_data(object_data_list):
+                row = [str(object_data['area']),
+                       str(object_data['min_intensity']),
+                       str(object_data['max_intensity']),
+                       str(object_data['mean_intensity']),
+                       str(object_data['total_intensity']),
+                       str(object_data['object_id']),
+                       copy_text(object_data['name']),
+                       postgres_array_literal(object_data['centroid'])]
+
+                if compact_bool:
+                    # bytea values are written in hex format; the backslash is escaped for COPY
+                    compact_data = compact_object_data(object_data)
+                    row.extend(['\\\\x' + compact_data['coordinates'].hex(),
+                                postgres_array_literal(compact_data['coordinate_scale']),
+                                '\\\\x' + compact_data['intensity_image'].hex(),
+                                postgres_array_literal(compact_data['raw_img_shape']),
+                                copy_text(compact_data['raw_img_dtype'])])
+                else:
+                    row.extend([postgres_array_literal(object_data['coordinates']),
+                                postgres_array_literal(object_data['intensity_image'])])
+
+                if surface_bool:
+                    surface_data = surface_object_data(object_data, storage_format)
+
+                    if compact_bool:
+                        row.append('\\\\x' + surface_data['surface'].hex())
+                    else:
+                        row.append(postgres_array_literal(surface_data['surface']))
+
+                    row.append(postgres_array_literal(surface_data['bbox']))
+
+                buffer.write('\t'.join(row) + '\n')
+                buffer_rows += 1
+                object_count += 1
+                image_names.add(object_data['name'])
+
+                if buffer_rows == batch_size:
+                    buffer.seek(0)
+                    cur.copy_expert(copy_query, buffer)
+                    buffer = io.StringIO()
+                    buffer_rows = 0
+
+        if buffer_rows:
+            buffer.seek(0)
+            cur.copy_expert(copy_query, buffer)
+
+        bump_data_versions(cur, structure, image_names)
+
+        cur.close()
+
+    return object_count
+
+def list_image_files(file_path, structures, raw_data_dir, segmentation_dir, segmentation_file_suffix):
+    """ Walks the segmentation folder of each structure in the same way as the extraction cell of pipeline.ipynb
+
+    Segmentation files that start w/ '.' are ignored. If segmentation_file_suffix is not an empty string, it is replaced
+    w/ '.tif' to find the name of the matching raw data file
+
+    Returns a list of tuples in format [(structure, image_name, segmented_image_path, intensity_image_path)]
+    """
+
+    import os
+
+    image_files = []
+
+    for structure in structures:
+        segmentations_path = os.path.join(file_path, structure, segmentation_dir)
+
+        for seg_img_name in sorted(os.listdir(segmentations_path)):
+            if not seg_img_name[0] == '.':
+
+                ins_img_name = seg_img_name
+
+                if segmentation_file_suffix:
+                    ins_img_name = seg_img_name[0:-(len(segmentation_file_suffix))] + '.tif'
+
+                seg_img_path = os.path.join(segmentations_path, seg_img_name)
+                ins_img_path = os.path.join(file_path, structure, raw_data_dir, ins_img_name)
+
+                image_files.append((structure, ins_img_name, seg_img_path, ins_img_path))
+
+    return image_files
+
+def create_ingest_manifest_table(database_name):
+    """ Creates the ingest_manifest table, if it doesn't exist
+
+    The table has one row per structure and image w/ the size, modification time (in ns) and sha256 hash of the segmentation
+    and intensity files, the xy_scale and z_scale used to extract the objects and the number of objects inserted
+    object_count is NULL while an image is being inserted, so images that were interrupted are inserted again
+
+    Returns nothing
+    """
+
+    manifest_query = """CREATE TABLE IF NOT EXISTS ingest_manifest (
+                        structure TEXT NOT NULL,
+                        image_name TEXT NOT NULL,
+                        segmentation_size BIGINT,
+                        segmentation_mtime BIGINT,
+                        segmentation_hash TEXT,
+                        intensity_size BIGINT,
+                        intensity_mtime BIGINT,
+                        intensity_hash TEXT,
+                        xy_scale DOUBLE PRECISION,
+                        z_scale DOUBLE PRECISION,
+                        object_count INT,
+                        ingested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (structure, image_name));"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(manifest_query)
+        cur.close()
+
+    return
+
+def file_hash(file_path, block_size=1048576):
+    """ Returns the sha256 hash of a file as a hex string, reading block_size bytes at a time
+    """
+
+    import hashlib
+
+    file_sha256 = hashlib.sha256()
+
+    with open(file_path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(block_size), b''):
+            file_sha256.update(block)
+
+    return file_sha256.hexdigest()
+
+def fetch_ingest_manifest(database_name):
+    """ Returns the whole ingest_manifest table w/ one query, as a dictionary {(structure, image_name): row dictionary}
+    """
+
+    from psycopg2.extras import RealDictCursor
+
+    create_ingest_manifest_table(database_name)
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM ingest_manifest;")
+        manifest_rows = cur.fetchall()
+        cur.close()
+
+    return {(row['structure'], row['image_name']): row for row in manifest_rows}
+
+def plan_image_ingest(image_files, xy_scale, z_scale, database_name):
+    """ Takes the output of list_image_files and the xy_scale and z_scale used for extraction
+
+    Compares each image w/ the ingest manifest (fetched w/ one query) and returns a list of tuples in format
+    [(structure, image_name, segmented_image_path, intensity_image_path, ingest_status)], where ingest_status is
+    'new' - the image has not been inserted
+    'changed' - the files, xy_scale or z_scale changed since the image was inserted, or its insert was interrupted
+    'unchanged' - the image is in the database and doesn't need to be inserted again
+
+    Files are only hashed if their size is unchanged but their modification time is not; if the hash is unchanged,
+    the new modification time is saved (w/ the hash computed here, so the file is read only once) so the file isn't hashed again
+    Images that were inserted before the manifest existed are found w/ one query per structure and are 'unchanged'
+    """
+
+    import os
+    from psycopg2 import sql
+
+    manifest = fetch_ingest_manifest(database_name)
+
+    # images that are in a structure table but not in the manifest were inserted before the manifest existed
+    legacy_image_names = {}
+    for structure in sorted({image_file[0] for image_file in image_files if (image_file[0], image_file[1]) not in manifest}):
+        with database_connection(database_name) as conn:
+            cur = conn.cursor()
+            cur.execute(sql.SQL("SELECT DISTINCT name FROM {table};").format(table=sql.Identifier(structure)))
+            legacy_image_names[structure] = {row[0] for row in cur.fetchall()}
+            cur.close()
+
+    ingest_plan = []
+
+    for structure, image_name, seg_img_path, ins_img_path in image_files:
+        manifest_row = manifest.get((structure, image_name))
+
+        if manifest_row is None:
+            ingest_status = 'unchanged' if image_name in legacy_image_names[structure] else 'new'
+
+        elif manifest_row['object_count'] is None or manifest_row['xy_scale'] != xy_scale or manifest_row['z_scale'] != z_scale:
+            ingest_status = 'changed'
+
+        else:
+            ingest_status = 'unchanged'
+            mtime_changed_bool = False
+            file_hashes = {}
+
+            for file_type, image_path in (('segmentation', seg_img_path), ('intensity', ins_img_path)):
+                file_stat = os.stat(image_path)
+                file_hashes[file_type] = manifest_row[file_type + '_hash']
+
+                if file_stat.st_size != manifest_row[file_type + '_size']:
+                    ingest_status = 'changed'
+                elif file_stat.st_mtime_ns != manifest_row[file_type + '_mtime']:
+                    file_hashes[file_type] = file_hash(image_path)
+                    if file_hashes[file_type] != manifest_row[file_type + '_hash']:
+                        ingest_status = 'changed'
+                    mtime_changed_bool = True
+
+            if ingest_status == 'unchanged' and mtime_changed_bool:
+                record_ingest_manifest(structure, image_name, seg_img_path, ins_img_path, xy_scale, z_scale, database_name, object_count=manifest_row['object_count'],
+                                       file_hashes=file_hashes)
+
+        ingest_plan.append((structure, image_name, seg_img_path, ins_img_path, ingest_status))
+
+    return ingest_plan
+
+def record_ingest_manifest(structure, image_name, segmented_image_path, intensity_image_path, xy_scale, z_scale, database_name, object_count=None, file_hashes=None):
+    """ Saves the size, modification time and hash of the image's files, the xy_scale, z_scale and object_count in the ingest manifest
+    file_hashes is an optional dictionary of hashes that are already known, by file type ('segmentation' or 'intensity');
+    the other files are hashed here
+
+    Returns nothing
+    """
+
+    import os
+
+    file_hashes = file_hashes or {}
+
+    manifest_values = {'structure': structure, 'image_name': image_name, 'xy_scale': xy_scale, 'z_scale': z_scale, 'object_count': object_count}
+
+    for file_type, image_path in (('segmentation', segmented_image_path), ('intensity', intensity_image_path)):
+        file_stat = os.stat(image_path)
+        manifest_values[file_type + '_size'] = file_stat.st_size
+        manifest_values[file_type + '_mtime'] = file_stat.st_mtime_ns
+        manifest_values[file_type + '_hash'] = file_hashes[file_type] if file_type in file_hashes else file_hash(image_path)
+
+    record_query = """INSERT INTO ingest_manifest (structure, image_name, segmentation_size, segmentation_mtime, segmentation_hash,
+                        intensity_size, intensity_mtime, intensity_hash, xy_scale, z_scale, object_count)
+                    VALUES (%(structure)s, %(image_name)s, %(segmentation_size)s, %(segmentation_mtime)s, %(segmentation_hash)s,
+                        %(intensity_size)s, %(intensity_mtime)s, %(intensity_hash)s, %(xy_scale)s, %(z_scale)s, %(object_count)s)
+                    ON CONFLICT (structure, image_name) DO UPDATE
+                    SET segmentation_size = EXCLUDED.segmentation_size, segmentation_mtime = EXCLUDED.segmentation_mtime,
+                    segmentation_hash = EXCLUDED.segmentation_hash, intensity_size = EXCLUDED.intensity_size,
+                    intensity_mtime = EXCLUDED.intensity_mtime, intensity_hash = EXCLUDED.intensity_hash,
+                    xy_scale = EXCLUDED.xy_scale, z_scale = EXCLUDED.z_scale, object_count = EXCLUDED.object_count, ingested_at = now();"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(record_query, manifest_values)
+        cur.close()
+
+    return
+
+def begin_image_ingest(structure, image_name, segmented_image_path, intensity_image_path, xy_scale, z_scale, database_name, ingest_status):
+    """ Prepares an image w/ ingest_status 'new' or 'changed' (see plan_image_ingest) to be inserted
+
+    The image is saved in the manifest w/o an object count, so it is inserted again if the insert is interrupted,
+    and the old objects of 'changed' images are deleted (see delete_data_db)
+
+    Returns nothing
+    """
+
+    record_ingest_manifest(structure, image_name, segmented_image_path, intensity_image_path, xy_scale, z_scale, database_name)
+
+    if ingest_status == 'changed':
+        delete_data_db(image_name, structure, database_name)
+
+    return
+
+def finish_image_ingest(structure, image_name, object_count, database_name):
+    """ Saves the object count of an image in the manifest once all of its objects have been inserted
+
+    Returns nothing
+    """
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE ingest_manifest SET object_count = %s WHERE structure = %s AND image_name = %s;", (object_count, structure, image_name))
+        cur.close()
+
+    return
+
+@instrument_function('image_name')
+def ingest_image(structure, image_name, segmented_image_path, intensity_image_path, xy_scale, z_scale, database_name, ingest_status='new',
+                 batch_size=1000, copy_bool=False, surface_bool=False, measurement_engine='ndimage', slab_depth=None):
+    """ Extracts the objects of one image w/ iter_object_properties and inserts them in batches of batch_size objects
+    w/ insert_object_data, recording the image in the ingest manifest (see begin_image_ingest and finish_image_ingest)
+
+    Returns the number of objects inserted
+    """
+
+    begin_image_ingest(structure, image_name, segmented_image_path, intensity_image_path, xy_scale, z_scale, database_name, ingest_status)
+
+    object_count = 0
+
+    for object_data_batch in iter_object_properties(segmented_image_path, intensity_image_path, image_name, xy_scale, z_scale, batch_size=batch_size,
+                                                    measurement_engine=measurement_engine, slab_depth=slab_depth):
+        insert_object_data(structure, object_data_batch, database_name, copy_bool=copy_bool, surface_bool=surface_bool)
+        object_count += len(object_data_batch)
+
+    finish_image_ingest(structure, image_name, object_count, database_name)
+
+    return object_count
+
+def extract_images_parallel(file_path, structures, raw_data_dir, segmentation_dir, segmentation_file_suffix, xy_scale, z_scale, database_name,
+                            processes=None, max_images_in_flight=None, copy_bool=False, measurement_engine='ndimage', slab_depth=None, surface_bool=False):
+    """ Extracts object data for every image of every structure w/ a pool of processes
+
+    The inputs match the parameters cell of pipeline.ipynb. Images that are already in the database are not re-processed,
+    unless their files or the xy_scale and z_scale changed since they were inserted (see plan_image_ingest)
+    Worker processes run extract_object_properties; only this process writes to the database (w/ insert_object_data),
+    so inserts never compete w/ each other. At most max_images_in_flight images (default: 2 per process) are being
+    extracted or waiting to be inserted at any time, which keeps memory use bounded
+
+    processes defaults to the number of cpus - 1
+    measurement_engine and slab_depth are passed to extract_object_properties, copy_bool and surface_bool to insert_object_data
+
+    Returns a list of dictionaries, one per image, w/ the keys 'structure', 'image_name', 'status'
+    ('inserted', 'replaced', 'skipped' or 'failed'), 'object_count' and 'error'
+    """
+
+    import os
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) - 1)
+
+    if max_images_in_flight is None:
+        max_images_in_flight = 2 * processes
+
+    image_reports = []
+    pending_images = []
+
+    image_files = list_image_files(file_path, structures, raw_data_dir, segmentation_dir, segmentation_file_suffix)
+
+    for structure, image_name, seg_img_path, ins_img_path, ingest_status in plan_image_ingest(image_files, xy_scale, z_scale, database_name):
+
+        # check if the image has been processed
+        if ingest_status == 'unchanged':
+            print('{structure} data for {image_name} has already been processed and will not be re-processed'.format(structure=structure, image_name=image_name))
+            image_reports.append({'structure': structure, 'image_name': image_name, 'status': 'skipped', 'object_count': None, 'error': None})
+        else:
+            pending_images.append((structure, image_name, seg_img_path, ins_img_path, ingest_status))
+
+    pending_images.reverse()
+    running_futures = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while pending_images or running_futures:
+
+            # keep the number of images in flight bounded
+            while pending_images and len(running_futures) < max_images_in_flight:
+                structure, image_name, seg_img_path, ins_img_path, ingest_status = pending_images.pop()
+                future = executor.submit(extract_object_properties, seg_img_path, ins_img_path, image_name, xy_scale, z_scale, measurement_engine, slab_depth, True)
+                running_futures[future] = (structure, image_name, seg_img_path, ins_img_path, ingest_status)
+
+            done_futures, not_done_futures = wait(running_futures, return_when=FIRST_COMPLETED)
+
+            for future in done_futures:
+                structure, image_name, seg_img_path, ins_img_path, ingest_status = running_futures.pop(future)
+                image_report = {'structure': structure, 'image_name': image_name, 'status': 'replaced' if ingest_status == 'changed' else 'inserted',
+                                'object_count': None, 'error': None}
+
+                try:
+                    object_data_list = future.result()
+                    begin_image_ingest(structure, image_name, seg_img_path, ins_img_path, xy_scale, z_scale, database_name, ingest_status)
+                    insert_object_data(structure, object_data_list, database_name, copy_bool=copy_bool, surface_bool=surface_bool)
+                    finish_image_ingest(structure, image_name, len(object_data_list), database_name)
+                    image_report['object_count'] = len(object_data_list)
+                except Exception as error:
+                    image_report['status'] = 'failed'
+                    image_report['error'] = repr(error)
+                    print('{structure} data for {image_name} could not be processed: {error}'.format(structure=structure, image_name=image_name, error=repr(error)))
+
+                image_reports.append(image_report)
+
+    return image_reports
+
+def extract_surface_coordinates(coordinates_list):
+    """ Input: a list of coordinates that define one object
+
+    Logic is to include all coordinates in the minimum and maximum z slices
+    Then hold z, x constant and include the coordinates w/ the min and max y values for each z,x pair
+    Then hold z, y constant and include the coordinates w/ the min and max x values for each z,y pair
+
+    Return list of exterior coordinates, excluding any invaginations
+    """
+
+    surface_coords = extract_surface_array(coordinates_list)
+
+    return list(map(tuple, surface_coords.tolist()))
+
+@instrument_function()
+def extract_surface_array(coordinates, true_boundary_bool=False):
+    """ Input: an (N, 3) array (or list) of the z, x, y coordinates that define one object
+
+    By default returns the same exterior coordinates as extract_surface_coordinates:
+    all coordinates in the minimum and maximum z slices, plus the coordinates w/ the min and max y values
+    for each z,x pair and the coordinates w/ the min and max x values for each z,y pair
+    The coordinates are grouped by sorting once with np.lexsort, so large objects take milliseconds
+
+    If true_boundary_bool = True, the object is rasterized into a boolean volume on its bounding box and the
+    surface is every voxel that touches the background along z, x or y, which includes invaginations and cavities
+
+    Returns an (M, 3) numpy array of unique surface coordinates
+    """
+
+    # package import
+    import numpy as np
+
+    coordinates = np.asarray(coordinates).reshape(-1, 3)
+
+    if len(coordinates) == 0:
+        return coordinates
+
+    if true_boundary_bool:
+        from scipy.ndimage import binary_erosion
+
+        # coordinates of one connected object are contiguous along each axis, so the rank of each unique value
+        # is its voxel index within the bounding box; this works for both voxel and scaled coordinates
+        axis_values = []
+        voxel_indexes = []
+        for axis in range(3):
+            values, indexes = np.unique(coordinates[:, axis], return_inverse=True)
+            axis_values.append(values)
+            voxel_indexes.append(indexes.reshape(-1))
+
+        # pad the bounding box by one voxel so that voxels on its faces count as boundary
+        volume = np.zeros([len(values) + 2 for values in axis_values], dtype=bool)
+        volume[voxel_indexes[0] + 1, voxel_indexes[1] + 1, voxel_indexes[2] + 1] = True
+
+        boundary = volume & ~binary_erosion(volume)
+        z_idx, x_idx, y_idx = np.nonzero(boundary[1:-1, 1:-1, 1:-1])
+
+        return np.stack([axis_values[0][z_idx], axis_values[1][x_idx], axis_values[2][y_idx]], axis=1)
+
+    z = coordinates[:, 0]
+    surface_mask = (z == z.min()) | (z == z.max())
+
+    # hold z, x constant: sort by z, then x, then y and keep the first and last coordinate of each z,x group
+    # then hold z, y constant in the same way with x as the innermost sort key
+    for group_axis, extreme_axis in ((1, 2), (2, 1)):
+        order = np.lexsort((coordinates[:, extreme_axis], coordinates[:, group_axis], z))
+        sorted_keys = coordinates[order][:, [0, group_axis]]
+
+        new_group = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+        group_starts = np.concatenate(([True], new_group))
+        group_ends = np.concatenate((new_group, [True]))
+
+        surface_mask[order[group_starts | group_ends]] = True
+
+    # remove duplicates
+    surface_coords = np.unique(coordinates[surface_mask], axis=0)
+
+    return surface_coords
+
+def build_centroid_tree(structure_2_centroid_data):
+    """ structure_2 centroid data is a list of tuples in format [(id, centroid)] w/ all the centroids for the subcellular target of interest for that image
+
+    Builds a KD-tree spatial index over the structure_2 centroids. Build this once per image and reuse it
+    to find the closest structure_2 objects for every structure_1 object in that image
+
+    Returns a tuple of (centroid_tree, structure_2_ids); centroid_tree is None if the image has no structure_2 objects
+    """
+
+    # package import
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    structure_2_ids = [id_centroid_row[0] for id_centroid_row in structure_2_centroid_data]
+
+    if not structure_2_ids:
+        return None, structure_2_ids
+
+    centroids_2 = np.array([id_centroid_row[1] for id_centroid_row in structure_2_centroid_data], dtype=float)
+
+    return cKDTree(centroids_2), structure_2_ids
+
+def query_closest_structure_2(centroid_tree, structure_2_ids, centroids_1, number_centroid_measure):
+    """ Takes the output of build_centroid_tree and a list of structure_1 centroids from the same image
+
+    Finds the number_centroid_measure closest structure_2 centroids for all structure_1 centroids in one batched query
+
+    Returns a list with one tuple of structure_2 ids per structure_1 centroid, ordered from closest to furthest
+    """
+
+    # package import
+    import numpy as np
+
+    if centroid_tree is None or len(centroids_1) == 0:
+        return [tuple() for centroid_1 in centroids_1]
+
+    k = min(number_centroid_measure, len(structure_2_ids))
+
+    distances, indexes = centroid_tree.query(np.array(centroids_1, dtype=float).reshape(-1, 3), k=k)
+
+    # a query for a single neighbor returns 1D arrays
+    indexes = np.asarray(indexes).reshape(len(centroids_1), k)
+
+    closest_structure_2_ids = [tuple(structure_2_ids[idx] for idx in row) for row in indexes.tolist()]
+
+    return closest_structure_2_ids
+
+def centroid_measurements_closest_structure_2(centroid_1, structure_2_centroid_data, number_centroid_measure):
+    """ structure_2 centroid data is a list of tuples in format [(id, centroid)] w/ all the centroids for the subcellular target of interest for that image
+
+    Returns a tuple with the ids of the number_centroid_measure structure_2 objects closest to centroid_1
+    """
+
+    centroid_tree, structure_2_ids = build_centroid_tree(structure_2_centroid_data)
+
+    closest_structure_2_ids = query_closest_structure_2(centroid_tree, structure_2_ids, [centroid_1], number_centroid_measure)[0]
+
+    return closest_structure_2_ids
+
+def select_closest_structure_2_ids(structure_1, structure_2, number_centroid_measure, database_name, by_image_bool=False):
+    """ Finds the closest structure_2 objects by centroid distance for every structure_1 object that has not been measured
+
+    Loads the centroids for both structures once, builds one KD-tree per image for structure_2
+    and queries all of the structure_1 centroids in that image in a single batch
+
+    Returns a dict mapping each unmeasured structure_1 id to a tuple of the closest structure_2 ids
+    If by_image_bool is True, returns a dict mapping each image name to such a dict for the objects in that image
+    """
+
+    from psycopg2 import sql
+
+    distance_col = 'distance_to_' + structure_2
+
+    structure_1_centroid_query = sql.SQL("""SELECT name, id, centroid
+                            FROM {structure_1}
+                            WHERE {distance_col} IS NULL;""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier(distance_col))
+
+    structure_2_centroid_query = sql.SQL("""SELECT name, id, centroid
+                                FROM {structure_2}
+                                WHERE name IN (SELECT DISTINCT name FROM {structure_1} WHERE {distance_col} IS NULL);""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    structure_2=sql.Identifier(structure_2),
+                    distance_col=sql.Identifier(distance_col))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(structure_1_centroid_query)
+        structure_1_centroid_data = cur.fetchall()
+
+        cur.execute(structure_2_centroid_query)
+        structure_2_centroid_data = cur.fetchall()
+
+        cur.close()
+
+    # group the centroids by image
+    structure_1_by_image = {}
+    for image_name, structure_1_id, centroid in structure_1_centroid_data:
+        structure_1_by_image.setdefault(image_name, []).append((structure_1_id, centroid))
+
+    structure_2_by_image = {}
+    for image_name, structure_2_id, centroid in structure_2_centroid_data:
+        structure_2_by_image.setdefault(image_name, []).append((structure_2_id, centroid))
+
+    closest_structure_2_by_id = {}
+
+    for image_name, structure_1_rows in structure_1_by_image.items():
+        centroid_tree, structure_2_ids = build_centroid_tree(structure_2_by_image.get(image_name, []))
+
+        centroids_1 = [centroid for structure_1_id, centroid in structure_1_rows]
+        closest_structure_2_ids = query_closest_structure_2(centroid_tree, structure_2_ids, centroids_1, number_centroid_measure)
+
+        for (structure_1_id, centroid), closest_ids in zip(structure_1_rows, closest_structure_2_ids):
+            if by_image_bool:
+                closest_structure_2_by_id.setdefault(image_name, {})[structure_1_id] = closest_ids
+            else:
+                closest_structure_2_by_id[structure_1_id] = closest_ids
+
+    return closest_structure_2_by_id
+
+def minimum_distance(object_1, object_2):
+    """ Takes two lists as input
+    A list of numpy arrays of coordinates that make up object 1 and object 2
+    Measures the distances between each of the coordinates
+    Returns the minimum distance between the two objects, as calculated using a vector norm
+    Returns 0 if two coordinates overlap
+    """
+
+    # package import
+    import numpy as np
+
+    return minimum_distance_arrays(np.array(object_1, dtype=float), np.array(object_2, dtype=float))
+
+@instrument_function()
+def minimum_distance_arrays(coords_1, coords_2, max_block_size=4194304):
+    """ Takes two (N, 3) numpy arrays of coordinates that make up object 1 and object 2
+
+    Measures the pairwise distances in blocks of at most max_block_size coordinate pairs, so memory
+    stays bounded for very large surfaces
+
+    Returns the exact minimum Euclidean distance between the two objects
+    Stops the calculation and returns 0 if two coordinates overlap
+    """
+
+    # package import
+    import numpy as np
+    from scipy.spatial.distance import cdist
+
+    coords_1 = np.asarray(coords_1, dtype=float).reshape(-1, 3)
+    coords_2 = np.asarray(coords_2, dtype=float).reshape(-1, 3)
+
+    minimum_distance = 100000
+
+    if len(coords_1) == 0 or len(coords_2) == 0:
+        return float(minimum_distance)
+
+    # iterate over blocks of the larger object so that each block holds at most max_block_size pairs
+    if len(coords_1) < len(coords_2):
+        coords_1, coords_2 = coords_2, coords_1
+
+    block_length = max(1, max_block_size // len(coords_2))
+
+    for block_start in range(0, len(coords_1), block_length):
+        block_minimum = cdist(coords_1[block_start:block_start + block_length], coords_2).min()
+        count_metric('minimum_distance_voxel_pairs', len(coords_1[block_start:block_start + block_length]) * len(coords_2))
+
+        if block_minimum == 0:
+            return 0.0
+        elif block_minimum < minimum_distance:
+            minimum_distance = block_minimum
+
+    return float(minimum_distance)
+
+
+def object_bounding_box(coordinates):
+    """ Takes an (N, 3) array of coordinates
+
+    Returns the axis-aligned bounding box as an array in format [z_min, x_min, y_min, z_max, x_max, y_max],
+    in the (z, x, y) order of the coordinates
+    The bounding box of an object's surface (see extract_surface_array) is the same as that of its coordinates
+    """
+
+    # package import
+    import numpy as np
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+
+    return np.concatenate([coordinates.min(axis=0), coordinates.max(axis=0)])
+
+def bounding_box_distances(bounding_box, bounding_boxes):
+    """ Takes one bounding box and an (M, 6) array of bounding boxes from object_bounding_box
+
+    Returns an array w/ the distance between the first box and each of the others (0 where they overlap)
+    This is a lower bound for the minimum distance between the coordinates inside the boxes
+    """
+
+    # package import
+    import numpy as np
+
+    bounding_boxes = np.asarray(bounding_boxes, dtype=float).reshape(-1, 6)
+
+    # the gap along each axis is positive only if the boxes don't overlap along that axis
+    axis_gaps = np.maximum(0, np.maximum(bounding_boxes[:, :3] - bounding_box[3:], bounding_box[:3] - bounding_boxes[:, 3:]))
+
+    return np.sqrt((axis_gaps ** 2).sum(axis=1))
+
+def create_postgres_table(structure, database_name, storage_format='array'):
+    """ Function to create foundational table for holding data related to images
+    All images of subcellular structures have this foundational data collected and stored
+    The structure_1 table has specialized additional columns for distance measurements that are added separately
+
+    Input: string describing the subcellular structure this table is for (e.g. 'rna' or 'centrosomes')
+    and the name of the experiment's database
+
+    storage_format = 'array' stores coordinates and intensity crops as postgres arrays
+    storage_format = 'compact' stores them as compressed bytea (see encode_coordinates and encode_intensity_image),
+    which is much smaller and faster to read for large objects
+
+    Output: creates a table in the database that the connection object connects to.
+    Closes the cursor and returns nothing
+
+    """
+
+    from psycopg2 import sql
+
+    # only the columns that hold the coordinates and the intensity crop depend on the storage format
+    if storage_format == 'compact':
+        storage_columns = """coordinates BYTEA,
+            coordinate_scale DOUBLE PRECISION [],
+            raw_img BYTEA,
+            raw_img_shape INT [],
+            raw_img_dtype TEXT"""
+    else:
+        storage_columns = """coordinates REAL [][][],
+            raw_img INT [][][]"""
+
+    create_table_query = sql.SQL("""
+
+        CREATE TABLE IF NOT EXISTS {table}
+            (id SERIAL NOT NULL,
+            object_id INT NOT NULL,
+            name TEXT NOT NULL,
+            area REAL,
+            min_intensity REAL,
+            max_intensity REAL,
+            mean_intensity REAL,
+            total_intensity REAL,
+            centroid REAL [][][],
+            {storage_columns});""").format(
+                                table=sql.Identifier(structure),
+                                storage_columns=sql.SQL(storage_columns))
+
+    _storage_formats.pop((database_name, structure), None)
+    _surface_columns.discard((database_name, structure))
+    _version_tables.discard(database_name)
+
+    # borrow a connection from the pool and initialize a cursor
+    with database_connection(database_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(create_table_query)
+        cursor.close()
+
+    create_version_tables(database_name)
+
+    return None
+
+def get_storage_format(structure, database_name):
+    """ Returns 'compact' if the structure table stores coordinates as bytea, otherwise 'array'
+
+    The answer is cached for each process, since a table keeps its layout for the life of an experiment
+    """
+
+    storage_key = (database_name, structure)
+
+    if storage_key not in _storage_formats:
+        with database_connection(database_name) as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT data_type FROM INFORMATION_SCHEMA.COLUMNS
+                            WHERE table_name = %(table)s AND column_name = 'coordinates';""", {'table': structure})
+            data_type = cur.fetchone()
+            cur.close()
+
+        # don't cache the answer for a table that doesn't exist yet
+        if data_type is None:
+            return 'array'
+
+        _storage_formats[storage_key] = 'compact' if data_type[0] == 'bytea' else 'array'
+
+    return _storage_formats[storage_key]
+
+def coordinates_column_sql(storage_format):
+    """ Returns the SQL that selects an object's coordinates together w/ its coordinate scale
+    The coordinate scale is NULL for tables w/ the 'array' storage format
+    Pass the two selected values to coordinates_to_array
+    """
+
+    from psycopg2 import sql
+
+    if storage_format == 'compact':
+        return sql.SQL("coordinates, coordinate_scale")
+
+    return sql.SQL("coordinates, NULL AS coordinate_scale")
+
+def encode_coordinates(coordinates, coordinate_scale):
+    """ Takes an (N, 3) array of scaled coordinates and the [z_scale, xy_scale, xy_scale] used to scale them
+
+    Converts the coordinates back to voxel indices, stored as int16 (or int32 for images w/ more than 32767 pixels along an axis)
+    The indices are compressed w/ zlib and prefixed w/ one byte that names the integer type
+
+    Returns bytes
+    """
+
+    # package import
+    import numpy as np
+    import zlib
+
+    voxel_indexes = np.rint(np.asarray(coordinates, dtype=float).reshape(-1, 3) / np.asarray(coordinate_scale, dtype=float))
+
+    index_dtype = np.dtype('<i2')
+    if voxel_indexes.size and np.abs(voxel_indexes).max() > np.iinfo(np.int16).max:
+        index_dtype = np.dtype('<i4')
+
+    return index_dtype.char.encode('ascii') + zlib.compress(voxel_indexes.astype(index_dtype).tobytes())
+
+def decode_coordinates(coordinates_blob, coordinate_scale):
+    """ Takes the output of encode_coordinates and the coordinate scale stored w/ it
+
+    Returns an (N, 3) numpy array of scaled coordinates
+    """
+
+    # package import
+    import numpy as np
+    import zlib
+
+    coordinates_blob = bytes(coordinates_blob)
+    index_dtype = np.dtype(coordinates_blob[0:1].decode('ascii')).newbyteorder('<')
+
+    voxel_indexes = np.frombuffer(zlib.decompress(coordinates_blob[1:]), dtype=index_dtype).reshape(-1, 3)
+
+    return voxel_indexes * np.asarray(coordinate_scale, dtype=float)
+
+def encode_intensity_image(intensity_image):
+    """ Takes an intensity crop (numpy array or nested list)
+
+    Returns a tuple of (zlib compressed bytes, shape list, dtype string) to store in the raw_img, raw_img_shape and raw_img_dtype columns
+    """
+
+    # package import
+    import numpy as np
+    import zlib
+
+    intensity_image = np.asarray(intensity_image)
+
+    if intensity_image.dtype.kind == 'i' and intensity_image.size and intensity_image.min() >= 0 and intensity_image.max() <= np.iinfo(np.uint16).max:
+        intensity_image = intensity_image.astype(np.uint16)
+
+    intensity_image = intensity_image.astype(intensity_image.dtype.newbyteorder('<'))
+
+    return zlib.compress(intensity_image.tobytes()), list(intensity_image.shape), intensity_image.dtype.str
+
+def decode_intensity_image(raw_img_blob, raw_img_shape, raw_img_dtype):
+    """ Takes the raw_img, raw_img_shape and raw_img_dtype values of a compact table
+
+    Returns the intensity crop as a numpy array
+    """
+
+    # package import
+    import numpy as np
+    import zlib
+
+    return np.frombuffer(zlib.decompress(bytes(raw_img_blob)), dtype=np.dtype(raw_img_dtype)).reshape(raw_img_shape)
+
+def coordinates_to_array(coordinates, coordinate_scale=None):
+    """ Takes the coordinates and coordinate scale selected w/ coordinates_column_sql
+
+    Returns an (N, 3) numpy array of scaled coordinates for both the 'array' and the 'compact' storage formats
+    """
+
+    # package import
+    import numpy as np
+
+    if coordinate_scale is None:
+        return np.array(coordinates, dtype=float).reshape(-1, 3)
+
+    return decode_coordinates(coordinates, coordinate_scale)
+
+def compact_object_data(object_data):
+    """ Takes one object dictionary from extract_object_properties
+
+    Returns a copy where the coordinates and intensity image are encoded for a table w/ the 'compact' storage format
+    """
+
+    raw_img, raw_img_shape, raw_img_dtype = encode_intensity_image(object_data['intensity_image'])
+
+    compact_data = dict(object_data)
+    compact_data.update({
+        'coordinates': encode_coordinates(object_data['coordinates'], object_data['coordinate_scale']),
+        'coordinate_scale': [float(scale) for scale in object_data['coordinate_scale']],
+        'intensity_image': raw_img,
+        'raw_img_shape': raw_img_shape,
+        'raw_img_dtype': raw_img_dtype})
+
+    return compact_data
+
+def add_surface_columns(structure, database_name):
+    """ Adds the surface and bbox columns to a structure table, if they don't exist
+    Tables that already have them (see has_surface_columns) are not altered, since ALTER TABLE locks the table
+    even if the columns exist, and this runs for every batch of inserted objects
+
+    surface holds the surface coordinates of each object (see extract_surface_array), stored like the coordinates column
+    (REAL[][] for the 'array' storage format, encoded bytea for 'compact'); bbox holds the axis-aligned bounding box
+    of the scaled coordinates as [z_min, x_min, y_min, z_max, x_max, y_max], in the (z, x, y) order of the coordinates
+    The bound candidate mode reads the structure_2 bounding boxes instead of computing them (see stored_bounding_boxes)
+
+    Returns nothing
+    """
+
+    from psycopg2 import sql
+
+    if has_surface_columns(structure, database_name):
+        return None
+
+    surface_type = sql.SQL("BYTEA") if get_storage_format(structure, database_name) == 'compact' else sql.SQL("REAL [][]")
+
+    query = sql.SQL("ALTER TABLE {table} ADD COLUMN IF NOT EXISTS surface {surface_type}, ADD COLUMN IF NOT EXISTS bbox REAL [];").format(
+                            table=sql.Identifier(structure),
+                            surface_type=surface_type)
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+        cur.close()
+
+    _surface_columns.add((database_name, structure))
+
+    return None
+
+def has_surface_columns(structure, database_name):
+    """ Returns True if the structure table has the surface and bbox columns (see add_surface_columns)
+    Only a True answer is cached, since the columns can be added at any time
+    """
+
+    surface_key = (database_name, structure)
+
+    if surface_key not in _surface_columns:
+        with database_connection(database_name) as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+                            WHERE table_name = %(table)s AND column_name IN ('surface', 'bbox');""", {'table': structure})
+            column_count = cur.fetchone()[0]
+            cur.close()
+
+        if column_count < 2:
+            return False
+
+        _surface_columns.add(surface_key)
+
+    return True
+
+def surface_column_sql(structure, database_name):
+    """ Returns the SQL that selects an object's coordinates, coordinate scale and precomputed surface for distance measurements
+    The full coordinates are only selected for objects w/o a precomputed surface
+    Pass the three selected values to object_surface_array
+    """
+
+    from psycopg2 import sql
+
+    coordinate_scale = sql.SQL("coordinate_scale") if get_storage_format(structure, database_name) == 'compact' else sql.SQL("NULL AS coordinate_scale")
+
+    if has_surface_columns(structure, database_name):
+        return sql.SQL("CASE WHEN surface IS NULL THEN coordinates END AS coordinates, {coordinate_scale}, surface").format(coordinate_scale=coordinate_scale)
+
+    return sql.SQL("coordinates, {coordinate_scale}, NULL AS surface").format(coordinate_scale=coordinate_scale)
+
+def bbox_column_sql(structure, database_name):
+    """ Returns the SQL that selects an object's precomputed bounding box, or NULL if the table has no bbox column
+    Pass the rows to stored_bounding_boxes
+    """
+
+    from psycopg2 import sql
+
+    if has_surface_columns(structure, database_name):
+        return sql.SQL("bbox")
+
+    return sql.SQL("NULL AS bbox")
+
+def stored_bounding_boxes(object_rows):
+    """ Takes rows that start w/ the object id and end w/ the bbox selected w/ bbox_column_sql
+
+    The boxes are stored as REAL, so each one is widened by more than the float32 rounding error;
+    it then still contains the object's coordinates as read from the database, and its distances are lower bounds
+
+    Returns a dictionary {id: bounding box array} of the objects w/ a stored bbox, for measure_image_objects
+    """
+
+    # package import
+    import numpy as np
+
+    bounding_boxes = {}
+
+    for object_row in object_rows:
+        if object_row[-1] is None:
+            continue
+
+        bounding_box = np.asarray(object_row[-1], dtype=float)
+        margin = np.abs(bounding_box) * 1e-6 + 1e-6
+
+        bounding_boxes[object_row[0]] = np.concatenate([bounding_box[:3] - margin[:3], bounding_box[3:] + margin[3:]])
+
+    return bounding_boxes
+
+def object_surface_array(coordinates, coordinate_scale, surface):
+    """ Takes the values selected w/ surface_column_sql
+
+    Returns the object's surface coordinates as an (N, 3) numpy array, from the surface column if it has been precomputed
+    """
+
+    if surface is not None:
+        return coordinates_to_array(surface, coordinate_scale)
+
+    return extract_surface_array(coordinates_to_array(coordinates, coordinate_scale))
+
+def image_surface_data(object_rows):
+    """ Takes rows of (id, centroid, coordinates, coordinate_scale, surface) selected w/ surface_column_sql
+
+    Returns a tuple of ([(id, centroid, coordinates)], {id: surface coordinates}) for measure_image_objects
+    Only the objects w/ a precomputed surface are in the dictionary, and their coordinates are None
+    """
+
+    object_data = []
+    object_surfaces = {}
+
+    for object_id, centroid, coordinates, coordinate_scale, surface in object_rows:
+        if surface is not None:
+            object_surfaces[object_id] = coordinates_to_array(surface, coordinate_scale)
+            coordinates = None
+        else:
+            coordinates = coordinates_to_array(coordinates, coordinate_scale)
+
+        object_data.append((object_id, centroid, coordinates))
+
+    return object_data, object_surfaces
+
+def surface_object_data(object_data, storage_format='array'):
+    """ Takes one object dictionary from extract_object_properties
+
+    Returns a copy w/ the 'surface' and 'bbox' values for the surface and bbox columns (see add_surface_columns)
+    """
+
+    # package import
+    import numpy as np
+
+    coordinates = np.asarray(object_data['coordinates'], dtype=float).reshape(-1, 3)
+    surface = extract_surface_array(coordinates)
+
+    surface_data = dict(object_data)
+    surface_data['bbox'] = coordinates.min(axis=0).tolist() + coordinates.max(axis=0).tolist()
+
+    if storage_format == 'compact':
+        surface_data['surface'] = encode_coordinates(surface, object_data['coordinate_scale'])
+    else:
+        surface_data['surface'] = surface.tolist()
+
+    return surface_data
+
+@instrument_function()
+def backfill_surface_columns(structure, database_name, batch_size=1000):
+    """ Adds the surface and bbox columns to an existing structure table and fills them for every object that doesn't have them yet
+
+    The objects are processed in batches of batch_size, w/ one transaction per batch, so an interrupted backfill can be resumed
+    by running it again
+
+    Returns the number of objects that were updated
+    """
+
+    # package import
+    import numpy as np
+    from psycopg2 import sql
+    from psycopg2.extras import execute_values
+
+    add_surface_columns(structure, database_name)
+
+    storage_format = get_storage_format(structure, database_name)
+
+    id_query = sql.SQL("SELECT id FROM {table} WHERE surface IS NULL ORDER BY id;").format(table=sql.Identifier(structure))
+
+    coordinates_query = sql.SQL("SELECT id, {coordinates} FROM {table} WHERE id = ANY(%(ids)s);").format(
+                            coordinates=coordinates_column_sql(storage_format),
+                            table=sql.Identifier(structure))
+
+    update_query = sql.SQL("""UPDATE {table}
+                            SET surface = data.surface, bbox = data.bbox
+                            FROM (VALUES %s) AS data (id, surface, bbox)
+                            WHERE {table}.id = data.id;""").format(table=sql.Identifier(structure))
+
+    surface_template = '(%s, %s::BYTEA, %s::REAL[])' if storage_format == 'compact' else '(%s, %s::REAL[], %s::REAL[])'
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(id_query)
+        object_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+
+    for batch_start in range(0, len(object_ids), batch_size):
+        with database_connection(database_name) as conn:
+            cur = conn.cursor()
+
+            cur.execute(coordinates_query, {'ids': object_ids[batch_start:batch_start + batch_size]})
+
+            surface_rows = []
+            for object_id, coordinates, coordinate_scale in cur.fetchall():
+                coordinates = coordinates_to_array(coordinates, coordinate_scale)
+                surface = extract_surface_array(coordinates)
+                bbox = coordinates.min(axis=0).tolist() + coordinates.max(axis=0).tolist()
+
+                if storage_format == 'compact':
+                    surface = encode_coordinates(surface, coordinate_scale)
+                else:
+                    surface = np.asarray(surface).tolist()
+
+                surface_rows.append((object_id, surface, bbox))
+
+            execute_values(cur, update_query.as_string(conn), surface_rows, template=surface_template, page_size=batch_size)
+
+            cur.close()
+
+        print('Added surfaces for {count} of {total} {structure} objects'.format(count=min(batch_start + batch_size, len(object_ids)), total=len(object_ids), structure=structure))
+
+    return len(object_ids)
+
+def add_distance_columns(structure_1, structure_2, database_name):
+    # package import
+    from psycopg2 import sql
+
+    # create variables that contain the names for the new columns
+    distance_to_structure_2 = 'distance_to_' + structure_2
+    structure_2_id = structure_2 + '_id'
+
+    # update the database
+    query = sql.SQL("ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col_1} REAL, ADD COLUMN IF NOT EXISTS {col_2} INT;").format(
+                            table=sql.Identifier(structure_1),
+                            col_1=sql.Identifier(distance_to_structure_2),
+                            col_2=sql.Identifier(structure_2_id))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+        cur.close()
+
+    # create indexes on tables to speed up distance measurements later
+    structures = [structure_1, structure_2]
+
+    index_columns = ['name', 'id']
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        for structure in structures:
+            for index_column in index_columns:
+                index_name = 'idx_' + structure + '_' + index_column
+
+                create_index_query = sql.SQL("""CREATE INDEX IF NOT EXISTS {index_name} ON {structure}({index_column})""").format(
+                index_name=sql.Identifier(index_name),
+                structure=sql.Identifier(structure),
+                index_column=sql.Identifier(index_column))
+
+                cur.execute(create_index_query)
+
+        cur.close()
+
+    # the distance writes are recorded in the table_changes table (see record_table_changes)
+    create_version_tables(database_name)
+
+    return None
+
+
+def create_version_tables(database_name):
+    """ Creates the data_versions, distance_versions and table_changes tables, if they don't exist
+
+    data_versions holds a version number for each structure and image, which is increased every time objects are inserted or deleted
+    distance_versions holds the structure_1 and structure_2 versions that the distances of each image were measured from
+    table_changes has a row for the last transactions that changed the objects or distances of a structure table (see record_table_changes)
+    The tables are only created once per process and database, since this runs for every batch of inserted objects;
+    create_postgres_table checks again, e.g. after the database was re-created
+
+    Returns nothing
+    """
+
+    if database_name in _version_tables:
+        return
+
+    data_versions_query = """CREATE TABLE IF NOT EXISTS data_versions (
+                            structure TEXT NOT NULL,
+                            image_name TEXT NOT NULL,
+                            version INT NOT NULL DEFAULT 1,
+                            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            PRIMARY KEY (structure, image_name));"""
+
+    distance_versions_query = """CREATE TABLE IF NOT EXISTS distance_versions (
+                            structure_1 TEXT NOT NULL,
+                            structure_2 TEXT NOT NULL,
+                            image_name TEXT NOT NULL,
+                            structure_1_version INT NOT NULL,
+                            structure_2_version INT NOT NULL,
+                            PRIMARY KEY (structure_1, structure_2, image_name));"""
+
+    table_changes_query = """CREATE TABLE IF NOT EXISTS table_changes (
+                            table_name TEXT NOT NULL,
+                            transaction_id BIGINT NOT NULL,
+                            changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            PRIMARY KEY (table_name, transaction_id));"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(data_versions_query)
+        cur.execute(distance_versions_query)
+        cur.execute(table_changes_query)
+        cur.close()
+
+    _version_tables.add(database_name)
+
+    return
+
+def bump_data_versions(cur, structure, image_names):
+    """ Increases the data version of the structure for each image in image_names (see create_version_tables)
+    and records the change of the structure table (see record_table_changes)
+    Takes the cursor of the transaction that changes the objects, so the new version is only saved if the change is
+
+    Returns nothing
+    """
+
+    if not image_names:
+        return
+
+    bump_query = """INSERT INTO data_versions (structure, image_name)
+                    SELECT %(structure)s, image_name FROM UNNEST(%(image_names)s::TEXT[]) AS image_name
+                    ON CONFLICT (structure, image_name) DO UPDATE
+                    SET version = data_versions.version + 1, updated_at = now();"""
+
+    cur.execute(bump_query, {'structure': structure, 'image_names': sorted(image_names)})
+
+    record_table_changes(cur, [structure])
+
+    return
+
+def record_table_changes(cur, tables):
+    """ Adds a row for the current transaction to the table_changes table for each table in tables (see create_version_tables)
+    and deletes the older rows of those tables in the same statement, so each table only keeps a row or two
+    Takes the cursor of the transaction that changes the tables, so the change is only recorded if it is saved
+
+    Every transaction inserts its own row and skips the older rows that another writer is deleting, so concurrent writers never wait for each other
+    The transaction ids that are left are the version stamp of the table for cached results (see table_version_stamp);
+    the id of the last saved change is never deleted by an earlier transaction, so every saved change gives a new stamp
+    Changes made w/ your own SQL (e.g. normalizing intensities in the notebook) should be recorded w/ this function as well
+
+    Returns nothing
+    """
+
+    record_query = """WITH older_changes AS (
+                        DELETE FROM table_changes
+                        WHERE (table_name, transaction_id) IN (SELECT table_name, transaction_id
+                                                                FROM table_changes
+                                                                WHERE table_name = ANY(%(tables)s::TEXT[])
+                                                                AND transaction_id < txid_current()
+                                                                FOR UPDATE SKIP LOCKED))
+                    INSERT INTO table_changes (table_name, transaction_id)
+                    SELECT table_name, txid_current() FROM UNNEST(%(tables)s::TEXT[]) AS table_name
+                    ON CONFLICT (table_name, transaction_id) DO NOTHING;"""
+
+    cur.execute(record_query, {'tables': sorted(set(tables))})
+
+    return
+
+def invalidate_stale_distances(structure_1, structure_2, database_name):
+    """ Finds the images where the structure_1 or structure_2 objects have changed (i.e. their data version has increased)
+    since the distances from structure_1 to structure_2 were measured, and sets those distances back to NULL
+    so they are measured again. Images that were never re-ingested keep their distances
+
+    The current data versions are saved w/ record_distance_versions in the same transaction, before anything is measured,
+    so an interrupted measurement can be resumed: its NULL distances are measured on the next run, and the distances
+    that were already written are kept. Objects re-ingested in the meantime get a newer version and are reset on the next run
+
+    Returns a dictionary {image_name: (structure_1 version, structure_2 version)} w/ the current data versions
+    """
+
+    from psycopg2 import sql
+
+    create_version_tables(database_name)
+
+    versions_query = """SELECT current_versions.image_name, current_versions.structure_1_version, current_versions.structure_2_version,
+                        distance_versions.image_name IS NULL
+                        OR distance_versions.structure_1_version <> current_versions.structure_1_version
+                        OR distance_versions.structure_2_version <> current_versions.structure_2_version AS stale
+                        FROM (SELECT image_name,
+                                COALESCE(MAX(version) FILTER (WHERE structure = %(structure_1)s), 0) AS structure_1_version,
+                                COALESCE(MAX(version) FILTER (WHERE structure = %(structure_2)s), 0) AS structure_2_version
+                                FROM data_versions
+                                WHERE structure IN (%(structure_1)s, %(structure_2)s)
+                                GROUP BY image_name) AS current_versions
+                        LEFT JOIN distance_versions
+                        ON distance_versions.structure_1 = %(structure_1)s
+                        AND distance_versions.structure_2 = %(structure_2)s
+                        AND distance_versions.image_name = current_versions.image_name;"""
+
+    invalidate_query = sql.SQL("""UPDATE {structure_1}
+                            SET {distance_col} = NULL, {structure_2_id} = NULL
+                            WHERE name = ANY(%(image_names)s)
+                            AND {distance_col} IS NOT NULL;""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier('distance_to_' + structure_2),
+                    structure_2_id=sql.Identifier(structure_2 + '_id'))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(versions_query, {'structure_1': structure_1, 'structure_2': structure_2})
+        version_rows = cur.fetchall()
+
+        stale_image_names = [row[0] for row in version_rows if row[3]]
+
+        cur.execute(invalidate_query, {'image_names': stale_image_names})
+        invalidated_count = cur.rowcount
+
+        if invalidated_count:
+            record_table_changes(cur, [structure_1])
+
+        record_distance_versions(cur, structure_1, structure_2, {row[0]: (row[1], row[2]) for row in version_rows if row[3]})
+
+        cur.close()
+
+    if invalidated_count:
+        print('Reset {count} {structure_1} distances to {structure_2} in images w/ changed data'.format(count=invalidated_count, structure_1=structure_1, structure_2=structure_2))
+
+    return {row[0]: (row[1], row[2]) for row in version_rows}
+
+def record_distance_versions(cur, structure_1, structure_2, data_versions):
+    """ Takes a dictionary {image_name: (structure_1 version, structure_2 version)} of data versions
+
+    Saves the data versions that the structure_1 to structure_2 distances of each image are measured from
+    Takes the cursor of the transaction that resets the stale distances (see invalidate_stale_distances)
+    If objects are re-ingested later, the saved version is older than the data, so the next
+    invalidate_stale_distances resets them
+
+    Returns nothing
+    """
+
+    from psycopg2.extras import execute_values
+
+    record_query = """INSERT INTO distance_versions (structure_1, structure_2, image_name, structure_1_version, structure_2_version)
+                    VALUES %s
+                    ON CONFLICT (structure_1, structure_2, image_name) DO UPDATE
+                    SET structure_1_version = EXCLUDED.structure_1_version, structure_2_version = EXCLUDED.structure_2_version;"""
+
+    execute_values(cur, record_query, [(structure_1, structure_2, image_name, versions[0], versions[1]) for image_name, versions in data_versions.items()])
+
+    return
+
+def test_data_db(image_name, structure, database_name):
+    """Inputs: string describing the name of an image and a string describing a subcellular structure in that image
+    and the name of the experiment's database
+
+    Tests if any object data for a given structure and image has been inserted into the database
+
+    Returns 'True' if there is 1 or more objects for that structure are in the db
+    Returns 'False' if there are no objects for that structure are in the db
+
+    """
+
+    from psycopg2 import sql
+
+    query = sql.SQL("SELECT * FROM {table} where name = %s").format(
+                            table=sql.Identifier(structure))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(query, (image_name,))
+
+        processed_bool = bool(cur.fetchone())
+
+        cur.close()
+
+    return processed_bool
+
+def select_null_ids(structure_1, distance_col, database_name):
+    from psycopg2 import sql
+
+    structure_1_data_query = sql.SQL("""SELECT id
+                            FROM {structure_1}
+                            WHERE {distance_col} IS NULL;""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier(distance_col))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(structure_1_data_query)
+        structure_1_data_all = cur.fetchall()
+
+        cur.close()
+
+    structure_1_id_ls = [id_tuple[0] for id_tuple in structure_1_data_all]
+
+    return structure_1_id_ls
+
+
+def select_null_image_names(structure_1, distance_col, database_name):
+    """ Returns a list of the image names that have at least one structure_1 object w/o a value in distance_col
+    """
+
+    from psycopg2 import sql
+
+    image_name_query = sql.SQL("""SELECT DISTINCT name
+                            FROM {structure_1}
+                            WHERE {distance_col} IS NULL
+                            ORDER BY name;""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier(distance_col))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(image_name_query)
+        image_name_ls = [name_tuple[0] for name_tuple in cur.fetchall()]
+
+        cur.close()
+
+    return image_name_ls
+
+
+def select_null_object_counts(structure_1, distance_col, database_name):
+    """ Returns a dict mapping each image name w/ structure_1 objects w/o a value in distance_col to the number of those objects
+    distance_col can also be a list of columns; objects w/o a value in any of them are counted
+    """
+
+    from psycopg2 import sql
+
+    distance_cols = [distance_col] if isinstance(distance_col, str) else distance_col
+
+    object_count_query = sql.SQL("""SELECT name, COUNT(*)
+                            FROM {structure_1}
+                            WHERE {null_condition}
+                            GROUP BY name
+                            ORDER BY name;""").format(
+                    structure_1=sql.Identifier(structure_1),
+                    null_condition=sql.SQL(' OR ').join(sql.SQL("{} IS NULL").format(sql.Identifier(col)) for col in distance_cols))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(object_count_query)
+        object_counts = dict(cur.fetchall())
+
+        cur.close()
+
+    return object_counts
+
+
+@instrument_function()
+def measure_distances(structure_measurement_tuple, parallel_processing_bool, database_name, number_centroid_measure, measurement_mode='object', xy_scale=None, z_scale=None,
+                      processes=None, chunksize=None, flush_size=1000, candidate_mode='centroid'):
+
+    """ This function measures the distances between two structures, defined within a tuple with form
+    (structure_1, structure_2)
+
+    If parallel_processing_bool is True, then the distances will be measured using parallel processing
+    Otherwise, one object (or one image) is measured at a time
+    The work is split into one task per image and run w/ schedule_measurement_tasks; processes (default: number of cpus - 1)
+    and chunksize (the number of images sent to a process at a time) are passed to it
+    The distances are written to the database in batches of flush_size objects (see write_distance_results)
+
+    The number_centroid_measure will determine how many structure 2 objects are measured using surface to surface coordinates
+    For the 'image' and 'queue' modes, candidate_mode = 'bound' instead measures the structure 2 objects in order of their bounding box distance
+    until no closer object is possible, which always finds the closest structure 2 object (see measure_image_objects)
+
+    The measurement_mode determines how work is divided:
+    'object' - each structure 1 object is loaded, measured and updated in the database on its own
+    'image' - all structure 1 and structure 2 objects for an image are loaded at once, measured in memory
+    and written back to the database in one batch (see measure_distances_by_image)
+    'edt' - like 'image', but the distances are read off one Euclidean distance transform per image
+    (see measure_image_objects_edt). This mode is exact, ignores number_centroid_measure and requires
+    the xy_scale and z_scale that were used to extract the objects
+    'queue' - like 'image', but the images are added as jobs to the distance_jobs table (see enqueue_distance_jobs)
+    and measured by workers that claim them (see run_distance_worker). Workers on other hosts can help by running
+    run_distance_worker against the same database, and interrupted measurements are resumed on the next run
+
+    Distances in images where the structure_1 or structure_2 objects were re-ingested (or deleted) since they were measured
+    are reset and measured again (see invalidate_stale_distances)
+
+    Returns None
+    """
+
+    # unpack the structure_measurement_tuple
+    structure_1 = structure_measurement_tuple[0]
+    structure_2 = structure_measurement_tuple[1]
+
+    # add distance columns to the database and create database indexes
+    add_distance_columns(structure_1, structure_2, database_name)
+
+    distance_col = 'distance_to_' + structure_2
+
+    if candidate_mode not in ('centroid', 'bound'):
+        raise ValueError("candidate_mode must be 'centroid' or 'bound', not {mode}".format(mode=candidate_mode))
+
+    if candidate_mode == 'bound' and measurement_mode not in ('image', 'queue'):
+        raise ValueError("candidate_mode 'bound' requires measurement_mode 'image' or 'queue'")
+
+    if measurement_mode not in ('object', 'image', 'edt', 'queue'):
+        raise ValueError("measurement_mode must be 'object', 'image', 'edt' or 'queue', not {mode}".format(mode=measurement_mode))
+
+    # reset the distances in images whose data changed since they were measured
+    invalidate_stale_distances(structure_1, structure_2, database_name)
+
+    if measurement_mode in ('image', 'edt'):
+        distance_engine = 'surface'
+
+        if measurement_mode == 'edt':
+            if xy_scale is None or z_scale is None:
+                raise ValueError("measurement_mode 'edt' requires xy_scale and z_scale")
+
+            distance_engine = 'edt'
+
+        # get all images that contain structure 1 objects that haven't been measured
+        object_counts = select_null_object_counts(structure_1, distance_col, database_name)
+
+        measurement_function = measure_distances_by_image
+        argument_tuples = [(image_name, structure_1, structure_2, number_centroid_measure, database_name, distance_engine, xy_scale, z_scale, flush_size, candidate_mode)
+                           for image_name in object_counts]
+        task_sizes = list(object_counts.values())
+
+    elif measurement_mode == 'object':
+        # get all structure 1 ids that haven't been measured, together with the closest structure 2 ids by centroid distance
+        # this uses one KD-tree per image instead of measuring every centroid pair for every object
+        closest_structure_2_by_image = select_closest_structure_2_ids(structure_1, structure_2, number_centroid_measure, database_name, by_image_bool=True)
+
+        # the objects are still measured one at a time, but sent to the processes in one task per image
+        measurement_function = measure_distances_by_obj_shard
+        argument_tuples = [(closest_structure_2_by_id, structure_1, structure_2, number_centroid_measure, database_name, flush_size)
+                           for closest_structure_2_by_id in closest_structure_2_by_image.values()]
+        task_sizes = [len(closest_structure_2_by_id) for closest_structure_2_by_id in closest_structure_2_by_image.values()]
+
+    elif measurement_mode == 'queue':
+        import functools
+        import multiprocessing as mp
+
+        # add a job for each image w/ unmeasured objects; every worker claims jobs until none are left
+        enqueue_distance_jobs(structure_1, structure_2, database_name)
+
+        worker_count = 1
+        if parallel_processing_bool:
+            worker_count = processes or max(1, mp.cpu_count() - 1)
+
+        measurement_function = functools.partial(run_distance_worker, flush_size=flush_size, candidate_mode=candidate_mode)
+        argument_tuples = [(structure_1, structure_2, number_centroid_measure, database_name)] * worker_count
+
+        # the number of images each worker measures is not known in advance
+        task_sizes = [None] * worker_count
+
+    schedule_measurement_tasks(measurement_function, argument_tuples, task_sizes, parallel_processing_bool, processes=processes, chunksize=chunksize)
+
+    return None
+
+
+def run_measurement_task(task):
+    """ Takes a tuple of (task index, function, argument tuple); used by schedule_measurement_tasks
+
+    Returns a tuple of (task index, the function's return value, the wall time of the task in seconds)
+    """
+
+    import time
+
+    task_idx, measurement_function, argument_tuple = task
+
+    task_start = time.perf_counter()
+
+    with instrument_stage('measurement_task'):
+        result = measurement_function(*argument_tuple)
+
+    return task_idx, result, time.perf_counter() - task_start
+
+
+def schedule_measurement_tasks(measurement_function, argument_tuples, task_sizes, parallel_processing_bool, processes=None, chunksize=None, report_seconds=10):
+    """ Runs measurement_function once for each argument tuple, e.g. once per image
+
+    task_sizes is the number of objects in each task (or None if unknown); the largest tasks are started first, and the
+    number of measured objects, the throughput (objects/s) and the estimated time remaining are printed every report_seconds
+
+    If parallel_processing_bool is True, the tasks are run on a pool of processes (default: number of cpus - 1)
+    Results are streamed back w/ imap_unordered, chunksize tasks at a time (default: about 4 chunks per process)
+    The pool is closed and joined when all tasks are done, or terminated if a task raises an error
+    While instrumentation is enabled, the time the processes spent on tasks and the time they were available for tasks are counted
+    (measurement_pool_busy_seconds and measurement_pool_capacity_seconds, see aggregate_instrumentation)
+
+    Returns a list of the return values of measurement_function, in the order of argument_tuples
+    """
+
+    # package import
+    import time
+    import multiprocessing as mp
+
+    task_count = len(argument_tuples)
+    known_sizes = [task_size for task_size in task_sizes if task_size is not None]
+    total_size = sum(known_sizes)
+
+    # start the largest tasks first so that one large image doesn't finish long after the others
+    task_order = sorted(range(task_count), key=lambda task_idx: -(task_sizes[task_idx] or 0))
+    tasks = [(task_idx, measurement_function, argument_tuples[task_idx]) for task_idx in task_order]
+
+    results = [None] * task_count
+    progress = {'tasks': 0, 'objects': 0, 'reported_at': time.time()}
+    start_time = time.time()
+
+    def report_progress(task_idx, result, final_bool=False):
+        progress['tasks'] += 1
+        progress['objects'] += task_sizes[task_idx] or 0
+        results[task_idx] = result
+
+        now = time.time()
+        if not final_bool and now - progress['reported_at'] < report_seconds:
+            return
+        progress['reported_at'] = now
+
+        elapsed = max(now - start_time, 1e-9)
+        message = 'Measured {tasks} of {task_count} tasks'.format(tasks=progress['tasks'], task_count=task_count)
+
+        if total_size:
+            objects_per_second = progress['objects'] / elapsed
+            message += ', {objects} of {total_size} objects ({rate:.1f} objects/s'.format(objects=progress['objects'], total_size=total_size, rate=objects_per_second)
+
+            if objects_per_second > 0:
+                remaining_seconds = int(round((total_size - progress['objects']) / objects_per_second))
+                message += ', ETA {hours:d}:{minutes:02d}:{seconds:02d}'.format(hours=remaining_seconds // 3600, minutes=remaining_seconds % 3600 // 60, seconds=remaining_seconds % 60)
+
+            message += ')'
+
+        print(message + ' after {elapsed:.1f} s'.format(elapsed=elapsed))
+
+    # code to process using parallel processing
+    if parallel_processing_bool:
+        if processes is None:
+            processes = max(1, mp.cpu_count() - 1)
+
+        if chunksize is None:
+            chunksize = max(1, task_count // (processes * 4))
+
+        print('Measuring distances with parallel processing ({processes} processes, {chunksize} tasks per chunk)'.format(processes=processes, chunksize=chunksize))
+
+        pool = mp.Pool(processes)
+        pool_start = time.perf_counter()
+
+        try:
+            for completed_count, (task_idx, result, task_seconds) in enumerate(pool.imap_unordered(run_measurement_task, tasks, chunksize), 1):
+                report_progress(task_idx, result, final_bool=completed_count == task_count)
+                count_metric('measurement_pool_busy_seconds', task_seconds)
+
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            count_metric('measurement_pool_capacity_seconds', processes * (time.perf_counter() - pool_start))
+
+    # otherwise iterate over the tasks and process one at a time
+    else:
+        print('Measuring distances without parallel processing')
+
+        for completed_count, task in enumerate(tasks, 1):
+            task_idx, result, task_seconds = run_measurement_task(task)
+            report_progress(task_idx, result, final_bool=completed_count == task_count)
+
+    return results
+
+
+@instrument_function()
+def measure_image_objects(structure_1_data, structure_2_data, number_centroid_measure, structure_1_surfaces=None, structure_2_surfaces=None,
+                          candidate_mode='centroid', structure_2_bounding_boxes=None):
+    """ structure_1_data and structure_2_data are lists of tuples in format [(id, centroid, coordinates)] w/ the objects of one image
+
+    candidate_mode = 'centroid' finds the number_centroid_measure closest structure_2 objects for every structure_1 object with one KD-tree query,
+    then measures surface to surface distances to those candidates
+    candidate_mode = 'bound' visits the structure_2 objects in order of the distance between their bounding boxes, which is a lower bound
+    for the surface distance, and stops once the closest surface distance found is not larger than the next lower bound.
+    This always finds the closest structure_2 object (number_centroid_measure is not used), usually w/ few surface measurements
+    Each structure_2 surface is extracted at most once, no matter how many structure_1 objects it is a candidate for
+    structure_1_surfaces is an optional list w/ the surface coordinates of each structure_1 object (e.g. to reuse them for several structure_2 targets)
+    structure_2_surfaces is an optional dictionary of structure_2 surface coordinates by id (e.g. from the surface column);
+    the coordinates of those objects are not used and may be None
+    structure_2_bounding_boxes is an optional dictionary of structure_2 bounding boxes by id (e.g. from the bbox column, see stored_bounding_boxes);
+    the 'bound' candidate mode computes the boxes of the other objects from their surfaces or coordinates
+
+    Returns a list of tuples in format [(structure_1_id, closest_structure_2_distance, closest_structure_2_id)]
+    """
+
+    # package import
+    import numpy as np
+
+    structure_2_coords = {row[0]: row[2] for row in structure_2_data}
+    structure_2_surface_cache = dict(structure_2_surfaces or {})
+
+    if candidate_mode == 'centroid':
+        centroid_tree, structure_2_ids = build_centroid_tree([(row[0], row[1]) for row in structure_2_data])
+
+        centroids_1 = [row[1] for row in structure_1_data]
+        closest_structure_2_ids = query_closest_structure_2(centroid_tree, structure_2_ids, centroids_1, number_centroid_measure)
+
+    elif candidate_mode == 'bound':
+        structure_2_ids = [row[0] for row in structure_2_data]
+
+        # stored bounding boxes are used where available; otherwise the boxes of precomputed surfaces, since they are smaller to scan
+        stored_boxes = structure_2_bounding_boxes or {}
+        structure_2_bounding_boxes = np.array([stored_boxes[structure_2_id] if structure_2_id in stored_boxes
+                                               else object_bounding_box(structure_2_surface_cache[structure_2_id] if structure_2_id in structure_2_surface_cache
+                                                                        else structure_2_coords[structure_2_id])
+                                               for structure_2_id in structure_2_ids]).reshape(-1, 6)
+
+        # the candidates are ordered per structure_1 object in the loop below
+        closest_structure_2_ids = [structure_2_ids] * len(structure_1_data)
+
+    else:
+        raise ValueError("candidate_mode must be 'centroid' or 'bound', not {mode}".format(mode=candidate_mode))
+
+    distance_results = []
+
+    for idx, (structure_1_row, closest_structure_2) in enumerate(zip(structure_1_data, closest_structure_2_ids)):
+        structure_1_id = structure_1_row[0]
+
+        if structure_1_surfaces is None:
+            surface_coords_1 = extract_surface_array(np.array(structure_1_row[2], dtype=float))
+        else:
+            surface_coords_1 = structure_1_surfaces[idx]
+
+        closest_structure_2_distance = 100000
+        closest_structure_2_id = None
+
+        lower_bounds = None
+        if candidate_mode == 'bound':
+            lower_bounds = bounding_box_distances(object_bounding_box(surface_coords_1), structure_2_bounding_boxes)
+            candidate_order = np.argsort(lower_bounds, kind='stable')
+
+            closest_structure_2 = [closest_structure_2[candidate_idx] for candidate_idx in candidate_order]
+            lower_bounds = lower_bounds[candidate_order]
+
+        for candidate_idx, structure_2_id in enumerate(closest_structure_2):
+            # no remaining candidate can be closer than the closest one found so far
+            if lower_bounds is not None and lower_bounds[candidate_idx] >= closest_structure_2_distance:
+                break
+
+            if structure_2_id not in structure_2_surface_cache:
+                structure_2_surface_cache[structure_2_id] = extract_surface_array(np.array(structure_2_coords[structure_2_id], dtype=float))
+
+            distance_to_structure_1 = minimum_distance_arrays(surface_coords_1, structure_2_surface_cache[structure_2_id])
+
+            if distance_to_structure_1 < closest_structure_2_distance:
+                closest_structure_2_distance = distance_to_structure_1
+                closest_structure_2_id = structure_2_id
+
+        distance_results.append((structure_1_id, closest_structure_2_distance, closest_structure_2_id))
+
+    return distance_results
+
+
+@instrument_function()
+def measure_image_objects_edt(structure_1_data, structure_2_data, xy_scale, z_scale, structure_1_surfaces=None, structure_2_surfaces=None):
+    """ structure_1_data and structure_2_data are lists of tuples in format [(id, centroid, coordinates)] w/ the objects of one image
+
+    Rasterizes the surfaces of the structure_2 objects into a label volume on the bounding box of both structures and computes
+    one anisotropic Euclidean distance transform w/ sampling=(z_scale, xy_scale, xy_scale). The transform returns the
+    index of the nearest structure_2 surface voxel for every voxel, so the minimum distance from the structure_1 surface voxels
+    and the closest structure_2 id of each structure_1 object are read off directly. The cost is linear in the bounding box volume
+    rather than in the number of object pairs, and every structure_2 object is considered (no number_centroid_measure approximation)
+
+    Like measure_image_objects, distances are measured surface to surface between voxel centers, so a structure_1 object inside
+    a structure_2 object (e.g. rna inside a nucleus) gets its distance to the structure_2 surface, not 0
+    structure_1_surfaces and structure_2_surfaces are optional precomputed surfaces, as in measure_image_objects
+
+    Returns a list of tuples in format [(structure_1_id, closest_structure_2_distance, closest_structure_2_id)]
+    """
+
+    # package import
+    import numpy as np
+    from scipy.ndimage import distance_transform_edt
+
+    if not structure_1_data:
+        return []
+
+    if not structure_2_data:
+        return [(row[0], 100000, None) for row in structure_1_data]
+
+    scale = np.array([z_scale, xy_scale, xy_scale])
+
+    if structure_1_surfaces is None:
+        structure_1_surfaces = [extract_surface_array(np.array(row[2], dtype=float)) for row in structure_1_data]
+
+    structure_2_surfaces = structure_2_surfaces or {}
+    structure_2_surfaces = [structure_2_surfaces[row[0]] if row[0] in structure_2_surfaces else extract_surface_array(np.array(row[2], dtype=float))
+                            for row in structure_2_data]
+
+    # convert the scaled surface coordinates back to voxel indices
+    voxels_1 = [np.rint(np.asarray(surface, dtype=float).reshape(-1, 3) / scale).astype(np.int64) for surface in structure_1_surfaces]
+    voxels_2 = [np.rint(np.asarray(surface, dtype=float).reshape(-1, 3) / scale).astype(np.int64) for surface in structure_2_surfaces]
+
+    all_voxels = np.concatenate(voxels_1 + voxels_2)
+    origin = all_voxels.min(axis=0)
+    shape = all_voxels.max(axis=0) - origin + 1
+
+    # label 0 is background, label n is the nth structure_2 object
+    label_volume = np.zeros(shape, dtype=np.int32)
+    for label, structure_2_voxels in enumerate(voxels_2, start=1):
+        structure_2_voxels = structure_2_voxels - origin
+        label_volume[structure_2_voxels[:, 0], structure_2_voxels[:, 1], structure_2_voxels[:, 2]] = label
+
+    # only the nearest voxel indices are kept to halve the memory needed; the distances are recomputed for structure_1 voxels
+    nearest_indices = distance_transform_edt(label_volume == 0, sampling=scale, return_distances=False, return_indices=True)
+
+    structure_2_ids = [row[0] for row in structure_2_data]
+
+    distance_results = []
+
+    for structure_1_row, structure_1_voxels in zip(structure_1_data, voxels_1):
+        structure_1_voxels = structure_1_voxels - origin
+        z, x, y = structure_1_voxels[:, 0], structure_1_voxels[:, 1], structure_1_voxels[:, 2]
+
+        nearest_voxels = nearest_indices[:, z, x, y].T
+        voxel_distances = np.linalg.norm((nearest_voxels - structure_1_voxels) * scale, axis=1)
+
+        closest_voxel = nearest_voxels[np.argmin(voxel_distances)]
+        closest_label = label_volume[closest_voxel[0], closest_voxel[1], closest_voxel[2]]
+
+        distance_results.append((structure_1_row[0], float(voxel_distances.min()), structure_2_ids[closest_label - 1]))
+
+    return distance_results
+
+
+@instrument_function('image_name')
+def measure_distances_by_image(image_name, structure_1, structure_2, number_centroid_measure, database_name, distance_engine='surface', xy_scale=None, z_scale=None,
+                               flush_size=1000, candidate_mode='centroid'):
+    """ This function measures the distance from every unmeasured structure_1 object in one image to the closest structure_2 object
+
+    All structure_1 and structure_2 rows for the image are loaded with one query each, measured in memory
+    and written back to the database in batches of flush_size objects (see write_distance_results)
+
+    distance_engine = 'surface' measures surface to surface distances w/ measure_image_objects
+    distance_engine = 'edt' uses one distance transform per image w/ measure_image_objects_edt, which requires xy_scale and z_scale
+    The 'surface' engine reads the precomputed surface column instead of the full coordinates where it is filled (see add_surface_columns)
+    and chooses the structure_2 candidates w/ candidate_mode ('centroid' or 'bound', see measure_image_objects)
+
+    Returns the number of structure_1 objects that were measured
+    """
+
+    # import packages
+    from psycopg2 import sql
+
+    # name the distance column
+    distance_col = 'distance_to_' + structure_2
+
+    structure_1_columns = surface_column_sql(structure_1, database_name)
+    structure_2_columns = sql.SQL("{columns}, {bbox}").format(columns=surface_column_sql(structure_2, database_name), bbox=bbox_column_sql(structure_2, database_name))
+
+    structure_1_data_query = sql.SQL("""SELECT id, centroid, {columns}
+                            FROM {structure_1}
+                            WHERE {distance_col} IS NULL
+                            AND name = %(image_name)s;""").format(
+                    columns=structure_1_columns,
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier(distance_col))
+
+    structure_2_data_query = sql.SQL("""SELECT id, centroid, {columns}
+                            FROM {structure_2}
+                            WHERE name = %(image_name)s;""").format(
+                    columns=structure_2_columns,
+                    structure_2=sql.Identifier(structure_2))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(structure_1_data_query, {'image_name': image_name})
+        structure_1_data, structure_1_surfaces = image_surface_data(cur.fetchall())
+
+        cur.execute(structure_2_data_query, {'image_name': image_name})
+        structure_2_rows = cur.fetchall()
+
+        cur.close()
+
+    structure_2_data, structure_2_surfaces = image_surface_data([row[:5] for row in structure_2_rows])
+    structure_2_bounding_boxes = stored_bounding_boxes(structure_2_rows)
+
+    print('Measuring distances for {count} {structure_1} objects in {image_name}'.format(count=len(structure_1_data), structure_1=structure_1, image_name=image_name))
+
+    structure_1_surfaces = [structure_1_surfaces[row[0]] if row[0] in structure_1_surfaces else extract_surface_array(row[2]) for row in structure_1_data]
+
+    if distance_engine == 'edt':
+        distance_results = measure_image_objects_edt(structure_1_data, structure_2_data, xy_scale, z_scale,
+                                                     structure_1_surfaces=structure_1_surfaces, structure_2_surfaces=structure_2_surfaces)
+    else:
+        distance_results = measure_image_objects(structure_1_data, structure_2_data, number_centroid_measure,
+                                                 structure_1_surfaces=structure_1_surfaces, structure_2_surfaces=structure_2_surfaces,
+                                                 candidate_mode=candidate_mode, structure_2_bounding_boxes=structure_2_bounding_boxes)
+
+    # now update the database in batches
+    write_distance_results(structure_1, structure_2, distance_results, database_name, flush_size=flush_size)
+
+    return len(distance_results)
+
+
+@instrument_function()
+def measure_distances_to_targets(structure_1, structure_2_list, parallel_processing_bool, database_name, number_centroid_measure, measurement_mode='image',
+                                 xy_scale=None, z_scale=None, processes=None, chunksize=None, flush_size=1000, candidate_mode='centroid'):
+    """ Measures the distances from every structure_1 object to the closest object of each structure in structure_2_list,
+    e.g. measure_distances_to_targets('rna', ['centrosomes', 'nuclei'], ...)
+
+    This gives the same results as calling measure_distances for each (structure_1, structure_2) pair, but each structure_1 object
+    is loaded and its surface extracted once for all of the targets, and all of the distance columns are written together
+    (see measure_distances_by_image_to_targets)
+
+    measurement_mode is 'image' (surface to surface distances) or 'edt' (distance transforms; requires xy_scale and z_scale)
+    parallel_processing_bool, processes, chunksize, flush_size and candidate_mode work as in measure_distances
+
+    Returns None
+    """
+
+    if measurement_mode not in ('image', 'edt'):
+        raise ValueError("measurement_mode must be 'image' or 'edt', not {mode}".format(mode=measurement_mode))
+
+    if measurement_mode == 'edt' and (xy_scale is None or z_scale is None):
+        raise ValueError("measurement_mode 'edt' requires xy_scale and z_scale")
+
+    distance_engine = 'edt' if measurement_mode == 'edt' else 'surface'
+
+    # add distance columns to the database and create database indexes, and reset the distances in images whose data changed
+    for structure_2 in structure_2_list:
+        add_distance_columns(structure_1, structure_2, database_name)
+        invalidate_stale_distances(structure_1, structure_2, database_name)
+
+    # get all images that contain structure 1 objects that haven't been measured for at least one target
+    distance_cols = ['distance_to_' + structure_2 for structure_2 in structure_2_list]
+    object_counts = select_null_object_counts(structure_1, distance_cols, database_name)
+
+    argument_tuples = [(image_name, structure_1, structure_2_list, number_centroid_measure, database_name, distance_engine, xy_scale, z_scale, flush_size, candidate_mode)
+                       for image_name in object_counts]
+    task_sizes = list(object_counts.values())
+
+    schedule_measurement_tasks(measure_distances_by_image_to_targets, argument_tuples, task_sizes, parallel_processing_bool, processes=processes, chunksize=chunksize)
+
+    return None
+
+
+@instrument_function('image_name')
+def measure_distances_by_image_to_targets(image_name, structure_1, structure_2_list, number_centroid_measure, database_name, distance_engine='surface',
+                                          xy_scale=None, z_scale=None, flush_size=1000, candidate_mode='centroid'):
+    """ Like measure_distances_by_image, but measures the structure_1 objects in one image against several structure_2 targets
+
+    The structure_1 objects that are unmeasured for at least one target are loaded w/ one query, and their surfaces are extracted once
+    (or read from the precomputed surface column, see add_surface_columns)
+    Each object is only measured against the targets that it has not been measured for yet
+    The results for all targets are written together w/ write_target_distance_results
+
+    Returns the number of structure_1 objects that were measured
+    """
+
+    # import packages
+    from psycopg2 import sql
+
+    distance_cols = ['distance_to_' + structure_2 for structure_2 in structure_2_list]
+
+    structure_1_data_query = sql.SQL("""SELECT id, centroid, {columns}, {unmeasured_columns}
+                            FROM {structure_1}
+                            WHERE ({null_condition})
+                            AND name = %(image_name)s;""").format(
+                    columns=surface_column_sql(structure_1, database_name),
+                    unmeasured_columns=sql.SQL(', ').join(sql.SQL("{} IS NULL").format(sql.Identifier(col)) for col in distance_cols),
+                    null_condition=sql.SQL(' OR ').join(sql.SQL("{} IS NULL").format(sql.Identifier(col)) for col in distance_cols),
+                    structure_1=sql.Identifier(structure_1))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute(structure_1_data_query, {'image_name': image_name})
+        structure_1_rows = cur.fetchall()
+
+        structure_2_data_list = []
+
+        for structure_2 in structure_2_list:
+            structure_2_data_query = sql.SQL("""SELECT id, centroid, {columns}, {bbox}
+                                    FROM {structure_2}
+                                    WHERE name = %(image_name)s;""").format(
+                            columns=surface_column_sql(structure_2, database_name),
+                            bbox=bbox_column_sql(structure_2, database_name),
+                            structure_2=sql.Identifier(structure_2))
+
+            cur.execute(structure_2_data_query, {'image_name': image_name})
+            structure_2_rows = cur.fetchall()
+            structure_2_data_list.append(image_surface_data([row[:5] for row in structure_2_rows]) + (stored_bounding_boxes(structure_2_rows),))
+
+        cur.close()
+
+    structure_1_data, structure_1_surfaces = image_surface_data([row[:5] for row in structure_1_rows])
+    unmeasured_targets = [row[5:] for row in structure_1_rows]
+
+    print('Measuring distances for {count} {structure_1} objects in {image_name} to {targets}'.format(
+        count=len(structure_1_data), structure_1=structure_1, image_name=image_name, targets=', '.join(structure_2_list)))
+
+    # extract the structure 1 surfaces once for all of the targets
+    structure_1_surfaces = [structure_1_surfaces[row[0]] if row[0] in structure_1_surfaces else extract_surface_array(row[2]) for row in structure_1_data]
+
+    # one row per object: (structure_1 id, distance, structure_2 id, distance, structure_2 id, ...), None for targets that are already measured
+    distance_rows = {row[0]: [row[0]] + [None] * (2 * len(structure_2_list)) for row in structure_1_data}
+
+    for target_idx, (structure_2_data, structure_2_surfaces, structure_2_bounding_boxes) in enumerate(structure_2_data_list):
+        target_rows = [idx for idx, unmeasured in enumerate(unmeasured_targets) if unmeasured[target_idx]]
+
+        if not target_rows:
+            continue
+
+        target_structure_1_data = [structure_1_data[idx] for idx in target_rows]
+
+        if distance_engine == 'edt':
+            distance_results = measure_image_objects_edt(target_structure_1_data, structure_2_data, xy_scale, z_scale,
+                                                         structure_1_surfaces=[structure_1_surfaces[idx] for idx in target_rows],
+                                                         structure_2_surfaces=structure_2_surfaces)
+        else:
+            distance_results = measure_image_objects(target_structure_1_data, structure_2_data, number_centroid_measure,
+                                                     structure_1_surfaces=[structure_1_surfaces[idx] for idx in target_rows],
+                                                     structure_2_surfaces=structure_2_surfaces,
+                                                     candidate_mode=candidate_mode, structure_2_bounding_boxes=structure_2_bounding_boxes)
+
+        for structure_1_id, closest_structure_2_distance, closest_structure_2_id in distance_results:
+            distance_rows[structure_1_id][1 + 2 * target_idx] = closest_structure_2_distance
+            distance_rows[structure_1_id][2 + 2 * target_idx] = closest_structure_2_id
+
+    # now update the database in batches
+    write_target_distance_results(structure_1, structure_2_list, list(distance_rows.values()), database_name, flush_size=flush_size)
+
+    return len(structure_1_data)
+
+
+def measure_distances_by_obj_shard(closest_structure_2_by_id, structure_1, structure_2, number_centroid_measure, database_name, flush_size=1000):
+    """ Measures a shard of structure_1 objects (e.g. the unmeasured objects of one image) one at a time w/ measure_distance_by_obj
+
+    closest_structure_2_by_id maps each structure_1 id to the closest structure_2 ids by centroid (see select_closest_structure_2_ids)
+    The results are buffered and written w/ write_distance_results every flush_size objects
+
+    Returns the number of structure_1 objects that were measured
+    """
+
+    distance_results = []
+
+    for structure_1_id, closest_structure_2 in closest_structure_2_by_id.items():
+        distance_results.append(measure_distance_by_obj(structure_1_id, structure_1, structure_2, number_centroid_measure, database_name, closest_structure_2, write_bool=False))
+
+        if len(distance_results) >= flush_size:
+            write_distance_results(structure_1, structure_2, distance_results, database_name, flush_size=flush_size)
+            distance_results = []
+
+    write_distance_results(structure_1, structure_2, distance_results, database_name, flush_size=flush_size)
+
+    return len(closest_structure_2_by_id)
+
+@instrument_function()
+def write_distance_results(structure_1, structure_2, distance_results, database_name, flush_size=1000):
+    """ Takes a list of (structure_1 id, distance, closest structure_2 id) tuples
+
+    Writes the results to the distance_to_<structure_2> and <structure_2>_id columns in batches of flush_size rows
+    (see write_target_distance_results)
+
+    Returns nothing
+    """
+
+    write_target_distance_results(structure_1, [structure_2], distance_results, database_name, flush_size=flush_size)
+
+    return
+
+@instrument_function()
+def write_target_distance_results(structure_1, structure_2_list, distance_rows, database_name, flush_size=1000):
+    """ Takes a list of (structure_1 id, distance, closest structure_2 id, distance, closest structure_2 id, ...) tuples,
+    w/ one distance and id for each structure_2 in structure_2_list. None means that the target was not measured
+
+    Writes the results to the distance_to_<structure_2> and <structure_2>_id columns of every target in batches of flush_size rows.
+    Each batch is copied into a temporary staging table (w/ COPY) and applied w/ one UPDATE ... FROM the staging table,
+    in one transaction per batch. Columns w/o a new value keep their current value
+    If a batch fails, none of its rows are updated, so those objects are still unmeasured (NULL)
+    and are measured again the next time measure_distances is run
+
+    Returns nothing
+    """
+
+    # package import
+    import io
+    from psycopg2 import sql
+
+    staging_columns = []
+    for target_idx in range(len(structure_2_list)):
+        staging_columns.append(('distance_' + str(target_idx), 'REAL'))
+        staging_columns.append(('id_' + str(target_idx), 'INT'))
+
+    # temporary tables are not written to the WAL; it is dropped at the end of each batch's transaction
+    staging_table_query = sql.SQL("""CREATE TEMPORARY TABLE distance_staging (
+                                structure_1_id INT,
+                                {staging_columns}) ON COMMIT DROP;""").format(
+                                staging_columns=sql.SQL(', ').join(sql.SQL("{} " + column_type).format(sql.Identifier(column_name)) for column_name, column_type in staging_columns))
+
+    copy_staging_query = "COPY distance_staging FROM STDIN"
+
+    set_columns = []
+    for target_idx, structure_2 in enumerate(structure_2_list):
+        set_columns.append(sql.SQL("{distance_col} = COALESCE(distance_staging.{staging_distance}, {structure_1}.{distance_col})").format(
+                                structure_1=sql.Identifier(structure_1),
+                                distance_col=sql.Identifier('distance_to_' + structure_2),
+                                staging_distance=sql.Identifier('distance_' + str(target_idx))))
+        set_columns.append(sql.SQL("{structure_2_id} = COALESCE(distance_staging.{staging_id}, {structure_1}.{structure_2_id})").format(
+                                structure_1=sql.Identifier(structure_1),
+                                structure_2_id=sql.Identifier(structure_2 + '_id'),
+                                staging_id=sql.Identifier('id_' + str(target_idx))))
+
+    update_distance_query = sql.SQL("""UPDATE {structure_1}
+                                        SET {set_columns}
+                                        FROM distance_staging
+                                        WHERE {structure_1}.id = distance_staging.structure_1_id;""").format(
+                                structure_1=sql.Identifier(structure_1),
+                                set_columns=sql.SQL(', ').join(set_columns))
+
+    for batch_start in range(0, len(distance_rows), flush_size):
+        buffer = io.StringIO()
+
+        for distance_row in distance_rows[batch_start:batch_start + flush_size]:
+            row = [str(int(distance_row[0]))]
+
+            for closest_structure_2_distance, closest_structure_2_id in zip(distance_row[1::2], distance_row[2::2]):
+                row.append('\\N' if closest_structure_2_distance is None else repr(float(closest_structure_2_distance)))
+                row.append('\\N' if closest_structure_2_id is None else str(int(closest_structure_2_id)))
+
+            buffer.write('\t'.join(row) + '\n')
+
+        buffer.seek(0)
+
+        with database_connection(database_name) as conn:
+            cur = conn.cursor()
+
+            cur.execute(staging_table_query)
+            cur.copy_expert(copy_staging_query, buffer)
+            cur.execute(update_distance_query)
+            record_table_changes(cur, [structure_1])
+
+            cur.close()
+
+    return
+
+@instrument_function()
+def measure_distance_by_obj(obj_id, structure_1, structure_2, number_centroid_measure, database_name, closest_structure_2=None, write_bool=True):
+
+    """ This function takes an object id from the structure_1 table. It will measure the distance from that object
+    to the closest structure_2 object.
+
+    The number_centroid_measure is the number of structure_2 objects to use to perform surface to surface distance measurements for this structure 1 object
+
+    closest_structure_2 is an optional tuple of candidate structure_2 ids (e.g. from select_closest_structure_2_ids)
+    If it is None, the candidates are found by measuring centroid to centroid distances for this object
+
+    It then updates the database with the closest structure_2 id
+    If write_bool is False, the database is not updated, so the result can be written in a batch w/ write_distance_results
+    The update is not recorded in the table_changes table, so that measuring an object stays a single statement;
+    call record_table_changes once after measuring a batch of objects this way (write_distance_results records its own batches)
+
+    Returns a tuple of (structure_1 id, distance, closest structure_2 id)
+
+    """
+
+    # import packages
+    from psycopg2 import sql
+    import numpy as np
+
+    # name the distance column
+    distance_col = 'distance_to_' + structure_2
+
+    # these queries run once per object, so they are executed as prepared statements w/ $n placeholders
+    structure_1_data_query = sql.SQL("""SELECT name, id, centroid, {columns}
+                            FROM {structure_1}
+                            WHERE {distance_col} IS NULL
+                            AND id = $1;""").format(
+                    columns=surface_column_sql(structure_1, database_name),
+                    structure_1=sql.Identifier(structure_1),
+                    distance_col=sql.Identifier(distance_col))
+
+    structure_2_centroid_query = sql.SQL("""SELECT id, centroid
+                                FROM {structure_2}
+                                WHERE name = $1""").format(
+                        structure_2=sql.Identifier(structure_2))
+
+    structure_2_coords_query = sql.SQL("SELECT id, {columns} FROM {structure_2} WHERE id = ANY($1);").format(
+                                        columns=surface_column_sql(structure_2, database_name),
+                                        structure_2=sql.Identifier(structure_2))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        # first get the null values for this object
+        execute_prepared(cur, structure_1_data_query, (obj_id,))
+        structure_1_data = cur.fetchall()[0]
+
+        # unpack the structure 1 data
+
+        image_name = structure_1_data[0]
+        structure_1_id = structure_1_data[1]
+        centroid_1 = np.array(structure_1_data[2])
+
+        if closest_structure_2 is None:
+            # get all structure 2 centroids for that image
+            execute_prepared(cur, structure_2_centroid_query, (image_name,))
+
+            structure_2_centroid_data = cur.fetchall()
+
+            # measure centroid to centroid distances
+            closest_structure_2 = centroid_measurements_closest_structure_2(centroid_1, structure_2_centroid_data, number_centroid_measure)
+
+        # now get the surface coordinates for those structure 2 ids
+        structure_2_coord_data = []
+
+        if closest_structure_2:
+            execute_prepared(cur, structure_2_coords_query, (list(closest_structure_2),))
+
+            structure_2_coord_data = cur.fetchall()
+
+        cur.close()
+
+    # prepare the coordinates for object 1 for distance measurements
+
+    surface_coords_1 = object_surface_array(structure_1_data[3], structure_1_data[4], structure_1_data[5])
+
+    closest_structure_2_distance = 100000
+    closest_structure_2_id = None
+
+    # now iterate over structure 2 coords
+    for id_coord_row in structure_2_coord_data:
+        structure_2_id = id_coord_row[0]
+
+        surface_coords_2 = object_surface_array(id_coord_row[1], id_coord_row[2], id_coord_row[3])
+
+        distance_to_structure_1 = minimum_distance_arrays(surface_coords_1, surface_coords_2)
+
+        if distance_to_structure_1 < closest_structure_2_distance:
+            closest_structure_2_distance = distance_to_structure_1
+            closest_structure_2_id = structure_2_id
+
+    if not write_bool:
+        return (structure_1_id, closest_structure_2_distance, closest_structure_2_id)
+
+    # now update the database
+    update_distance_query = sql.SQL("""UPDATE {structure_1}
+                                        SET {distance_col} = $1,
+                                        {structure_2_id} = $2
+                                        WHERE id = $3;""").format(
+                                structure_1=sql.Identifier(structure_1),
+                                distance_col=sql.Identifier(distance_col),
+                                structure_2_id=sql.Identifier(structure_2 + '_id'))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        execute_prepared(cur, update_distance_query, (closest_structure_2_distance, closest_structure_2_id, structure_1_id))
+
+        cur.close()
+
+    return (structure_1_id, closest_structure_2_distance, closest_structure_2_id)
+
+def create_distance_jobs_table(database_name):
+    """ Creates the distance_jobs table, if it doesn't exist
+
+    Each row is one image to measure for a (structure_1, structure_2) pair. Workers claim jobs by setting status = 'running'
+    and a lease (lease_expires_at) that they renew w/ heartbeats; a job whose lease has expired can be claimed by another worker
+
+    Returns nothing
+    """
+
+    jobs_table_query = """CREATE TABLE IF NOT EXISTS distance_jobs (
+                            id SERIAL PRIMARY KEY,
+                            structure_1 TEXT NOT NULL,
+                            structure_2 TEXT NOT NULL,
+                            image_name TEXT NOT NULL,
+                            status TEXT NOT NULL DEFAULT 'pending',
+                            attempts INT NOT NULL DEFAULT 0,
+                            worker_id TEXT,
+                            lease_expires_at TIMESTAMPTZ,
+                            heartbeat_at TIMESTAMPTZ,
+                            object_count INT,
+                            error TEXT,
+                            UNIQUE (structure_1, structure_2, image_name));"""
+
+    jobs_index_query = """CREATE INDEX IF NOT EXISTS distance_jobs_status_idx ON distance_jobs (structure_1, structure_2, status);"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(jobs_table_query)
+        cur.execute(jobs_index_query)
+        cur.close()
+
+    return
+
+def enqueue_distance_jobs(structure_1, structure_2, database_name, retry_failed_bool=False):
+    """ Adds a pending job to the distance_jobs table for every image w/ unmeasured structure_1 objects
+
+    Images that already have a job are left alone, unless the job is 'done' (i.e. new unmeasured objects were added since)
+    or, if retry_failed_bool = True, 'failed'
+
+    Returns the number of jobs that were added or reset to pending
+    """
+
+    from psycopg2 import sql
+    from psycopg2.extras import execute_values
+
+    create_distance_jobs_table(database_name)
+
+    image_name_ls = select_null_image_names(structure_1, 'distance_to_' + structure_2, database_name)
+
+    reset_statuses = ['done', 'failed'] if retry_failed_bool else ['done']
+
+    enqueue_query = sql.SQL("""INSERT INTO distance_jobs (structure_1, structure_2, image_name)
+                            VALUES %s
+                            ON CONFLICT (structure_1, structure_2, image_name) DO UPDATE
+                            SET status = 'pending', attempts = 0, worker_id = NULL, lease_expires_at = NULL, error = NULL
+                            WHERE distance_jobs.status = ANY({reset_statuses})
+                            RETURNING id;""").format(
+                    reset_statuses=sql.Literal(reset_statuses))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        job_ids = execute_values(cur, enqueue_query.as_string(conn), [(structure_1, structure_2, image_name) for image_name in image_name_ls], fetch=True)
+        cur.close()
+
+    return len(job_ids)
+
+def claim_distance_jobs(structure_1, structure_2, worker_id, database_name, batch_size=1, lease_seconds=300, max_attempts=3):
+    """ Claims up to batch_size jobs for worker_id
+
+    A job can be claimed if it is pending, or if it is running but its lease has expired (e.g. the worker crashed)
+    Jobs are locked w/ SELECT ... FOR UPDATE SKIP LOCKED, so workers on any number of processes or hosts never claim the same job
+    Running jobs w/ an expired lease that have been attempted max_attempts times are marked as failed instead
 
+    Returns a list of (job id, image name) tuples
     """
 
-    # import packages
-    import psycopg2
-    from psycopg2 import sql
-    import os
-    import numpy as np
+    fail_expired_query = """UPDATE distance_jobs
+                            SET status = 'failed', error = COALESCE(error, 'lease expired')
+                            WHERE structure_1 = %(structure_1)s AND structure_2 = %(structure_2)s
+                            AND status = 'running' AND lease_expires_at < now()
+                            AND attempts >= %(max_attempts)s;"""
 
-    # name the distance column
-    distance_col = 'distance_to_' + structure_2
+    claim_query = """UPDATE distance_jobs
+                    SET status = 'running', worker_id = %(worker_id)s, attempts = attempts + 1,
+                    lease_expires_at = now() + make_interval(secs => %(lease_seconds)s), heartbeat_at = now()
+                    WHERE id IN (SELECT id
+                                FROM distance_jobs
+                                WHERE structure_1 = %(structure_1)s AND structure_2 = %(structure_2)s
+                                AND (status = 'pending' OR (status = 'running' AND lease_expires_at < now()))
+                                AND attempts < %(max_attempts)s
+                                ORDER BY id
+                                LIMIT %(batch_size)s
+                                FOR UPDATE SKIP LOCKED)
+                    RETURNING id, image_name;"""
 
-    # first get all null values
-    structure_1_data_query = sql.SQL("""SELECT name, id, centroid, coordinates
-                            FROM {structure_1}
-                            WHERE {distance_col} IS NULL
-                            AND id = %(obj_id)s;""").format(
-                    structure_1=sql.Identifier(structure_1),
-                    distance_col=sql.Identifier(distance_col))
+    claim_params = {'structure_1': structure_1, 'structure_2': structure_2, 'worker_id': worker_id,
+                    'lease_seconds': lease_seconds, 'max_attempts': max_attempts, 'batch_size': batch_size}
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
 
-    cur.execute(structure_1_data_query, {'obj_id': obj_id})
-    structure_1_data = cur.fetchall()[0]
+        cur.execute(fail_expired_query, claim_params)
+        cur.execute(claim_query, claim_params)
+        claimed_jobs = sorted(cur.fetchall())
 
-    cur.close()
-    conn.close()
+        cur.close()
 
-    # unpack the structure 1 data
+    return claimed_jobs
 
-    image_name = structure_1_data[0]
-    structure_1_id = structure_1_data[1]
-    centroid_1 = np.array(structure_1_data[2])
-    coords_1 = structure_1_data[3]
+def heartbeat_distance_jobs(job_ids, worker_id, database_name, lease_seconds=300):
+    """ Renews the lease of the running jobs in job_ids that are held by worker_id
 
-    # get all structure 2 centroids for that image
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    Returns the ids of the jobs that are still held by worker_id
+    """
 
-    structure_2_centroid_query = sql.SQL("""SELECT id, centroid
-                                FROM {structure_2}
-                                WHERE name = %(image_name)s""").format(
-                        structure_2=sql.Identifier(structure_2))
+    heartbeat_query = """UPDATE distance_jobs
+                        SET lease_expires_at = now() + make_interval(secs => %(lease_seconds)s), heartbeat_at = now()
+                        WHERE id = ANY(%(job_ids)s) AND worker_id = %(worker_id)s AND status = 'running'
+                        RETURNING id;"""
 
-    cur.execute(structure_2_centroid_query, {'image_name': image_name})
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(heartbeat_query, {'job_ids': list(job_ids), 'worker_id': worker_id, 'lease_seconds': lease_seconds})
+        held_job_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
 
-    structure_2_centroid_data = cur.fetchall()
+    return held_job_ids
 
-    cur.close()
-    conn.close()
+def finish_distance_job(job_id, worker_id, database_name, object_count=None, error=None, max_attempts=3):
+    """ Marks a job held by worker_id as 'done', or records the error
+    A job w/ an error goes back to 'pending' so it can be retried, unless it has been attempted max_attempts times ('failed')
 
-    # measure centroid to centroid distances
-    closest_structure_2 = centroid_measurements_closest_structure_2(centroid_1, structure_2_centroid_data, number_centroid_measure)
+    Returns nothing
+    """
 
-    # now get the surface coordinates for those structure 2 ids
-    structure_2_coords_query = sql.SQL("SELECT id, coordinates FROM {structure_2} WHERE id IN %(id)s;").format(
-                                        structure_2=sql.Identifier(structure_2))
+    finish_query = """UPDATE distance_jobs
+                    SET status = CASE WHEN %(error)s::TEXT IS NULL THEN 'done'
+                                      WHEN attempts >= %(max_attempts)s THEN 'failed'
+                                      ELSE 'pending' END,
+                    object_count = %(object_count)s, error = %(error)s, lease_expires_at = NULL
+                    WHERE id = %(job_id)s AND worker_id = %(worker_id)s AND status = 'running';"""
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(finish_query, {'job_id': job_id, 'worker_id': worker_id, 'object_count': object_count, 'error': error, 'max_attempts': max_attempts})
+        cur.close()
 
-    cur.execute(structure_2_coords_query, {'id': closest_structure_2})
+    return
 
-    structure_2_coord_data = cur.fetchall()
-    cur.close()
-    conn.close()
+@instrument_function()
+def run_distance_worker(structure_1, structure_2, number_centroid_measure, database_name, distance_engine='surface', xy_scale=None, z_scale=None,
+                        worker_id=None, batch_size=1, lease_seconds=300, heartbeat_seconds=60, max_attempts=3, flush_size=1000, candidate_mode='centroid'):
+    """ Claims jobs from the distance_jobs table and measures them w/ measure_distances_by_image until no jobs are left to claim
 
-    # prepare the coordinates for object 1 for distance measurements
+    Any number of workers can run at the same time, in other processes or on other hosts that connect to the same database
+    (see enqueue_distance_jobs to add the jobs). While a batch of jobs is measured, a background thread renews
+    their lease every heartbeat_seconds. If a worker stops, its jobs are claimed again by another worker once the lease expires
+    Re-measuring an image only updates the objects that are still unmeasured, so resuming a job is safe
 
-    surface_coords_1 = extract_surface_coordinates(coords_1)
-    surface_coords_1 = [np.array(coord) for coord in surface_coords_1]
+    worker_id defaults to <hostname>-<process id>
+    flush_size and candidate_mode are passed to measure_distances_by_image
 
-    closest_structure_2_distance = 100000
-    closest_structure_2_id = None
+    Returns the number of jobs that were completed by this worker
+    """
 
-    # now iterate over structure 2 coords
-    for id_coord_row in structure_2_coord_data:
-        structure_2_id = id_coord_row[0]
-        coords_2 = id_coord_row[1]
+    # package import
+    import os
+    import socket
+    import threading
 
-        surface_coords_2 = extract_surface_coordinates(coords_2)
-        surface_coords_2 = [np.array(coord) for coord in surface_coords_2]
+    if worker_id is None:
+        worker_id = '{host}-{pid}'.format(host=socket.gethostname(), pid=os.getpid())
 
-        distance_to_structure_1 = minimum_distance(surface_coords_1, surface_coords_2)
+    create_distance_jobs_table(database_name)
 
-        if distance_to_structure_1 < closest_structure_2_distance:
-            closest_structure_2_distance = distance_to_structure_1
-            closest_structure_2_id = structure_2_id
+    completed_job_count = 0
 
-    # now update the database
-    update_distance_query = sql.SQL("""UPDATE {structure_1}
-                                        SET {distance_col} = %(closest_structure_2_distance)s,
-                                        {structure_2_id} = %(closest_structure_2_id)s
-                                        WHERE id = %(structure_1_id)s;""").format(
-                                structure_1=sql.Identifier(structure_1),
-                                distance_col=sql.Identifier(distance_col),
-                                structure_2_id=sql.Identifier(structure_2 + '_id'))
+    while True:
+        claimed_jobs = claim_distance_jobs(structure_1, structure_2, worker_id, database_name, batch_size=batch_size, lease_seconds=lease_seconds, max_attempts=max_attempts)
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+        if not claimed_jobs:
+            break
 
-    cur.execute(update_distance_query, {'closest_structure_2_distance': closest_structure_2_distance,
-                                       'closest_structure_2_id': closest_structure_2_id,
-                                        'structure_1_id': structure_1_id})
-    conn.commit()
+        # renew the leases of the claimed jobs in the background while they are measured
+        stop_heartbeat = threading.Event()
 
-    cur.close()
-    conn.close()
+        def send_heartbeats(job_ids=[job[0] for job in claimed_jobs]):
+            while not stop_heartbeat.wait(heartbeat_seconds):
+                heartbeat_distance_jobs(job_ids, worker_id, database_name, lease_seconds=lease_seconds)
 
-    return None
+        heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            for job_id, image_name in claimed_jobs:
+                try:
+                    object_count = measure_distances_by_image(image_name, structure_1, structure_2, number_centroid_measure, database_name,
+                                                              distance_engine=distance_engine, xy_scale=xy_scale, z_scale=z_scale, flush_size=flush_size,
+                                                              candidate_mode=candidate_mode)
+                except Exception as error:
+                    print('{worker_id} could not measure {image_name}: {error}'.format(worker_id=worker_id, image_name=image_name, error=repr(error)))
+                    finish_distance_job(job_id, worker_id, database_name, error=repr(error), max_attempts=max_attempts)
+                else:
+                    finish_distance_job(job_id, worker_id, database_name, object_count=object_count, max_attempts=max_attempts)
+                    completed_job_count += 1
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+    return completed_job_count
 
 def delete_data_db(image_name, structure, database_name):
     """Inputs: string describing the name of an image and a string describing a subcellular structure in that image
-    and a connection object
+    and the name of the experiment's database
 
     Deletes all the data in the structure table for that name; use this to re-process data / avoid
     appending duplicate objects
+    The structure's data version for the image is increased, so distances that depend on it are measured again (see invalidate_stale_distances)
 
     Returns None
     """
 
-    import psycopg2
     from psycopg2 import sql
-    import os
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    create_version_tables(database_name)
+
     query = sql.SQL("DELETE FROM {table} where name = %s").format(
                             table=sql.Identifier(structure))
 
-    cur.execute(query, (image_name,))
-    conn.commit()
-
-    cur.close()
-    conn.close()
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(query, (image_name,))
+        bump_data_versions(cur, structure, [image_name])
+        cur.close()
 
     return
 
 
-def calculate_fraction_rna(structure_1, structure_2, image_name_column, distance_threshold, granule_bool, granule_threshold, database_name):
+@instrument_function()
+def calculate_fraction_rna(structure_1, structure_2, image_name_column, distance_threshold, granule_bool, granule_threshold, database_name, cache_bool=False):
     """ This function calculates the fraction of total structure 1 intensity at each distance from structure 2
 
     If granule_bool = True, then the function will calculate the % of structure 1 in granules (objects containing > granule_threshold # of objects) relative to distance from structure_2
 
+    If cache_bool = True, the result is saved in the result_cache table and returned from there until the structure_1 or images tables change (see cached_result)
+
     Returns a dataframe containing the a column with the distance from structure_2 and the corresponding % structure_1 (and optionally, % structure_1 in granules)
     """
 
     from psycopg2 import sql
-    import psycopg2
     import pandas as pd
-    import os
-
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
-
-    distance_col = 'distance_to_' + structure_2
-
-    # if user does not specify a distance threshold, use the largest distance from the db
-    if distance_threshold == None:
-        max_distance_query = sql.SQL("SELECT MAX({distance_col}) from {structure_1_table}").format(structure_1_table=sql.Identifier(structure_1), distance_col = sql.Identifier(distance_col))
-        cur.execute(max_distance_query)
-        distance_threshold = cur.fetchall()[0][0]
-
-    # calculate the total structure 1 fluoresence, grouped by image
-    total_structure_1_sql = sql.SQL("""SELECT {name},
-                                sum(total_intensity)
-                        FROM {structure_1_table}
-                        WHERE {distance_col} <= %(max_distance)s
-                        GROUP BY {name};""").format(
-                        structure_1_table = sql.Identifier(structure_1),
-                        distance_col =sql.Identifier(distance_col),
-                        name = sql.Identifier(image_name_column))
-
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
 
-    cur.execute(total_structure_1_sql, {'max_distance':distance_threshold})
-    total_structure_1_data = cur.fetchall()
+    if cache_bool:
+        parameters = {'structure_1': structure_1, 'structure_2': structure_2, 'image_name_column': image_name_column, 'distance_threshold': distance_threshold,
+                      'granule_bool': granule_bool, 'granule_threshold': granule_threshold}
 
+        return cached_result('calculate_fraction_rna', parameters, [structure_1, 'images'], database_name,
+                             lambda: calculate_fraction_rna(structure_1, structure_2, image_name_column, distance_threshold, granule_bool, granule_threshold, database_name))
 
-    # get the sum of structure 1 fluoresence intensity at each distance from structure 2
-    structure_1_distance_query = sql.SQL("""SELECT {name},
-                                                    SUM(total_intensity),
-                                                    {distance_col}
-                                            FROM {structure_1_table}
-                                            WHERE {distance_col} <= %(max_distance)s
-                                            GROUP BY {name}, {distance_col};""").format(
-                structure_1_table = sql.Identifier(structure_1),
-                distance_col =sql.Identifier(distance_col),
-                name = sql.Identifier(image_name_column))
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
 
-    cur.execute(structure_1_distance_query, {'max_distance':distance_threshold})
-    structure_1_per_distance_data = cur.fetchall()
+        distance_col = 'distance_to_' + structure_2
 
+        # if user does not specify a distance threshold, use the largest distance from the db
+        if distance_threshold == None:
+            max_distance_query = sql.SQL("SELECT MAX({distance_col}) from {structure_1_table}").format(structure_1_table=sql.Identifier(structure_1), distance_col = sql.Identifier(distance_col))
+            cur.execute(max_distance_query)
+            distance_threshold = cur.fetchall()[0][0]
 
-    # calculate the % in objects > the granule_threshold if user desires
-    if granule_bool:
-        structure_1_granule_query = sql.SQL("""SELECT {name},
+        # calculate the total structure 1 fluoresence, grouped by image
+        total_structure_1_sql = sql.SQL("""SELECT {name},
+                                    sum(total_intensity)
+                            FROM {structure_1_table}
+                            WHERE {distance_col} <= %(max_distance)s
+                            GROUP BY {name};""").format(
+                            structure_1_table = sql.Identifier(structure_1),
+                            distance_col =sql.Identifier(distance_col),
+                            name = sql.Identifier(image_name_column))
+
+        cur.execute(total_structure_1_sql, {'max_distance':distance_threshold})
+        total_structure_1_data = cur.fetchall()
+
+        # get the sum of structure 1 fluoresence intensity at each distance from structure 2
+        structure_1_distance_query = sql.SQL("""SELECT {name},
                                                         SUM(total_intensity),
                                                         {distance_col}
                                                 FROM {structure_1_table}
                                                 WHERE {distance_col} <= %(max_distance)s
-                                                AND normalized_intensity >= %(granule_threshold)s
                                                 GROUP BY {name}, {distance_col};""").format(
                     structure_1_table = sql.Identifier(structure_1),
                     distance_col =sql.Identifier(distance_col),
                     name = sql.Identifier(image_name_column))
 
-        cur.execute(structure_1_granule_query, {'max_distance':distance_threshold, 'granule_threshold': granule_threshold})
-        structure_1_granule_data = cur.fetchall()
+        cur.execute(structure_1_distance_query, {'max_distance':distance_threshold})
+        structure_1_per_distance_data = cur.fetchall()
+
+        # calculate the % in objects > the granule_threshold if user desires
+        if granule_bool:
+            structure_1_granule_query = sql.SQL("""SELECT {name},
+                                                            SUM(total_intensity),
+                                                            {distance_col}
+                                                    FROM {structure_1_table}
+                                                    WHERE {distance_col} <= %(max_distance)s
+                                                    AND normalized_intensity >= %(granule_threshold)s
+                                                    GROUP BY {name}, {distance_col};""").format(
+                        structure_1_table = sql.Identifier(structure_1),
+                        distance_col =sql.Identifier(distance_col),
+                        name = sql.Identifier(image_name_column))
 
-    # get the image data for the experiment
-    image_data_query = """SELECT * FROM images;"""
-    cur.execute(image_data_query)
-    image_data = cur.fetchall()
+            cur.execute(structure_1_granule_query, {'max_distance':distance_threshold, 'granule_threshold': granule_threshold})
+            structure_1_granule_data = cur.fetchall()
 
-    # get the column names for the images table
-    column_name_query = "SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'images';"
-    cur.execute(column_name_query)
-    column_names = cur.fetchall()
+        # get the image data for the experiment
+        image_data_query = """SELECT * FROM images;"""
+        cur.execute(image_data_query)
+        image_data = cur.fetchall()
 
+        # get the column names for the images table
+        column_name_query = "SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'images';"
+        cur.execute(column_name_query)
+        column_names = cur.fetchall()
 
-    cur.close()
-    conn.close()
+        cur.close()
 
     column_names_ls = [name[0] for name in column_names]
     image_data_df = pd.DataFrame(image_data, columns = column_names_ls)
@@ -669,71 +3660,69 @@ def calculate_percent_distributions(image_name, image_name_column, structure_1,
     """
     # package import
     from psycopg2 import sql
-    import psycopg2
-    import os
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
 
-    distance_col = 'distance_to_' + structure_2
+        distance_col = 'distance_to_' + structure_2
 
-    structure_1_total_query = sql.SQL("""SELECT SUM(total_intensity) FROM {structure_1_table}
-                WHERE {name} = %(image_name)s AND {distance_col} <= %(max_distance)s""").format(
-                structure_1_table = sql.Identifier(structure_1),
-                distance_col =sql.Identifier(distance_col),
-                name = sql.Identifier(image_name_column))
+        structure_1_total_query = sql.SQL("""SELECT SUM(total_intensity) FROM {structure_1_table}
+                    WHERE {name} = %(image_name)s AND {distance_col} <= %(max_distance)s""").format(
+                    structure_1_table = sql.Identifier(structure_1),
+                    distance_col =sql.Identifier(distance_col),
+                    name = sql.Identifier(image_name_column))
 
-    cur.execute(structure_1_total_query, {'image_name':image_name, 'max_distance' : distances[-1]})
-    total_structure_1 = cur.fetchall()[0][0]
+        cur.execute(structure_1_total_query, {'image_name':image_name, 'max_distance' : distances[-1]})
+        total_structure_1 = cur.fetchall()[0][0]
 
-    percent_structure_1_list = []
-    percent_granule_list = []
+        percent_structure_1_list = []
+        percent_granule_list = []
 
-    for distance in distances:
-        structure_1_sum_query = sql.SQL("""SELECT SUM(total_intensity) from {structure_1_table}
-                WHERE {name} = %(image_name)s AND {distance_col} <= %(distance)s""").format(
-                structure_1_table = sql.Identifier(structure_1),
-                distance_col =sql.Identifier(distance_col),
-                name = sql.Identifier(image_name_column))
+        for distance in distances:
+            structure_1_sum_query = sql.SQL("""SELECT SUM(total_intensity) from {structure_1_table}
+                    WHERE {name} = %(image_name)s AND {distance_col} <= %(distance)s""").format(
+                    structure_1_table = sql.Identifier(structure_1),
+                    distance_col =sql.Identifier(distance_col),
+                    name = sql.Identifier(image_name_column))
 
-        cur.execute(structure_1_sum_query, {'image_name':image_name, 'distance' : distance})
-        sum_structure_1 = cur.fetchall()[0][0]
+            cur.execute(structure_1_sum_query, {'image_name':image_name, 'distance' : distance})
+            sum_structure_1 = cur.fetchall()[0][0]
 
-        # avoid errors due to being unable to divide "None" by a number
-        if total_structure_1 == None:
-            percent_total_structure_1 = 0
-        else:
-            if sum_structure_1 == None:
-                sum_structure_1 = 0
+            # avoid errors due to being unable to divide "None" by a number
+            if total_structure_1 == None:
+                percent_total_structure_1 = 0
+            else:
+                if sum_structure_1 == None:
+                    sum_structure_1 = 0
 
-            percent_total_structure_1 = sum_structure_1 / total_structure_1 * 100
+                percent_total_structure_1 = sum_structure_1 / total_structure_1 * 100
 
-        percent_structure_1_list.append(percent_total_structure_1)
+            percent_structure_1_list.append(percent_total_structure_1)
 
-        # repeat these calculations for the normalized
+            # repeat these calculations for the normalized
 
-        if granule_bool:
-            structure_1_granule_query = sql.SQL("""SELECT SUM(total_intensity) from {structure_1_table}
-                    WHERE {name} = %(image_name)s AND {distance_col} <= %(distance)s
-                    AND normalized_intensity >= %(granule_threshold)s""").format(
-                    structure_1_table = sql.Identifier(structure_1),
-                    distance_col =sql.Identifier(distance_col),
-                    name = sql.Identifier(image_name_column))
+            if granule_bool:
+                structure_1_granule_query = sql.SQL("""SELECT SUM(total_intensity) from {structure_1_table}
+                        WHERE {name} = %(image_name)s AND {distance_col} <= %(distance)s
+                        AND normalized_intensity >= %(granule_threshold)s""").format(
+                        structure_1_table = sql.Identifier(structure_1),
+                        distance_col =sql.Identifier(distance_col),
+                        name = sql.Identifier(image_name_column))
 
-            cur.execute(structure_1_granule_query, {'image_name':image_name, 'distance' : distance, 'granule_threshold': granule_threshold})
-            granule_structure_1 = cur.fetchall()[0][0]
+                cur.execute(structure_1_granule_query, {'image_name':image_name, 'distance' : distance, 'granule_threshold': granule_threshold})
+                granule_structure_1 = cur.fetchall()[0][0]
 
-            # avoid division by None errors
-            if total_structure_1 == None:
-                percent_granule_structure_1 = 0
-            else:
-                if granule_structure_1 == None:
-                    granule_structure_1 = 0
+                # avoid division by None errors
+                if total_structure_1 == None:
+                    percent_granule_structure_1 = 0
+                else:
+                    if granule_structure_1 == None:
+                        granule_structure_1 = 0
 
-                percent_granule_structure_1 = granule_structure_1 / total_structure_1 * 100
-            percent_granule_list.append(percent_granule_structure_1)
+                    percent_granule_structure_1 = granule_structure_1 / total_structure_1 * 100
+                percent_granule_list.append(percent_granule_structure_1)
 
-    cur.close()
+        cur.close()
 
     if granule_bool:
         structure_1_distribution_dict = {'distance': distances, 'percent_total_structure_1': percent_structure_1_list, 'percent_granule_structure_1' : percent_granule_list}
@@ -742,40 +3731,146 @@ def calculate_percent_distributions(image_name, image_name_column, structure_1,
 
     return structure_1_distribution_dict
 
-def calculate_distributions_by_image(distance_threshold, granule_bool, granule_threshold, step_size, image_name_column, structure_1, structure_2, database_name):
-    """ Takes a distance threshold, a step_size, the structure_2 distance target, and a postgres db details
+def calculate_cumulative_distributions_sql(distance_threshold, granule_bool, granule_threshold, step_size, image_name_column, structure_1, structure_2, database_name):
+    """ Calculates the cumulative structure_1 distributions of every image in the images table w/ one SQL statement
 
-    Calculates the percent of total structure_1 fluorescence from 0 microns to the distance threshold away from a structure_2 object (or max image distance if the distance_threshold is set to None) at increments dictated by the step size
+    Each object is assigned to the first distance step (i * step_size) that is >= its distance; the cumulative sums at each step are
+    window sums over these bins, partitioned by image. The distances match np.arange(0, distance_threshold, step_size) plus the distance threshold,
+    as in calculate_distributions_by_image. If distance_threshold is None, the max distance of each image is used as that image's threshold
+    Intensities are summed as double precision
 
-    Returns a pandas dataframe object containing the distribution data
+    Returns a dict mapping each image name to a dict w/ the 'distance', 'percent_total_structure_1' (and 'percent_granule_structure_1' if granule_bool = True) lists
+    Images w/o a distance threshold (no measured objects and distance_threshold = None) are left out
     """
 
     # package import
-    import psycopg2
     from psycopg2 import sql
-    import numpy as np
-    import pandas as pd
-    import os
 
+    distance_col = 'distance_to_' + structure_2
 
-    # import image data from images table and create the image_data_list
-    # it assumes that the name of your images table is "images"
+    # the granule sums are only calculated if needed, since the normalized_intensity column may not exist
+    if granule_bool:
+        granule_sum_sql = sql.SQL("SUM(total_intensity::DOUBLE PRECISION) FILTER (WHERE normalized_intensity >= %(granule_threshold)s)")
+    else:
+        granule_sum_sql = sql.SQL("NULL::DOUBLE PRECISION")
+
+    distribution_query = sql.SQL("""WITH image_thresholds AS (
+                                        SELECT images.{name} AS image_name,
+                                               COALESCE(%(distance_threshold)s::DOUBLE PRECISION,
+                                                        (SELECT MAX({distance_col}) FROM {structure_1_table} WHERE {structure_1_table}.{name} = images.{name})) AS distance_threshold
+                                        FROM images
+                                    ),
+                                    distance_steps AS (
+                                        SELECT image_name, step_idx, step_idx * %(step_size)s::DOUBLE PRECISION AS distance
+                                        FROM image_thresholds,
+                                             generate_series(0, CEIL(distance_threshold / %(step_size)s::DOUBLE PRECISION)::INT - 1) AS step_idx
+                                        WHERE distance_threshold IS NOT NULL
+                                    ),
+                                    object_steps AS (
+                                        SELECT {name} AS image_name, total_intensity, {granule_columns}
+                                               {distance_col}::DOUBLE PRECISION AS distance,
+                                               GREATEST(CEIL({distance_col}::DOUBLE PRECISION / %(step_size)s::DOUBLE PRECISION), 0)::INT AS step_idx
+                                        FROM {structure_1_table}
+                                        WHERE {distance_col} IS NOT NULL
+                                    ),
+                                    object_bins AS (
+                                        -- correct the rounding of the division so that each object is in the first step w/ step distance >= object distance
+                                        SELECT image_name, total_intensity, {granule_columns}
+                                               CASE WHEN step_idx > 0 AND (step_idx - 1) * %(step_size)s::DOUBLE PRECISION >= distance THEN step_idx - 1
+                                                    WHEN step_idx * %(step_size)s::DOUBLE PRECISION < distance THEN step_idx + 1
+                                                    ELSE step_idx END AS step_idx
+                                        FROM object_steps
+                                    ),
+                                    bin_sums AS (
+                                        SELECT image_name, step_idx,
+                                               SUM(total_intensity::DOUBLE PRECISION) AS bin_intensity,
+                                               {granule_sum} AS bin_granule_intensity
+                                        FROM object_bins
+                                        GROUP BY image_name, step_idx
+                                    ),
+                                    threshold_sums AS (
+                                        SELECT image_thresholds.image_name, image_thresholds.distance_threshold,
+                                               SUM(total_intensity::DOUBLE PRECISION) AS total_intensity,
+                                               {granule_sum} AS granule_intensity
+                                        FROM image_thresholds
+                                        LEFT JOIN {structure_1_table}
+                                            ON {structure_1_table}.{name} = image_thresholds.image_name
+                                            AND {structure_1_table}.{distance_col} <= image_thresholds.distance_threshold
+                                        WHERE image_thresholds.distance_threshold IS NOT NULL
+                                        GROUP BY image_thresholds.image_name, image_thresholds.distance_threshold
+                                    ),
+                                    step_sums AS (
+                                        SELECT distance_steps.image_name, distance_steps.step_idx, distance_steps.distance,
+                                               SUM(COALESCE(bin_sums.bin_intensity, 0)) OVER image_steps AS cumulative_intensity,
+                                               SUM(COALESCE(bin_sums.bin_granule_intensity, 0)) OVER image_steps AS cumulative_granule_intensity
+                                        FROM distance_steps
+                                        LEFT JOIN bin_sums USING (image_name, step_idx)
+                                        WINDOW image_steps AS (PARTITION BY distance_steps.image_name ORDER BY distance_steps.step_idx)
+                                    )
+                                    SELECT image_name, step_idx, distance, cumulative_intensity, cumulative_granule_intensity
+                                    FROM step_sums
+                                    UNION ALL
+                                    SELECT image_name, NULL, distance_threshold, total_intensity, granule_intensity
+                                    FROM threshold_sums
+                                    ORDER BY 1, 2 NULLS LAST;""").format(
+                                        structure_1_table = sql.Identifier(structure_1),
+                                        distance_col = sql.Identifier(distance_col),
+                                        name = sql.Identifier(image_name_column),
+                                        granule_columns = sql.SQL("normalized_intensity,") if granule_bool else sql.SQL(""),
+                                        granule_sum = granule_sum_sql)
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(distribution_query, {'distance_threshold': distance_threshold, 'step_size': step_size, 'granule_threshold': granule_threshold})
+        distribution_rows = cur.fetchall()
+        cur.close()
+
+    # the threshold row of each image comes last and holds the total intensity used to calculate the percentages
+    image_rows = {}
+    for image_name, step_idx, distance, cumulative_intensity, cumulative_granule_intensity in distribution_rows:
+        image_rows.setdefault(image_name, []).append((distance, cumulative_intensity, cumulative_granule_intensity))
+
+    distribution_curves = {}
+
+    for image_name, rows in image_rows.items():
+        total_structure_1 = rows[-1][1]
+
+        # avoid errors due to being unable to divide "None" by a number
+        if total_structure_1 == None:
+            percent_structure_1_list = [0 for row in rows]
+            percent_granule_list = [0 for row in rows]
+        else:
+            percent_structure_1_list = [(row[1] or 0) / total_structure_1 * 100 for row in rows]
+            percent_granule_list = [(row[2] or 0) / total_structure_1 * 100 for row in rows]
+
+        distribution_curves[image_name] = {'distance': [row[0] for row in rows], 'percent_total_structure_1': percent_structure_1_list}
+
+        if granule_bool:
+            distribution_curves[image_name]['percent_granule_structure_1'] = percent_granule_list
+
+    return distribution_curves
+
+def fetch_image_data(database_name):
+    """ Imports the image data from the images table
+    It assumes that the name of your images table is "images"
+
+    Returns a list of dictionaries that contain 'column_name' : field, one dictionary per row of the images table
+    """
 
     column_name_query = "SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'images';"
 
     image_name_query = "SELECT * FROM images;"
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
 
-    cur.execute(column_name_query)
-    column_names =  [column_name[0] for column_name in cur.fetchall()]
+        cur.execute(column_name_query)
+        column_names =  [column_name[0] for column_name in cur.fetchall()]
 
-    cur.execute(image_name_query)
-    image_data =  cur.fetchall()
+        cur.execute(image_name_query)
+        image_data =  cur.fetchall()
 
-    cur.close()
-    conn.close()
+        cur.close()
 
     # process the images data into format needed for cumulative distribution calculation
     # this will create a list of dictionaries that contain 'column_name' : field
@@ -793,42 +3888,399 @@ def calculate_distributions_by_image(distance_threshold, granule_bool, granule_t
 
         image_data_list.append(image_data_dict)
 
+    return image_data_list
 
-    conn = psycopg2.connect('postgresql://'+os.environ['POSTGRES_USER']+':'+os.environ['POSTGRES_PASSWORD']+'@'+"db"+':'+'5432'+'/'+database_name)
-    cur = conn.cursor()
+def fetch_distance_data(image_name_column, structure_1, structure_2, granule_bool, database_name):
+    """ Selects the image name, distance to structure_2, total intensity and (if granule_bool = True) normalized intensity
+    of every structure_1 object that has been measured, in one query
 
-    distribution_dicts = []
+    The REAL values are returned exactly (as float32 values stored in float64 arrays), so calculations match those done in postgres
 
-    for image_data_dict in image_data_list:
+    Returns a pandas dataframe w/ the columns 'name', 'distance', 'total_intensity' and 'normalized_intensity'
+    ('name' holds the values of the image_name_column; 'normalized_intensity' is NaN if granule_bool = False)
+    """
 
-        image_name = image_data_dict[image_name_column]
+    # package import
+    from psycopg2 import sql
+    import numpy as np
+    import pandas as pd
 
-        print('Calculating cumulative distributions for ' + image_name)
+    distance_col = 'distance_to_' + structure_2
 
-        # if user specifies distance_threshold = None, then get the max distance to structure_2 from the  database
-        if distance_threshold == None:
-            distance_col = 'distance_to_' + structure_2
-            max_distance_query = sql.SQL("SELECT MAX({distance_col}) from {structure_1_table} WHERE {name} = %(image_name)s").format(structure_1_table=sql.Identifier(structure_1), distance_col = sql.Identifier(distance_col), name = sql.Identifier(image_name_column))
-            cur.execute(max_distance_query, {'image_name':image_name})
-            distance_threshold = cur.fetchall()[0][0]
+    distance_data_query = sql.SQL("""SELECT {name}, {distance_col}, total_intensity, {normalized_intensity}
+                                    FROM {structure_1_table}
+                                    WHERE {distance_col} IS NOT NULL;""").format(
+                                    structure_1_table = sql.Identifier(structure_1),
+                                    distance_col = sql.Identifier(distance_col),
+                                    name = sql.Identifier(image_name_column),
+                                    normalized_intensity = sql.SQL("normalized_intensity") if granule_bool else sql.SQL("NULL::REAL"))
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        # print REAL values w/ enough digits to recover them exactly (only for this transaction)
+        cur.execute("SET LOCAL extra_float_digits = 3;")
+        cur.execute(distance_data_query)
+        distance_data = cur.fetchall()
+
+        cur.close()
+
+    distance_data_df = pd.DataFrame(distance_data, columns = ['name', 'distance', 'total_intensity', 'normalized_intensity'])
+
+    for column_name in ['distance', 'total_intensity', 'normalized_intensity']:
+        distance_data_df[column_name] = np.array(distance_data_df[column_name], dtype=float).astype(np.float32).astype(float)
+
+    return distance_data_df
+
+def compute_cumulative_distributions(distance_data, image_data_list, distance_threshold, granule_bool, granule_threshold, step_size, image_name_column):
+    """ Takes the output of fetch_distance_data and fetch_image_data, and the parameters of calculate_distributions_by_image
+
+    Calculates the cumulative structure_1 distributions of every image in memory, w/o querying the database, so the distributions
+    can be recalculated quickly for a different step_size, distance_threshold or granule_threshold
+    For each image, the objects are sorted by distance once; the cumulative intensity at each distance is found w/ np.searchsorted
+    on the sorted distances and np.cumsum of the intensities. The granule intensities are a second cumsum w/ the non-granule objects masked out
+    As in the 'sql' distribution mode, the max distance of each image is used if distance_threshold is None
+
+    Returns a pandas dataframe like calculate_distributions_by_image
+    """
+
+    # package import
+    import numpy as np
+    import pandas as pd
+
+    distances = np.asarray(distance_data['distance'], dtype=float)
+    intensities = np.asarray(distance_data['total_intensity'], dtype=float)
+
+    # sort the objects by image, then by distance, and find where each image starts
+    image_codes, image_names = pd.factorize(distance_data['name'], sort=True)
+    object_order = np.lexsort((distances, image_codes))
+    image_starts = np.searchsorted(image_codes[object_order], np.arange(len(image_names) + 1))
+
+    sorted_distances = distances[object_order]
+    sorted_intensities = intensities[object_order]
+
+    if granule_bool:
+        granule_mask = np.asarray(distance_data['normalized_intensity'], dtype=float)[object_order] >= granule_threshold
+
+    distribution_curves = {}
+
+    for image_idx, image_name in enumerate(image_names):
+        image_start, image_end = image_starts[image_idx], image_starts[image_idx + 1]
+        image_distances = sorted_distances[image_start:image_end]
+
+        image_threshold = distance_threshold
+        if image_threshold == None:
+            image_threshold = image_distances[-1]
+
+        image_steps = np.append(np.arange(0, image_threshold, step_size), image_threshold)
+
+        # number of objects w/ distance <= each step, and the cumulative intensities w/ a leading 0 for steps w/o objects
+        step_counts = np.searchsorted(image_distances, image_steps, side='right')
+        cumulative_intensities = np.concatenate([[0], np.cumsum(sorted_intensities[image_start:image_end])])
+
+        total_structure_1 = cumulative_intensities[step_counts[-1]]
+
+        # avoid errors due to being unable to divide "None" by a number
+        if step_counts[-1] == 0:
+            percent_structure_1 = np.zeros(len(image_steps))
+        else:
+            percent_structure_1 = cumulative_intensities[step_counts] / total_structure_1 * 100
+
+        distribution_curves[image_name] = {'distance': image_steps, 'percent_total_structure_1': percent_structure_1}
+
+        if granule_bool:
+            cumulative_granule_intensities = np.concatenate([[0], np.cumsum(np.where(granule_mask[image_start:image_end], sorted_intensities[image_start:image_end], 0))])
+
+            if step_counts[-1] == 0:
+                percent_granule = np.zeros(len(image_steps))
+            else:
+                percent_granule = cumulative_granule_intensities[step_counts] / total_structure_1 * 100
+
+            distribution_curves[image_name]['percent_granule_structure_1'] = percent_granule
+
+    # images w/o measured objects have no distances if distance_threshold is None
+    if distance_threshold != None:
+        empty_steps = np.append(np.arange(0, distance_threshold, step_size), distance_threshold)
+
+        for image_data_dict in image_data_list:
+            image_name = image_data_dict[image_name_column]
+
+            if image_name not in distribution_curves:
+                distribution_curves[image_name] = {'distance': empty_steps, 'percent_total_structure_1': np.zeros(len(empty_steps))}
+
+                if granule_bool:
+                    distribution_curves[image_name]['percent_granule_structure_1'] = np.zeros(len(empty_steps))
+
+    return distribution_curves_to_df(distribution_curves, image_data_list, image_name_column)
+
+def distribution_curves_to_df(distribution_curves, image_data_list, image_name_column):
+    """ Takes a dict mapping image names to distribution dicts (w/ the 'distance', 'percent_total_structure_1' and optionally
+    'percent_granule_structure_1' values), and the image data from fetch_image_data
+
+    Returns a pandas dataframe containing the distribution data and the image data, in the order of the image_data_list
+    """
+
+    # package import
+    import pandas as pd
 
-        distances = np.arange(0, distance_threshold, step_size)
-        distances = np.append(distances, distance_threshold)
+    distribution_dicts = []
+
+    for image_data_dict in image_data_list:
+        image_name = image_data_dict[image_name_column]
 
-        structure_1_distribution_dict = calculate_percent_distributions(image_name, image_name_column, structure_1, structure_2, granule_bool, granule_threshold, distances, database_name)
+        if image_name not in distribution_curves:
+            print('No distances for ' + str(image_name))
+            continue
 
+        structure_1_distribution_dict = dict(distribution_curves[image_name])
         structure_1_distribution_dict.update(image_data_dict)
 
         distribution_dicts.append(structure_1_distribution_dict)
 
-    cur.close()
-    conn.close()
+    return pd.concat([pd.DataFrame(dict_obj) for dict_obj in distribution_dicts])
+
+@instrument_function()
+def calculate_distributions_by_image(distance_threshold, granule_bool, granule_threshold, step_size, image_name_column, structure_1, structure_2, database_name, distribution_mode='query',
+                                     cache_bool=False):
+    """ Takes a distance threshold, a step_size, the structure_2 distance target, and a postgres db details
+
+    Calculates the percent of total structure_1 fluorescence from 0 microns to the distance threshold away from a structure_2 object (or max image distance if the distance_threshold is set to None) at increments dictated by the step size
+
+    distribution_mode - 'query' (default) runs calculate_percent_distributions for each image, w/ one query per distance
+                        'sql' calculates all of the images at once w/ calculate_cumulative_distributions_sql
+                        'numpy' selects the distances once (fetch_distance_data) and calculates the distributions in memory (compute_cumulative_distributions)
+                        When distance_threshold is None, 'sql' and 'numpy' use the max distance of each image
+    cache_bool - if True, the result is saved in the result_cache table and returned from there until the structure_1 or images tables change (see cached_result)
+
+    Returns a pandas dataframe object containing the distribution data
+    """
+
+    if distribution_mode not in ('query', 'sql', 'numpy'):
+        raise ValueError("distribution_mode must be 'query', 'sql' or 'numpy', not {distribution_mode!r}".format(distribution_mode=distribution_mode))
+
+    # package import
+    from psycopg2 import sql
+    import numpy as np
+    import pandas as pd
+
+    if cache_bool:
+        parameters = {'structure_1': structure_1, 'structure_2': structure_2, 'image_name_column': image_name_column, 'distance_threshold': distance_threshold,
+                      'granule_bool': granule_bool, 'granule_threshold': granule_threshold, 'step_size': step_size, 'distribution_mode': distribution_mode}
+
+        return cached_result('calculate_distributions_by_image', parameters, [structure_1, 'images'], database_name,
+                             lambda: calculate_distributions_by_image(distance_threshold, granule_bool, granule_threshold, step_size, image_name_column,
+                                                                      structure_1, structure_2, database_name, distribution_mode=distribution_mode))
+
+
+    # import image data from images table and create the image_data_list
+    image_data_list = fetch_image_data(database_name)
+
+    if distribution_mode == 'sql':
+        print('Calculating cumulative distributions for all images')
+
+        distribution_curves = calculate_cumulative_distributions_sql(distance_threshold, granule_bool, granule_threshold, step_size, image_name_column, structure_1, structure_2, database_name)
+
+        return distribution_curves_to_df(distribution_curves, image_data_list, image_name_column)
+
+    if distribution_mode == 'numpy':
+        print('Calculating cumulative distributions for all images')
+
+        distance_data = fetch_distance_data(image_name_column, structure_1, structure_2, granule_bool, database_name)
+
+        return compute_cumulative_distributions(distance_data, image_data_list, distance_threshold, granule_bool, granule_threshold, step_size, image_name_column)
+
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        distribution_dicts = []
+
+        for image_data_dict in image_data_list:
+
+            image_name = image_data_dict[image_name_column]
+
+            print('Calculating cumulative distributions for ' + image_name)
+
+            # if user specifies distance_threshold = None, then get the max distance to structure_2 from the  database
+            if distance_threshold == None:
+                distance_col = 'distance_to_' + structure_2
+                max_distance_query = sql.SQL("SELECT MAX({distance_col}) from {structure_1_table} WHERE {name} = %(image_name)s").format(structure_1_table=sql.Identifier(structure_1), distance_col = sql.Identifier(distance_col), name = sql.Identifier(image_name_column))
+                cur.execute(max_distance_query, {'image_name':image_name})
+                distance_threshold = cur.fetchall()[0][0]
+
+            distances = np.arange(0, distance_threshold, step_size)
+            distances = np.append(distances, distance_threshold)
+
+            structure_1_distribution_dict = calculate_percent_distributions(image_name, image_name_column, structure_1, structure_2, granule_bool, granule_threshold, distances, database_name)
+
+            structure_1_distribution_dict.update(image_data_dict)
+
+            distribution_dicts.append(structure_1_distribution_dict)
+
+        cur.close()
 
 
     structure_1_distributions_df = pd.concat([pd.DataFrame(dict_obj) for dict_obj in distribution_dicts])
 
     return structure_1_distributions_df
 
+def table_version_stamp(tables, database_name):
+    """ Returns a string that changes whenever the pipeline changes any of the tables
+
+    The stamp holds the oid of each table, which changes when a table is re-created (e.g. the images table by pandas' to_sql),
+    and the ids of its last recorded changes (see record_table_changes); tables that don't exist have no oid
+    Nothing is created here: before the first change is recorded, the table_changes table may not exist yet and the tables have no changes
+    """
+
+    import json
+
+    from psycopg2 import sql
+
+    stamp_query = sql.SQL("""SELECT table_name, to_regclass(quote_ident(table_name))::oid::BIGINT, {changes}
+                    FROM UNNEST(%(tables)s::TEXT[]) AS tables(table_name)
+                    ORDER BY table_name;""")
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        if database_name not in _version_tables:
+            cur.execute("SELECT to_regclass('table_changes') IS NOT NULL;")
+
+            if cur.fetchone()[0]:
+                _version_tables.add(database_name)
+
+        if database_name in _version_tables:
+            changes = sql.SQL("""(SELECT ARRAY_AGG(transaction_id ORDER BY transaction_id)
+                            FROM table_changes WHERE table_changes.table_name = tables.table_name)""")
+        else:
+            changes = sql.SQL("NULL::BIGINT[]")
+
+        cur.execute(stamp_query.format(changes=changes), {'tables': sorted(set(tables))})
+        table_versions = cur.fetchall()
+        cur.close()
+
+    return json.dumps([list(table_version) for table_version in table_versions])
+
+def create_result_cache_table(database_name):
+    """ Creates the result_cache table, if it doesn't exist
+
+    Each row holds one pickled result, keyed by a hash of the function name, its parameters and the version stamp
+    of the tables it reads (see cached_result)
+
+    Returns nothing
+    """
+
+    result_cache_query = """CREATE TABLE IF NOT EXISTS result_cache (
+                            cache_key TEXT PRIMARY KEY,
+                            parameter_key TEXT NOT NULL,
+                            function_name TEXT NOT NULL,
+                            structure_1 TEXT,
+                            structure_2 TEXT,
+                            parameters TEXT NOT NULL,
+                            table_stamp TEXT NOT NULL,
+                            result BYTEA NOT NULL,
+                            size_bytes BIGINT NOT NULL,
+                            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            last_used_at TIMESTAMPTZ NOT NULL DEFAULT now());"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute(result_cache_query)
+        cur.execute("CREATE INDEX IF NOT EXISTS result_cache_parameter_key_idx ON result_cache (parameter_key);")
+        cur.close()
+
+    return
+
+def cached_result(function_name, parameters, tables, database_name, compute_function, max_cache_bytes=None):
+    """ Returns the result of compute_function() from the result_cache table, or calls it and saves the result
+
+    The result is looked up by function_name, the parameters dictionary (e.g. the structures, step_size and thresholds)
+    and the version stamp of the tables it reads (see table_version_stamp), so any change the pipeline makes to those tables
+    (new distance measurements, re-ingested images, a re-created images table, ...) makes old results miss
+    Changes made w/ your own SQL are only noticed if they are recorded w/ record_table_changes (or clear the cache w/ clear_result_cache)
+    Results for the same parameters but an older stamp are deleted when the new result is saved
+    The least recently used results are deleted once the cache holds more than max_cache_bytes
+    (default: the RESULT_CACHE_MAX_BYTES environment variable, or 256 MB)
+
+    Results are stored w/ pickle, so only use the cache w/ databases you trust
+    """
+
+    # package import
+    import hashlib
+    import json
+    import os
+    import pickle
+
+    if max_cache_bytes is None:
+        max_cache_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 268435456))
+
+    create_result_cache_table(database_name)
+
+    parameters_json = json.dumps(parameters, sort_keys=True, default=str)
+    table_stamp = table_version_stamp(tables, database_name)
+
+    parameter_key = hashlib.sha256((function_name + parameters_json).encode('utf-8')).hexdigest()
+    cache_key = hashlib.sha256((parameter_key + table_stamp).encode('utf-8')).hexdigest()
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE result_cache SET last_used_at = now() WHERE cache_key = %s RETURNING result;", (cache_key,))
+        cached_row = cur.fetchone()
+        cur.close()
+
+    if cached_row is not None:
+        print('Using the cached result of ' + function_name)
+        return pickle.loads(bytes(cached_row[0]))
+
+    result = compute_function()
+
+    result_pickle = pickle.dumps(result, protocol=4)
+
+    # keep the most recently used results that fit in max_cache_bytes
+    evict_query = """DELETE FROM result_cache
+                    WHERE cache_key IN (SELECT cache_key
+                                        FROM (SELECT cache_key, SUM(size_bytes) OVER (ORDER BY last_used_at DESC, cache_key) AS cache_bytes
+                                                FROM result_cache) AS cache_sizes
+                                        WHERE cache_bytes > %(max_cache_bytes)s);"""
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        cur.execute("DELETE FROM result_cache WHERE parameter_key = %s;", (parameter_key,))
+        cur.execute("""INSERT INTO result_cache (cache_key, parameter_key, function_name, structure_1, structure_2, parameters, table_stamp, result, size_bytes)
+                    VALUES (%(cache_key)s, %(parameter_key)s, %(function_name)s, %(structure_1)s, %(structure_2)s, %(parameters)s, %(table_stamp)s, %(result)s, %(size_bytes)s)
+                    ON CONFLICT (cache_key) DO NOTHING;""",
+                    {'cache_key': cache_key, 'parameter_key': parameter_key, 'function_name': function_name,
+                     'structure_1': parameters.get('structure_1'), 'structure_2': parameters.get('structure_2'),
+                     'parameters': parameters_json, 'table_stamp': table_stamp,
+                     'result': result_pickle, 'size_bytes': len(result_pickle)})
+        cur.execute(evict_query, {'max_cache_bytes': max_cache_bytes})
+
+        cur.close()
+
+    return result
+
+def clear_result_cache(database_name, structure=None):
+    """ Deletes the cached results (see cached_result) that involve structure (as structure_1 or structure_2), or all of them
+
+    Returns the number of results deleted
+    """
+
+    create_result_cache_table(database_name)
+
+    with database_connection(database_name) as conn:
+        cur = conn.cursor()
+
+        if structure is None:
+            cur.execute("DELETE FROM result_cache;")
+        else:
+            cur.execute("DELETE FROM result_cache WHERE structure_1 = %(structure)s OR structure_2 = %(structure)s;", {'structure': structure})
+
+        deleted_count = cur.rowcount
+        cur.close()
+
+    return deleted_count
+
 def save_csv(csv_fn, output_dir, df_to_save):
     """ This function takes two strings as inputs and a pandas dataframe. csv_fn describes the desired filename
     output_dir is the directory to save the csv. df_to_save is a pandas dataframe containing data to save